@@ -4,10 +4,23 @@ Unified RADIUS authentication backend for reverse proxy forward auth using FastA
 Supports nginx, Traefik, and Caddy with configurable behavior.
 """
 
+import asyncio
+import base64
+import hashlib
+import heapq
+import hmac
+import ipaddress
 import logging
 import os
+import random
 import secrets
-from datetime import datetime, timedelta
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import unquote, urlsplit
 
 from fastapi import FastAPI, Form, Request, Response
 from fastapi.responses import HTMLResponse, RedirectResponse
@@ -19,7 +32,44 @@ RADIUS_SERVER = os.getenv("RADIUS_SERVER", "radius")
 RADIUS_SECRET = os.getenv("RADIUS_SECRET", "testing123")
 RADIUS_PORT = int(os.getenv("RADIUS_PORT", "1812"))
 RADIUS_NAS_IDENTIFIER = os.getenv("RADIUS_NAS_IDENTIFIER", "auth-backend")
+RADIUS_DICTIONARY = os.getenv("RADIUS_DICTIONARY", "/app/dictionary")
 SESSION_TIMEOUT = int(os.getenv("SESSION_TIMEOUT", "3600"))
+# Most sessions kept in memory; beyond this the least recently used one is dropped
+SESSION_MAX = int(os.getenv("SESSION_MAX", "100000"))
+# Seconds between sweeps that remove expired sessions
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "30"))
+# Where sessions live: memory (one worker), sqlite (workers on one host), redis
+# (replicas on any host; anything speaking the Redis protocol works) or signed
+# (nowhere: the cookie is an HMAC-signed token, see SESSION_KEYS)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "/tmp/radius-auth-sessions.db")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://redis:6379/0")
+# Shared backends: seconds a successful lookup is answered from process memory
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "5"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+# Signed backend: comma-separated key_id:secret pairs. The first key signs new
+# sessions, all of them verify, so keys rotate by prepending a new one and
+# dropping the old one once its sessions have expired.
+SESSION_KEYS = os.getenv("SESSION_KEYS", "")
+# Fraction of /auth checks that write a log line (1 logs every request)
+AUTH_LOG_SAMPLE_RATE = float(os.getenv("AUTH_LOG_SAMPLE_RATE", "1"))
+# Login throttling, checked before any RADIUS work: LOGIN_USER_LIMIT failed attempts
+# for one username or LOGIN_IP_LIMIT from one client IP within LOGIN_WINDOW seconds
+# lock that key out for LOGIN_LOCKOUT seconds, doubling on each repeat up to
+# LOGIN_MAX_LOCKOUT. Only rejected passwords count, so concurrent or repeated correct
+# logins never lock a user out. A successful login clears its username. 0 disables a limit.
+# The per-IP limit is only on by default when uvicorn trusts proxy headers: behind the
+# reverse proxy every client otherwise shares its address, and one attacker could lock
+# everybody out.
+LOGIN_WINDOW = float(os.getenv("LOGIN_WINDOW", "300"))
+LOGIN_USER_LIMIT = int(os.getenv("LOGIN_USER_LIMIT", "5"))
+TRUSTED_PROXY_HEADERS = bool(os.getenv("FORWARDED_ALLOW_IPS"))
+LOGIN_IP_LIMIT = int(
+    os.getenv("LOGIN_IP_LIMIT", "20" if TRUSTED_PROXY_HEADERS else "0")
+)
+LOGIN_LOCKOUT = float(os.getenv("LOGIN_LOCKOUT", "60"))
+LOGIN_MAX_LOCKOUT = float(os.getenv("LOGIN_MAX_LOCKOUT", "3600"))
+LOGIN_THROTTLE_MAX_KEYS = int(os.getenv("LOGIN_THROTTLE_MAX_KEYS", "100000"))
 # nginx auth_request module only accepts 2xx (auth ok) or 401/403 (auth fail)
 # Traefik/Caddy forward_auth can handle 302 redirects directly
 PROXY_TYPE = os.getenv("PROXY_TYPE", "generic")  # nginx | generic
@@ -31,11 +81,631 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s",
 )
 
+
+class SessionStore(ABC):
+    """Interface of the session backends. Session IDs are opaque random strings."""
+
+    @abstractmethod
+    async def create(self, username):
+        """Start a session and return its ID."""
+
+    @abstractmethod
+    async def get(self, session_id):
+        """Username of a live session, or None."""
+
+    @abstractmethod
+    async def delete(self, session_id):
+        """End a session; returns its username if it existed."""
+
+    async def sweep(self):
+        """Remove expired sessions; returns how many were removed."""
+        return 0
+
+    def stats(self):
+        return {}
+
+
+class MemorySessionStore(SessionStore):
+    """In-memory sessions with proactive expiry and an LRU size cap.
+
+    Lookups are a single dict access. Expiry times also go into a min-heap that
+    a background task sweeps, so abandoned sessions are freed even if their
+    cookie is never presented again. Heap entries of sessions that were logged
+    out or evicted are skipped when they come up.
+    """
+
+    def __init__(self, timeout, max_sessions):
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self.sessions = (
+            OrderedDict()
+        )  # session_id -> (username, expires), oldest use first
+        self.expiry_heap = []  # (expires, session_id)
+        self.expired = 0
+        self.evicted = 0
+
+    async def create(self, username):
+        session_id = secrets.token_urlsafe(32)
+        expires = time.monotonic() + self.timeout
+        self.sessions[session_id] = (username, expires)
+        heapq.heappush(self.expiry_heap, (expires, session_id))
+        while self.max_sessions and len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+            self.evicted += 1
+        return session_id
+
+    async def get(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        username, expires = session
+        if time.monotonic() > expires:
+            # Expired since the last sweep
+            del self.sessions[session_id]
+            self.expired += 1
+            return None
+        self.sessions.move_to_end(session_id)
+        return username
+
+    async def delete(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        return session[0] if session else None
+
+    async def sweep(self):
+        """Remove every expired session; returns how many were removed."""
+        now = time.monotonic()
+        removed = 0
+        heap = self.expiry_heap
+        while heap and heap[0][0] <= now:
+            expires, session_id = heapq.heappop(heap)
+            session = self.sessions.get(session_id)
+            if session is not None and session[1] == expires:
+                del self.sessions[session_id]
+                removed += 1
+        self.expired += removed
+        if len(heap) > 2 * len(self.sessions) + 1024:
+            # Mostly entries of sessions that are already gone; rebuild from the live ones
+            self.expiry_heap = [(exp, sid) for sid, (_, exp) in self.sessions.items()]
+            heapq.heapify(self.expiry_heap)
+        return removed
+
+    def stats(self):
+        return {
+            "live": len(self.sessions),
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in a SQLite database in WAL mode, shared by the workers on one host.
+
+    In WAL mode readers do not wait for a writer, so lookups use their own
+    read-only connection and lock and never queue behind a write. Reads and
+    writes both run in a thread: a checkpoint or another worker's lock can
+    still hold SQLite up for the busy timeout, which must not stall the event
+    loop. Once there are more than max_sessions, the sweep drops the sessions
+    closest to expiry.
+    """
+
+    def __init__(self, path, timeout, max_sessions):
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self.expired = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(id TEXT PRIMARY KEY, username TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)"
+        )
+        self.reader = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self.reader.execute("PRAGMA query_only=ON")
+        self.read_lock = threading.Lock()
+
+    def _run(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params)
+
+    def _read(self, sql, params=()):
+        with self.read_lock:
+            return self.reader.execute(sql, params).fetchone()
+
+    async def create(self, username):
+        session_id = secrets.token_urlsafe(32)
+        # Wall-clock time: the expiry is shared with other processes
+        expires = time.time() + self.timeout
+        await asyncio.to_thread(
+            self._run,
+            "INSERT INTO sessions (id, username, expires) VALUES (?, ?, ?)",
+            (session_id, username, expires),
+        )
+        return session_id
+
+    async def get(self, session_id):
+        row = await asyncio.to_thread(
+            self._read,
+            "SELECT username, expires FROM sessions WHERE id = ?",
+            (session_id,),
+        )
+        if row is None or row[1] <= time.time():
+            return None
+        return row[0]
+
+    async def delete(self, session_id):
+        def delete():
+            with self.lock:
+                row = self.conn.execute(
+                    "DELETE FROM sessions WHERE id = ? RETURNING username",
+                    (session_id,),
+                ).fetchone()
+            return row[0] if row else None
+
+        return await asyncio.to_thread(delete)
+
+    async def sweep(self):
+        def sweep():
+            with self.lock:
+                removed = self.conn.execute(
+                    "DELETE FROM sessions WHERE expires <= ?", (time.time(),)
+                ).rowcount
+                live = self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+                evicted = 0
+                if self.max_sessions and live > self.max_sessions:
+                    evicted = self.conn.execute(
+                        "DELETE FROM sessions WHERE id IN "
+                        "(SELECT id FROM sessions ORDER BY expires LIMIT ?)",
+                        (live - self.max_sessions,),
+                    ).rowcount
+            return removed, evicted
+
+        removed, evicted = await asyncio.to_thread(sweep)
+        self.expired += removed
+        self.evicted += evicted
+        return removed
+
+    def stats(self):
+        live = self._read("SELECT COUNT(*) FROM sessions")[0]
+        return {"live": live, "expired": self.expired, "evicted": self.evicted}
+
+
+class RedisError(Exception):
+    """Error reply from the Redis server."""
+
+
+class RedisSessionStore(SessionStore):
+    """Sessions in Redis, shared by replicas on any host.
+
+    Speaks just enough of the Redis protocol (RESP) for SET/GET/DEL over one
+    connection, so it also works against Redis-compatible servers and test
+    stand-ins. Keys carry a TTL, so Redis expires them and there is nothing to sweep.
+    """
+
+    def __init__(self, url, timeout, prefix="radius-auth:session:"):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self.prefix = prefix
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(args):
+        out = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    async def _read_reply(self):
+        line = await self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RedisError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            return (await self.reader.readexactly(length + 2))[:-2].decode()
+        if kind == b"*":
+            length = int(payload)
+            return (
+                None
+                if length < 0
+                else [await self._read_reply() for _ in range(length)]
+            )
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    async def _send(self, *args):
+        self.writer.write(self._encode(args))
+        await self.writer.drain()
+        return await self._read_reply()
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._send("AUTH", self.password)
+        if self.db:
+            await self._send("SELECT", self.db)
+
+    def _disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def command(self, *args):
+        async with self.lock:
+            # One retry on a fresh connection covers a server restart or idle timeout
+            for attempt in range(2):
+                try:
+                    if self.writer is None:
+                        await self._connect()
+                    return await self._send(*args)
+                except (OSError, asyncio.IncompleteReadError):
+                    self._disconnect()
+                    if attempt:
+                        raise
+
+    async def create(self, username):
+        session_id = secrets.token_urlsafe(32)
+        await self.command(
+            "SET", self.prefix + session_id, username, "EX", self.timeout
+        )
+        return session_id
+
+    async def get(self, session_id):
+        return await self.command("GET", self.prefix + session_id)
+
+    async def delete(self, session_id):
+        username = await self.command("GET", self.prefix + session_id)
+        await self.command("DEL", self.prefix + session_id)
+        return username
+
+    def stats(self):
+        return {"backend": f"redis://{self.host}:{self.port}/{self.db}"}
+
+
+class CachedSessionStore(SessionStore):
+    """Process-local cache of successful lookups in front of a shared store.
+
+    Repeat /auth checks within ``ttl`` seconds never leave the process. The
+    price is that a session ended through another worker or replica can still
+    pass here for up to ``ttl`` seconds.
+    """
+
+    def __init__(self, store, ttl, max_entries):
+        self.store = store
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache = {}  # session_id -> (username, cached until)
+        self.hits = 0
+        self.misses = 0
+
+    async def create(self, username):
+        return await self.store.create(username)
+
+    async def get(self, session_id):
+        now = time.monotonic()
+        entry = self.cache.get(session_id)
+        if entry is not None and entry[1] > now:
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        username = await self.store.get(session_id)
+        if username is None:
+            self.cache.pop(session_id, None)
+            return None
+        if session_id not in self.cache and len(self.cache) >= self.max_entries:
+            # Drop the oldest entry (dicts keep insertion order)
+            self.cache.pop(next(iter(self.cache)))
+        self.cache[session_id] = (username, now + self.ttl)
+        return username
+
+    async def delete(self, session_id):
+        self.cache.pop(session_id, None)
+        return await self.store.delete(session_id)
+
+    async def sweep(self):
+        now = time.monotonic()
+        self.cache = {sid: entry for sid, entry in self.cache.items() if entry[1] > now}
+        return await self.store.sweep()
+
+    def stats(self):
+        return {
+            **self.store.stats(),
+            "cache_size": len(self.cache),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+        }
+
+
+class SignedSessionStore(SessionStore):
+    """Stateless sessions: the session ID is a token signed with HMAC-SHA256.
+
+    A token is ``key_id.username.expires.signature`` with the username and
+    signature base64url-encoded, so any worker holding the keys can verify it
+    without shared state. Verified tokens are remembered in a small cache so
+    repeat checks skip the HMAC. Nothing is stored server-side, so logout only
+    clears the cookie; a copied token stays valid until it expires.
+    """
+
+    def __init__(self, keys, timeout, cache_size):
+        if not keys:
+            raise ValueError("SESSION_KEYS is required for SESSION_BACKEND=signed")
+        self.keys = keys  # key_id -> secret; the first one signs
+        self.signing_key_id = next(iter(keys))
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.verified = {}  # token -> (username, expires)
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    @staticmethod
+    def parse_keys(value):
+        keys = {}
+        for pair in value.split(","):
+            if not pair.strip():
+                continue
+            key_id, sep, secret = pair.strip().partition(":")
+            if not sep or not key_id or not secret or "." in key_id:
+                raise ValueError(f"Invalid SESSION_KEYS entry for key {key_id!r}")
+            keys[key_id] = secret.encode()
+        return keys
+
+    @staticmethod
+    def _b64(data):
+        return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+    def _sign(self, key_id, payload):
+        mac = hmac.new(self.keys[key_id], payload.encode(), hashlib.sha256)
+        return self._b64(mac.digest())
+
+    async def create(self, username):
+        expires = int(time.time()) + self.timeout
+        payload = f"{self.signing_key_id}.{self._b64(username.encode())}.{expires}"
+        return f"{payload}.{self._sign(self.signing_key_id, payload)}"
+
+    def verify(self, token):
+        """Username of a valid, unexpired token, or None."""
+        now = time.time()
+        entry = self.verified.get(token)
+        if entry is not None:
+            if entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            del self.verified[token]
+        self.misses += 1
+        try:
+            payload, _, signature = token.rpartition(".")
+            key_id, user, expires = payload.split(".")
+            # Compared as bytes: compare_digest rejects non-ASCII str with TypeError
+            if key_id not in self.keys or not hmac.compare_digest(
+                signature.encode(), self._sign(key_id, payload).encode()
+            ):
+                self.rejected += 1
+                return None
+            expires = int(expires)
+            username = base64.urlsafe_b64decode(user + "=" * (-len(user) % 4)).decode()
+        except ValueError:
+            self.rejected += 1
+            return None
+        if expires <= now:
+            return None
+        if len(self.verified) >= self.cache_size:
+            # Drop the oldest entry (dicts keep insertion order)
+            self.verified.pop(next(iter(self.verified)))
+        self.verified[token] = (username, expires)
+        return username
+
+    async def get(self, session_id):
+        return self.verify(session_id)
+
+    async def delete(self, session_id):
+        # Nothing to remove; the username is only reported for logging
+        return self.verify(session_id)
+
+    async def sweep(self):
+        now = time.time()
+        self.verified = {t: e for t, e in self.verified.items() if e[1] > now}
+        return 0
+
+    def stats(self):
+        return {
+            "signing_key": self.signing_key_id,
+            "keys": list(self.keys),
+            "cache_size": len(self.verified),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "rejected": self.rejected,
+        }
+
+
+def create_session_store():
+    if SESSION_BACKEND == "memory":
+        return MemorySessionStore(SESSION_TIMEOUT, SESSION_MAX)
+    if SESSION_BACKEND == "signed":
+        keys = SignedSessionStore.parse_keys(SESSION_KEYS)
+        return SignedSessionStore(keys, SESSION_TIMEOUT, SESSION_CACHE_SIZE)
+    if SESSION_BACKEND == "sqlite":
+        store = SQLiteSessionStore(SESSION_SQLITE_PATH, SESSION_TIMEOUT, SESSION_MAX)
+    elif SESSION_BACKEND == "redis":
+        store = RedisSessionStore(SESSION_REDIS_URL, SESSION_TIMEOUT)
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND: {SESSION_BACKEND}")
+    if SESSION_CACHE_TTL > 0:
+        return CachedSessionStore(store, SESSION_CACHE_TTL, SESSION_CACHE_SIZE)
+    return store
+
+
+session_store = create_session_store()
+
+
+class LoginThrottle:
+    """Sliding-window login attempt limits with exponential lockout, per key.
+
+    Keys are usernames or client IPs. Each key keeps only the attempt counts of
+    the current and previous fixed windows (weighted into a sliding estimate)
+    and its lockout state; idle keys are dropped by the sweep and when the
+    table is full, so a burst cycling through many usernames stays bounded.
+    """
+
+    def __init__(self, limit, window, lockout, max_lockout, max_keys):
+        self.limit = limit
+        self.window = window
+        self.lockout = lockout
+        self.max_lockout = max_lockout
+        self.max_keys = max_keys
+        # key -> [window start, previous count, current count, locked until, lockouts]
+        self.entries = {}
+        self.rejected = 0
+
+    def _idle(self, entry, now):
+        # Nothing counted in the last two windows and no lockout pending
+        return entry[3] <= now and now - entry[0] >= 2 * self.window
+
+    def locked_for(self, key, now):
+        """Seconds the key stays locked out (0 = not locked)."""
+        entry = self.entries.get(key)
+        if entry is None or entry[3] <= now:
+            return 0
+        self.rejected += 1
+        return entry[3] - now
+
+    def failure(self, key, now):
+        """Count a failed attempt; returns seconds the key is now locked out (0 = not locked)."""
+        if not self.limit:
+            return 0
+        entry = self.entries.get(key)
+        if entry is None or self._idle(entry, now):
+            if entry is None and len(self.entries) >= self.max_keys > 0:
+                self.prune(now)
+            entry = self.entries[key] = [now, 0, 0, 0, 0]
+        if entry[3] > now:
+            # Already locked by a failure that was in flight alongside this one
+            return entry[3] - now
+        elapsed = now - entry[0]
+        if elapsed >= self.window:
+            entry[1] = entry[2] if elapsed < 2 * self.window else 0
+            entry[2] = 0
+            entry[0] += self.window * (elapsed // self.window)
+            elapsed = now - entry[0]
+        entry[2] += 1
+        if entry[1] * (1 - elapsed / self.window) + entry[2] >= self.limit:
+            # Each lockout of the same key lasts twice as long as the one before
+            entry[4] += 1
+            entry[3] = now + min(self.lockout * 2 ** (entry[4] - 1), self.max_lockout)
+            entry[1] = entry[2] = 0
+            return entry[3] - now
+        return 0
+
+    def reset(self, key):
+        self.entries.pop(key, None)
+
+    def prune(self, now):
+        self.entries = {
+            key: entry
+            for key, entry in self.entries.items()
+            if not self._idle(entry, now)
+        }
+        # Still full of live keys: drop the oldest tenth rather than pruning every time
+        excess = len(self.entries) - int(self.max_keys * 0.9)
+        for key in list(self.entries)[: max(excess, 0)]:
+            del self.entries[key]
+
+    def stats(self):
+        now = time.time()
+        locked = sum(1 for entry in self.entries.values() if entry[3] > now)
+        return {"keys": len(self.entries), "locked": locked, "rejected": self.rejected}
+
+
+login_throttle_users = LoginThrottle(
+    LOGIN_USER_LIMIT,
+    LOGIN_WINDOW,
+    LOGIN_LOCKOUT,
+    LOGIN_MAX_LOCKOUT,
+    LOGIN_THROTTLE_MAX_KEYS,
+)
+login_throttle_ips = LoginThrottle(
+    LOGIN_IP_LIMIT,
+    LOGIN_WINDOW,
+    LOGIN_LOCKOUT,
+    LOGIN_MAX_LOCKOUT,
+    LOGIN_THROTTLE_MAX_KEYS,
+)
+if LOGIN_IP_LIMIT and not TRUSTED_PROXY_HEADERS:
+    logging.warning(
+        "LOGIN_IP_LIMIT is on but FORWARDED_ALLOW_IPS is not set: behind a reverse "
+        "proxy every client shares the proxy's address, so failed logins from one "
+        "client can lock out everyone"
+    )
+shared_ip_warned = False
+
+
+def warn_if_shared_client_ip(client_ip):
+    """Warn once when the per-IP login limit is keyed on a private address."""
+    global shared_ip_warned
+    if shared_ip_warned or not LOGIN_IP_LIMIT:
+        return
+    try:
+        address = ipaddress.ip_address(client_ip)
+    except ValueError:
+        return
+    if address.is_private or address.is_loopback:
+        shared_ip_warned = True
+        logging.warning(
+            f"Login from private address {client_ip} counted against LOGIN_IP_LIMIT; "
+            "if this is the reverse proxy rather than the user's machine, set "
+            "FORWARDED_ALLOW_IPS to it or LOGIN_IP_LIMIT=0"
+        )
+
+
+async def sweep_sessions():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            removed = await session_store.sweep()
+            now = time.time()
+            login_throttle_users.prune(now)
+            login_throttle_ips.prune(now)
+        except Exception:
+            # Keep sweeping; a shared backend may only be briefly unavailable
+            logging.exception("Session sweep failed")
+            continue
+        if removed:
+            logging.info(f"Expired {removed} sessions")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    sweeper = asyncio.create_task(sweep_sessions())
+    yield
+    sweeper.cancel()
+
+
 # Initialize FastAPI app
-app = FastAPI(title=f"{PROXY_NAME} RADIUS Auth Backend")
+app = FastAPI(title=f"{PROXY_NAME} RADIUS Auth Backend", lifespan=lifespan)
 
 # Initialize RADIUS client
-radius_dict = Dictionary("/app/dictionary")
+radius_dict = Dictionary(RADIUS_DICTIONARY)
 radius_client = Client(
     server=RADIUS_SERVER,
     secret=RADIUS_SECRET.encode(),
@@ -43,31 +713,23 @@ radius_client = Client(
     dict=radius_dict,
 )
 
-# In-memory session store (use Redis in production)
-sessions = {}
 
+def log_sampled(message):
+    """Log a per-request line for AUTH_LOG_SAMPLE_RATE of requests."""
+    if AUTH_LOG_SAMPLE_RATE >= 1 or random.random() < AUTH_LOG_SAMPLE_RATE:
+        logging.info(message)
 
-def validate_session(session_id):
-    """Validate session ID and check expiration."""
-    if not session_id or session_id not in sessions:
-        return None
 
-    session = sessions[session_id]
-    if datetime.now() > session["expires"]:
-        del sessions[session_id]
+async def validate_session(session_id):
+    """Validate session ID and check expiration."""
+    if not session_id:
         return None
-
-    return session["username"]
+    return await session_store.get(session_id)
 
 
-def create_session(username):
+async def create_session(username):
     """Create a new session for the user."""
-    session_id = secrets.token_urlsafe(32)
-    sessions[session_id] = {
-        "username": username,
-        "expires": datetime.now() + timedelta(seconds=SESSION_TIMEOUT),
-    }
-    return session_id
+    return await session_store.create(username)
 
 
 @app.get("/auth")
@@ -85,10 +747,10 @@ async def auth(request: Request):
     - More flexible and cleaner approach
     """
     session_id = request.cookies.get("session_id")
-    username = validate_session(session_id)
+    username = await validate_session(session_id)
 
     if username:
-        logging.info(f"Authenticated request for user: {username}")
+        log_sampled(f"Authenticated request for user: {username}")
         return Response(
             content="OK",
             status_code=200,
@@ -97,7 +759,7 @@ async def auth(request: Request):
 
     # nginx: Return 401, let nginx config handle redirect via @error401
     if PROXY_TYPE == "nginx":
-        logging.info("Unauthenticated request (nginx auth_request)")
+        log_sampled("Unauthenticated request (nginx auth_request)")
         return Response(content="Unauthorized", status_code=401)
 
     # Traefik/Caddy: Return 302 redirect directly
@@ -108,10 +770,22 @@ async def auth(request: Request):
     forwarded_proto = request.headers.get("X-Forwarded-Proto", "http")
 
     login_url = f"{forwarded_proto}://{forwarded_host}/login?next={original_uri}"
-    logging.info(f"Unauthenticated request, redirecting to {login_url}")
+    log_sampled(f"Unauthenticated request, redirecting to {login_url}")
     return RedirectResponse(url=login_url, status_code=302)
 
 
+@app.get("/stats")
+async def stats():
+    """Session counters, and keys tracked and locked by the login throttles."""
+    return {
+        "sessions": session_store.stats(),
+        "login_throttle": {
+            "users": login_throttle_users.stats(),
+            "ips": login_throttle_ips.stats(),
+        },
+    }
+
+
 @app.get("/login", response_class=HTMLResponse)
 async def login(request: Request, next: str = "/", error: str = ""):
     """Display login form."""
@@ -234,6 +908,28 @@ async def do_login(
             status_code=303,
         )
 
+    # Throttle before doing any RADIUS work. Only rejected passwords are counted, once
+    # RADIUS has answered, so a double submit or several tabs logging in at once cannot
+    # lock the user out, and hammering a locked username does not also lock out its IP.
+    client_ip = request.client.host if request.client else "unknown"
+    warn_if_shared_client_ip(client_ip)
+    user_key = username.strip().lower()
+    now = time.time()
+    retry_after = max(
+        login_throttle_ips.locked_for(client_ip, now),
+        login_throttle_users.locked_for(user_key, now),
+    )
+    if retry_after:
+        wait = int(retry_after) + 1
+        logging.warning(
+            f"Login throttled for user: {username} from {client_ip}; retry in {wait}s"
+        )
+        return RedirectResponse(
+            url=f"{base_url}/login?next={next}&error=Too many login attempts, try again in {wait} seconds",
+            status_code=303,
+            headers={"Retry-After": str(wait)},
+        )
+
     try:
         # Authenticate with RADIUS
         logging.info(f"Attempting RADIUS authentication for user: {username}")
@@ -248,7 +944,8 @@ async def do_login(
 
         if reply.code == 2:  # Access-Accept
             logging.info(f"Login successful for user: {username}")
-            session_id = create_session(username)
+            login_throttle_users.reset(user_key)
+            session_id = await create_session(username)
 
             response = RedirectResponse(
                 url=next if next.startswith("/") else f"{base_url}{next}",
@@ -264,6 +961,15 @@ async def do_login(
             return response
         else:
             logging.warning(f"Login failed for user: {username}")
+            now = time.time()
+            locked = max(
+                login_throttle_ips.failure(client_ip, now),
+                login_throttle_users.failure(user_key, now),
+            )
+            if locked:
+                logging.warning(
+                    f"Login locked for user: {username} from {client_ip} for {locked:.0f}s"
+                )
             return RedirectResponse(
                 url=f"{base_url}/login?next={next}&error=Invalid credentials",
                 status_code=303,
@@ -282,9 +988,8 @@ async def do_login(
 async def logout(request: Request):
     """Handle logout."""
     session_id = request.cookies.get("session_id")
-    if session_id and session_id in sessions:
-        username = sessions[session_id].get("username", "unknown")
-        del sessions[session_id]
+    username = await session_store.delete(session_id) if session_id else None
+    if username:
         logging.info(f"User logged out: {username}")
 
     # Get the host from request
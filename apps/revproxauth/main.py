@@ -1,21 +1,39 @@
+import asyncio
+import base64
+import copy
+import hashlib
+import hmac
+import ipaddress
 import json
 import logging
 import os
+import random
+import re
+import secrets
 import socket
 import sys
 import time
-from collections import defaultdict
-from datetime import datetime
-from threading import Lock
+import traceback
+from collections import defaultdict, deque
+from collections.abc import Awaitable, Callable, Collection, Iterator
+from contextlib import asynccontextmanager, contextmanager, suppress
+from datetime import datetime, timedelta
+from functools import cached_property
+from threading import Lock, RLock, Thread, get_ident
+from threading import enumerate as enumerate_threads
 from typing import Any, TypedDict, cast
+from urllib.parse import quote, unquote, urlsplit
 
 import httpx
 import jwt
-from fastapi import FastAPI, Form, HTTPException, Request, status
+from fastapi import FastAPI, Form, HTTPException, Request, WebSocket, status
 from fastapi.responses import (
     FileResponse,
     HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
     RedirectResponse,
+    Response,
     StreamingResponse,
 )
 from fastapi.staticfiles import StaticFiles
@@ -23,6 +41,8 @@ from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 from pyrad.client import Client
 from pyrad.dictionary import Dictionary
+from starlette.requests import HTTPConnection, cookie_parser
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 # Application branding
 APP_NAME = "RevProxAuth"
@@ -36,9 +56,26 @@ class MetricsDict(TypedDict):
     bytes_received: int
     first_access: str | None
     last_access: str | None
+    count_error_bound: int  # requests the pair may have had before it was tracked
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    monitor_task = asyncio.create_task(loop_monitor.run()) if LOOP_MONITOR_ENABLED else None
+    exporter_task = asyncio.create_task(span_exporter.run()) if span_exporter else None
+    yield
+    if monitor_task:
+        loop_monitor.stop()
+        monitor_task.cancel()
+    if exporter_task:
+        # Cancelling runs the exporter's final flush
+        exporter_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await exporter_task
 
 
 app = FastAPI(
+    lifespan=lifespan,
     # root_path="/revproxauth"
 )
 templates = Jinja2Templates(directory="templates")
@@ -63,10 +100,109 @@ RADIUS_NAS_IDENTIFIER = os.getenv("RADIUS_NAS_IDENTIFIER", "revproxauth")
 LOGIN_DOMAIN = os.getenv("LOGIN_DOMAIN")
 ADMIN_USERS = os.getenv("REVPROXAUTH_ADMIN_USERS", "").split(",") if os.getenv("REVPROXAUTH_ADMIN_USERS") else []
 
+# File locations (overridable for running outside the container, e.g. benchmarks)
+CONFIG_FILE = os.getenv("REVPROXAUTH_CONFIG_FILE", "/app/config/revproxauth.json")
+RADIUS_DICTIONARY = os.getenv("RADIUS_DICTIONARY", "/app/dictionary")
+
 # JWT / session config
 SESSION_SECRET = os.getenv("SESSION_SECRET", RADIUS_SECRET)
 AUTHZ_COOKIE_NAME = "authz"
 AUTHZ_TTL = int(os.getenv("AUTHZ_TTL", "3600"))
+# Sliding renewal: a token within AUTHZ_REFRESH_WINDOW seconds of expiry is re-issued
+# with recomputed permissions (no RADIUS round-trip) until AUTHZ_MAX_LIFETIME seconds
+# after login. Expiries are spread by up to AUTHZ_JITTER seconds so sessions started
+# together do not all lapse together.
+AUTHZ_REFRESH_WINDOW = int(os.getenv("AUTHZ_REFRESH_WINDOW", "900"))
+AUTHZ_MAX_LIFETIME = int(os.getenv("AUTHZ_MAX_LIFETIME", "43200"))
+AUTHZ_JITTER = int(os.getenv("AUTHZ_JITTER", "300"))
+# Revoked sessions (logout, "log out everywhere") are remembered until they could no
+# longer be renewed anyway, and saved here so a restart does not bring them back
+REVOCATION_FILE = os.getenv("REVOCATION_FILE", os.path.join(os.path.dirname(CONFIG_FILE), "revocations.json"))
+# Verified session tokens kept in memory so repeat requests skip the signature check
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "4096"))
+
+# nginx X-Accel-Redirect handoff: when set (e.g. "/_revproxauth_upstream"), authorized
+# requests are answered with an internal redirect to this nginx location, which fetches
+# the upstream itself, instead of streaming the response through Python. Only GET and
+# HEAD are handed off: nginx replays the redirect as a GET without the request body
+ACCEL_REDIRECT_LOCATION = os.getenv("ACCEL_REDIRECT_LOCATION", "")
+
+# Login throttling, checked before any RADIUS work: LOGIN_USER_LIMIT failed attempts
+# for one username or LOGIN_IP_LIMIT from one client IP within LOGIN_WINDOW seconds
+# lock that key out for LOGIN_LOCKOUT seconds, doubling on each repeat up to
+# LOGIN_MAX_LOCKOUT. Only rejected passwords count, so concurrent or repeated correct
+# logins never lock a user out, and a successful login clears its username. 0 disables a limit.
+# The per-IP limit is only on by default when uvicorn trusts proxy headers: behind a
+# reverse proxy or Docker's gateway every client otherwise shares one address, and one
+# attacker could lock everybody out.
+LOGIN_WINDOW = float(os.getenv("LOGIN_WINDOW", "300"))
+LOGIN_USER_LIMIT = int(os.getenv("LOGIN_USER_LIMIT", "5"))
+TRUSTED_PROXY_HEADERS = bool(os.getenv("FORWARDED_ALLOW_IPS") or os.getenv("REVPROXAUTH_SOCKET"))
+LOGIN_IP_LIMIT = int(os.getenv("LOGIN_IP_LIMIT", "20" if TRUSTED_PROXY_HEADERS else "0"))
+LOGIN_LOCKOUT = float(os.getenv("LOGIN_LOCKOUT", "60"))
+LOGIN_MAX_LOCKOUT = float(os.getenv("LOGIN_MAX_LOCKOUT", "3600"))
+LOGIN_THROTTLE_MAX_KEYS = int(os.getenv("LOGIN_THROTTLE_MAX_KEYS", "100000"))
+# Successful RADIUS logins remembered for this many seconds (0 = off), keyed by a
+# salted hash of the credentials, so a burst of identical logins costs one round-trip.
+# A password changed or account disabled on the RADIUS server keeps working that long.
+RADIUS_AUTH_CACHE_TTL = float(os.getenv("RADIUS_AUTH_CACHE_TTL", "0"))
+RADIUS_AUTH_CACHE_SIZE = int(os.getenv("RADIUS_AUTH_CACHE_SIZE", "1024"))
+
+# Per-mapping admission control defaults (overridable per mapping via
+# "max_concurrency", "max_queue" and "queue_timeout" keys). 0 = unlimited.
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "50"))
+UPSTREAM_MAX_QUEUE = int(os.getenv("UPSTREAM_MAX_QUEUE", "50"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "10"))
+UPSTREAM_RETRY_AFTER = int(os.getenv("UPSTREAM_RETRY_AFTER", "5"))
+
+# Upstream DNS cache: http_dest hostnames are resolved once per UPSTREAM_DNS_TTL
+# seconds, then served stale for up to UPSTREAM_DNS_STALE_TTL more seconds while a
+# background lookup refreshes them. Failed lookups are cached for
+# UPSTREAM_DNS_NEGATIVE_TTL seconds. UPSTREAM_DNS_TTL=0 resolves on every request.
+UPSTREAM_DNS_TTL = float(os.getenv("UPSTREAM_DNS_TTL", "30"))
+UPSTREAM_DNS_STALE_TTL = float(os.getenv("UPSTREAM_DNS_STALE_TTL", "300"))
+UPSTREAM_DNS_NEGATIVE_TTL = float(os.getenv("UPSTREAM_DNS_NEGATIVE_TTL", "5"))
+UPSTREAM_DNS_TIMEOUT = float(os.getenv("UPSTREAM_DNS_TIMEOUT", "5"))
+
+# Event-loop lag monitoring: sample interval (seconds) and the lag (ms) that
+# triggers an alert with the stack of whatever is blocking the loop
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR", "1") == "1"
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1"))
+LOOP_LAG_ALERT_MS = float(os.getenv("LOOP_LAG_ALERT_MS", "250"))
+
+# On-demand sampling profiler limits (admin endpoint /revproxauth/profile)
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "30"))
+PROFILE_MIN_INTERVAL = float(os.getenv("PROFILE_MIN_INTERVAL", "0.005"))
+PROFILE_MAX_TASKS = int(os.getenv("PROFILE_MAX_TASKS", "200"))
+
+# Request tracing: spans are exported to a JSONL file path or an OTLP/HTTP traces
+# endpoint (e.g. http://collector:4318/v1/traces). Empty disables tracing.
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "512"))
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "5"))
+TRACE_MAX_QUEUE = int(os.getenv("TRACE_MAX_QUEUE", "8192"))
+
+
+def parse_size(value: str) -> int:
+    """Parse a byte size like "512K", "10M" or "2G" (powers of 1024) into bytes."""
+    value = value.strip().upper().removesuffix("B")
+    multipliers = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value or 0)
+
+
+# Bandwidth shaping and byte quotas (0 = unlimited). Mappings may set
+# "bandwidth_limit" (shared by all users of the mapping), "user_bandwidth_limit",
+# "daily_quota" and "monthly_quota" (per user on that mapping).
+USER_BANDWIDTH_LIMIT = parse_size(os.getenv("USER_BANDWIDTH_LIMIT", "0"))
+USER_DAILY_QUOTA = parse_size(os.getenv("USER_DAILY_QUOTA", "0"))
+USER_MONTHLY_QUOTA = parse_size(os.getenv("USER_MONTHLY_QUOTA", "0"))
+
+# Most (mapping, user) pairs tracked individually on the metrics page; lighter
+# users are folded into a per-mapping "(other)" row. 0 = unlimited.
+METRICS_MAX_KEYS = int(os.getenv("METRICS_MAX_KEYS", "1000"))
 
 # Validate required environment variables
 missing_vars: list[str] = []
@@ -135,14 +271,8 @@ print(startup_banner, flush=True)
 assert RADIUS_SERVER is not None
 assert RADIUS_SECRET is not None
 
-# Initialize RADIUS client and dictionary
-radius_dict = Dictionary("/app/dictionary")
-client = Client(
-    server=RADIUS_SERVER,
-    secret=RADIUS_SECRET.encode(),
-    authport=RADIUS_PORT,
-    dict=radius_dict,
-)
+# Initialize RADIUS dictionary (clients are created per exchange, see radius_exchange)
+radius_dict = Dictionary(RADIUS_DICTIONARY)
 
 # Metrics storage: {(mapping_url, username): {requests, bytes_sent, bytes_received, first_access, last_access}}
 metrics_storage: defaultdict[tuple[str, str], MetricsDict] = defaultdict(
@@ -152,39 +282,710 @@ metrics_storage: defaultdict[tuple[str, str], MetricsDict] = defaultdict(
         bytes_received=0,
         first_access=None,
         last_access=None,
+        count_error_bound=0,
     )
 )
 metrics_lock = Lock()
 
-# Load config from /app/config/revproxauth.json
-
-
-def load_config() -> dict[str, Any]:
-    try:
-        with open("/app/config/revproxauth.json") as f:
-            config = json.load(f)
-            # Validate version
+# Heavy-hitter bookkeeping for the bounded metrics table (space-saving style):
+# evicted pairs are summed into metrics_other per mapping, and a pair admitted
+# later starts with "count_error_bound" = the heaviest weight evicted so far, the most
+# requests it could have had before it was tracked.
+OTHER_USER = "(other)"
+metrics_other: dict[str, MetricsDict] = {}
+metrics_floor = 0
+metrics_evicted = 0
+
+# Indexes over metrics_storage for the metrics query API, kept in step as pairs
+# are added and evicted, plus running totals across everything ever recorded
+metrics_by_mapping: defaultdict[str, set[str]] = defaultdict(set)
+metrics_by_user: defaultdict[str, set[str]] = defaultdict(set)
+metrics_totals = {"requests": 0, "bytes_sent": 0, "bytes_received": 0}
+
+# Byte quota usage: {(period, mapping_url or "*", username): bytes}, where period
+# is "d:YYYY-MM-DD" or "m:YYYY-MM". Only the current periods are kept.
+quota_usage: dict[tuple[str, str, str], int] = {}
+quota_periods: tuple[str, str] = ("", "")
+
+
+class ConfigConflictError(Exception):
+    """Raised when a write names a config generation that is no longer current."""
+
+    def __init__(self, expected: int, current: int):
+        super().__init__(f"Config is at generation {current}, not {expected}")
+        self.current = current
+
+
+class ConfigValidationError(Exception):
+    """Raised when a config change would leave the mappings invalid."""
+
+
+class ConfigLoadError(Exception):
+    """Raised on a write while the config file on disk has failed to load, so it is not overwritten."""
+
+
+def parse_match_url(match_url: str) -> tuple[str, str]:
+    """Split a match_url ("host.com", "host.com/path" or "/path") into host and path (without leading slash).
+
+    The host may be a wildcard ("*.apps.example.com") and the path a regex ("~api/v[0-9]+/").
+    """
+    if "/" in match_url:
+        host, path = match_url.split("/", 1)
+        return host, path
+    return match_url, ""
+
+
+# Path regexes are embedded in one combined pattern per host, where their own
+# named groups would clash and numbered backreferences would point elsewhere
+PATH_REGEX_UNSUPPORTED = re.compile(r"\\[1-9]|\(\?P[<=]")
+PATH_REGEX_SPECIAL = frozenset(".^$*+?{}[]\\|()")
+# What may follow a regex's literal prefix for it to match every path with that prefix
+PATH_REGEX_ANY_SUFFIX = ("", ".*", ".*$")
+
+
+def regex_literal_prefix(regex: str) -> str:
+    """The literal text every match of a path regex starts with ("" when it cannot be told)."""
+    # An alternation outside any group can replace the prefix altogether
+    depth, in_class, i = 0, False, 0
+    while i < len(regex):
+        char = regex[i]
+        if char == "\\":
+            i += 1
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char in "()":
+            depth += 1 if char == "(" else -1
+        elif char == "|" and depth == 0:
+            return ""
+        i += 1
+    end = 0
+    while end < len(regex) and regex[end] not in PATH_REGEX_SPECIAL:
+        end += 1
+    # A quantifier makes the last literal character optional or repeatable
+    if end < len(regex) and regex[end] in "*?{":
+        end = max(0, end - 1)
+    return regex[:end]
+
+
+def validate_match_url(match_url: str) -> str | None:
+    """Problem with a wildcard host or regex path in match_url, or None if it can be routed."""
+    host, path = parse_match_url(match_url)
+    if "*" in host and not (host.startswith("*.") and len(host) > 2 and "*" not in host[2:]):
+        return "wildcard hosts must look like *.example.com"
+    if path.startswith("~"):
+        if PATH_REGEX_UNSUPPORTED.search(path):
+            return "path regexes cannot use named groups or backreferences"
+        try:
+            re.compile(path[1:])
+            re.compile(f"(?:{path[1:]})")
+        except re.error as e:
+            return f"invalid path regex: {e}"
+    return None
+
+
+class Route:
+    """An enabled mapping prepared for matching, built once per config generation."""
+
+    def __init__(self, index: int, mapping: dict[str, Any]):
+        self.index = index
+        self.mapping = mapping
+        self.match_url: str = mapping["match_url"]
+        self.host, self.path = parse_match_url(self.match_url)
+        self.strip_path = "strip_path" in mapping.get("flags", [])
+        # "*.example.com" matches any subdomain of example.com (not example.com itself)
+        self.host_suffix = self.host[2:] if self.host.startswith("*.") else None
+        # "~regex" is matched against the request path after its leading slash
+        self.path_regex = self.path[1:] if self.path.startswith("~") else None
+        # Literal text every matching path starts with, and whether every path starting
+        # with it matches (always for a literal prefix; for "~api/.*" but not "~api/v[0-9]")
+        if self.path_regex is None:
+            self.prefix, self.matches_whole_prefix = self.path, True
+        else:
+            self.prefix = regex_literal_prefix(self.path_regex)
+            self.matches_whole_prefix = self.path_regex[len(self.prefix) :] in PATH_REGEX_ANY_SUFFIX
+
+    @cached_property
+    def precedence(self) -> tuple[int, int, int, int, int]:
+        """Sort key, most specific first: exact host, then the longest wildcard, then any host;
+        within a host, longer (literal) prefixes first, a literal prefix before a regex with the
+        same literal prefix; then list order."""
+        if self.host_suffix is not None:
+            host_rank, host_depth = 1, -self.host_suffix.count(".")
+        else:
+            host_rank, host_depth = (0 if self.host else 2), 0
+        return host_rank, host_depth, -len(self.prefix), 0 if self.path_regex is None else 1, self.index
+
+    @cached_property
+    def path_pattern(self) -> re.Pattern[str]:
+        """The path regex compiled on its own, for stripping the matched part."""
+        return re.compile(self.path_regex if self.path_regex is not None else re.escape(self.path))
+
+    def target_path(self, full_path: str) -> str:
+        """Upstream path for a request path, with the mapping's path stripped if configured."""
+        target_path = f"/{full_path}" if full_path else "/"
+        if self.strip_path and self.path_regex is not None:
+            match = self.path_pattern.match(target_path, 1)
+            if match:
+                target_path = "/" + target_path[match.end() :].lstrip("/")
+        elif self.strip_path and self.path:
+            prefix_to_strip = f"/{self.path}"
+            if target_path.startswith(prefix_to_strip):
+                target_path = target_path[len(prefix_to_strip) :] or "/"
+        return target_path
+
+    def overlaps(self, other: "Route") -> bool:
+        """True if this route is tried before ``other`` and could match some of its requests."""
+        return self.host == other.host and self.precedence < other.precedence and other.prefix.startswith(self.prefix)
+
+    def shadows(self, other: "Route") -> bool:
+        """True if every request ``other`` could match is matched by this route first."""
+        return self.overlaps(other) and self.matches_whole_prefix
+
+
+class PathMatcher:
+    """The routes of one host pattern, in precedence order.
+
+    Regex paths are compiled into one alternation that the regex engine tries in precedence
+    order. Each alternative ends in an empty named group that is only reached when it
+    matched (a group at the start would make every failed alternative save the group
+    state, which grows quadratically). Literal prefixes are looked up by hash, longest
+    first. The better ranked of the two candidates wins.
+    """
+
+    def __init__(self, routes: list[Route]):
+        ordered = sorted(routes, key=lambda route: route.precedence)
+        self.regex_routes = [route for route in ordered if route.path_regex is not None]
+        self.regex = (
+            re.compile("|".join(f"(?:{route.path_regex})(?P<r{i}>)" for i, route in enumerate(self.regex_routes)))
+            if self.regex_routes
+            else None
+        )
+        self.prefixes: dict[str, Route] = {}
+        for route in ordered:
+            if route.path_regex is None:
+                self.prefixes.setdefault(route.path, route)
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.prefixes}, reverse=True)
+
+    def match(self, request_path: str) -> Route | None:
+        regex_route = None
+        if self.regex:
+            found = self.regex.match(request_path, 1)
+            if found and found.lastgroup:
+                regex_route = self.regex_routes[int(found.lastgroup[1:])]
+        for length in self.prefix_lengths:
+            route = self.prefixes.get(request_path[1 : 1 + length])
+            if route:
+                return regex_route if regex_route and regex_route.precedence < route.precedence else route
+        return regex_route
+
+
+class RouteTable:
+    """Combined matcher over the enabled routes of one config generation.
+
+    Hosts are looked up by exact name, then by wildcard suffix from the longest to the
+    shortest, then among routes without a host. The cost depends on the number of labels
+    in the host, not on the number of mappings.
+    """
+
+    def __init__(self, routes: list[Route]):
+        exact: defaultdict[str, list[Route]] = defaultdict(list)
+        wildcard: defaultdict[str, list[Route]] = defaultdict(list)
+        any_host: list[Route] = []
+        for route in routes:
+            if route.host_suffix is not None:
+                wildcard[route.host_suffix].append(route)
+            elif route.host:
+                exact[route.host].append(route)
+            else:
+                any_host.append(route)
+        self.exact = {host: PathMatcher(group) for host, group in exact.items()}
+        self.wildcard = {suffix: PathMatcher(group) for suffix, group in wildcard.items()}
+        self.any_host = PathMatcher(any_host) if any_host else None
+
+    def matchers(self, host: str) -> Iterator[PathMatcher]:
+        """Path matchers that apply to host, most specific first."""
+        if host in self.exact:
+            yield self.exact[host]
+        if self.wildcard:
+            dot = host.find(".")
+            while dot != -1:
+                matcher = self.wildcard.get(host[dot + 1 :])
+                if matcher:
+                    yield matcher
+                dot = host.find(".", dot + 1)
+        if self.any_host:
+            yield self.any_host
+
+    def match(self, host: str, request_path: str) -> Route | None:
+        for matcher in self.matchers(host):
+            route = matcher.match(request_path)
+            if route:
+                return route
+        return None
+
+
+class MappingIndex:
+    """Lookup tables over one config generation for searching the mappings admin page."""
+
+    def __init__(self, mappings: list[dict[str, Any]], invalid: Collection[int] = ()):
+        self.by_flag: defaultdict[str, list[int]] = defaultdict(list)
+        self.by_user: defaultdict[str, list[int]] = defaultdict(list)
+        self.by_group: defaultdict[str, list[int]] = defaultdict(list)
+        self.text: list[str] = []
+        for i, mapping in enumerate(mappings):
+            if i in invalid:
+                # Skipped when serving; their fields may not even have the right types
+                self.text.append("")
+                continue
+            for flag in mapping.get("flags", []):
+                self.by_flag[flag].append(i)
+            for user in mapping.get("allowed_users", []):
+                self.by_user[user.strip().lower()].append(i)
+            for group in mapping.get("allowed_groups", []):
+                self.by_group[group.strip().lower()].append(i)
+            fields = (mapping.get("match_url", ""), mapping.get("http_dest", ""))
+            self.text.append(" ".join(fields).lower())
+
+    def search(self, q: str = "", flag: str = "", user: str = "", group: str = "") -> list[int]:
+        """Indexes of mappings matching every given filter, in config order."""
+        matches: set[int] | None = None
+        for postings, key in ((self.by_flag, flag), (self.by_user, user.lower()), (self.by_group, group.lower())):
+            if key:
+                found = set(postings.get(key, ()))
+                matches = found if matches is None else matches & found
+        candidates = sorted(matches) if matches is not None else range(len(self.text))
+        q = q.strip().lower()
+        return [i for i in candidates if q in self.text[i]] if q else list(candidates)
+
+
+class ConfigSnapshot:
+    """One generation of the config. Never modified once published, so readers need no lock."""
+
+    def __init__(self, generation: int, mappings: list[dict[str, Any]]):
+        self.generation = generation
+        self.mappings = mappings
+        # Invalid mappings (hand-edited into the file) are skipped, like disabled ones
+        self.problems = {i: p for i, m in enumerate(mappings) if (p := mapping_problem(m))}
+        self.routes = [
+            Route(i, m)
+            for i, m in enumerate(mappings)
+            if i not in self.problems and "disabled" not in m.get("flags", [])
+        ]
+
+    @cached_property
+    def index(self) -> MappingIndex:
+        return MappingIndex(self.mappings, self.problems)
+
+    @cached_property
+    def quota_scopes(self) -> frozenset[str]:
+        """Mapping URLs with a byte quota ("*" = the global user quotas).
+
+        Usage is only recorded for these, so quota bookkeeping does not grow with every user.
+        """
+        scopes = {"*"} if USER_DAILY_QUOTA or USER_MONTHLY_QUOTA else set[str]()
+        for m in (route.mapping for route in self.routes):
+            if parse_size(str(m.get("daily_quota", 0))) or parse_size(str(m.get("monthly_quota", 0))):
+                scopes.add(m["match_url"])
+        return frozenset(scopes)
+
+    @cached_property
+    def table(self) -> RouteTable:
+        return RouteTable(self.routes)
+
+    def match(self, host: str, request_path: str) -> Route | None:
+        """Most specific enabled route whose host and path match the request (see Route.precedence)."""
+        route = self.table.match(host, request_path)
+        if route:
+            logging.debug(f"Request {host}{request_path} matched mapping {route.index} ({route.match_url})")
+        return route
+
+
+def mapping_problem(mapping: dict[str, Any]) -> str | None:
+    """Why a mapping cannot be served (e.g. "http_dest must be a non-empty string"), or None if it is valid."""
+    for field in ("match_url", "http_dest"):
+        if not isinstance(mapping.get(field), str) or not mapping[field]:
+            return f"{field} must be a non-empty string"
+    problem = validate_match_url(mapping["match_url"])
+    if problem:
+        return f"match_url: {problem}"
+    for field in ("flags", "allowed_users", "allowed_groups"):
+        value = mapping.get(field, [])
+        if not isinstance(value, list) or not all(isinstance(v, str) for v in cast(list[Any], value)):
+            return f"{field} must be a list of strings"
+    for field in ("daily_quota", "monthly_quota"):
+        try:
+            parse_size(str(mapping.get(field, 0)))
+        except ValueError:
+            return f'{field} must be a size like "500M"'
+    return None
+
+
+def validate_mappings_shape(mappings: Any) -> None:
+    if not isinstance(mappings, list):
+        raise ConfigValidationError("mappings must be a list")
+    for i, mapping in enumerate(cast(list[Any], mappings)):
+        if not isinstance(mapping, dict):
+            raise ConfigValidationError(f"mappings[{i}] must be an object")
+
+
+def validate_mappings(mappings: Any, unchanged: list[dict[str, Any]] | None = None) -> None:
+    """Strict check for admin writes: raise ConfigValidationError for the first invalid mapping.
+
+    Mappings identical to one in `unchanged` (the config being edited) are not checked,
+    so an invalid entry written into the file by hand, which loading skips, does not
+    block unrelated edits.
+    """
+    validate_mappings_shape(mappings)
+    known = {json.dumps(m, sort_keys=True) for m in unchanged or ()}
+    for i, mapping in enumerate(cast(list[dict[str, Any]], mappings)):
+        problem = mapping_problem(mapping)
+        if problem and json.dumps(mapping, sort_keys=True) not in known:
+            raise ConfigValidationError(f"mappings[{i}].{problem}")
+
+
+class ConfigStore:
+    """Versioned, in-memory view of the config file.
+
+    Readers get the current ConfigSnapshot without touching the disk; the file is
+    only re-parsed when its mtime/size/inode change (e.g. after a hand edit).
+    Writers run in a transaction: they edit a private copy, which is validated,
+    written to a temporary file and renamed over the config, then published with
+    the next generation number. A transaction can require the generation it was
+    based on, so concurrent admins cannot silently overwrite each other.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = RLock()
+        self.current = ConfigSnapshot(0, [])
+        self.file_signature: tuple[int, int, int] | None = None
+        self.load_error: str | None = None  # why the file on disk failed to load, if it did
+
+    def _signature(self) -> tuple[int, int, int] | None:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def snapshot(self) -> ConfigSnapshot:
+        signature = self._signature()
+        if signature != self.file_signature:
+            with self.lock:
+                if signature != self.file_signature:
+                    self._reload(signature)
+        return self.current
+
+    def _reload(self, signature: tuple[int, int, int] | None) -> None:
+        try:
+            with open(self.path) as f:
+                config = json.load(f)
             if config.get("version") != "1.0":
                 logging.warning(f"Unknown config version: {config.get('version')}")
-            return config
-    except Exception as e:
-        logging.error(f"Error loading config: {str(e)}")
-        return {"version": "1.0", "mappings": []}
+            mappings = config.get("mappings", [])
+            validate_mappings_shape(mappings)
+        except Exception as e:
+            # Keep serving the last good config rather than dropping every route
+            logging.error(f"Error loading config: {str(e)}")
+            self.file_signature = signature
+            self.load_error = str(e)
+            return
+        # Changed outside this process: it is still a new generation
+        generation = max(int(config.get("generation", 0)), self.current.generation + 1)
+        self.current = ConfigSnapshot(generation, mappings)
+        self.file_signature = signature
+        self.load_error = None
+        for i, problem in self.current.problems.items():
+            logging.warning(f"Skipping mappings[{i}]: {problem}")
+        logging.info(
+            f"Loaded config generation {generation} ({len(mappings)} mappings, {len(self.current.problems)} skipped)"
+        )
 
+    @contextmanager
+    def transaction(self, expected_generation: int | None = None) -> Iterator[dict[str, Any]]:
+        """Yield a mutable copy of the config document ({"mappings": [...]}) and commit it on success."""
+        with self.lock:
+            base = self.snapshot()
+            if self.load_error is not None:
+                # base is an older or empty generation; writing it would lose the file's mappings
+                raise ConfigLoadError(f"The config file failed to load ({self.load_error}); fix it before editing")
+            if expected_generation is not None and expected_generation != base.generation:
+                raise ConfigConflictError(expected_generation, base.generation)
+            document: dict[str, Any] = {"mappings": copy.deepcopy(base.mappings)}
+            yield document
+            validate_mappings(document.get("mappings"), base.mappings)
+            self._write(ConfigSnapshot(base.generation + 1, document["mappings"]))
+
+    def _write(self, snapshot: ConfigSnapshot) -> None:
+        config = {"version": "1.0", "generation": snapshot.generation, "mappings": snapshot.mappings}
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(config, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.replace(tmp_path, self.path)
+            except OSError:
+                # The config file itself is bind-mounted and cannot be replaced; fall back to an in-place write
+                os.remove(tmp_path)
+                with open(self.path, "w") as f:
+                    json.dump(config, f, indent=2)
+        except OSError as e:
+            logging.error(f"Error saving mappings: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Failed to save mappings: {str(e)}") from None
+        self.current = snapshot
+        self.file_signature = self._signature()
+        logging.info(f"Saved config generation {snapshot.generation} ({len(snapshot.mappings)} mappings)")
+
+
+config_store = ConfigStore(CONFIG_FILE)
 
-def load_mappings():
-    config = load_config()
-    return config.get("mappings", [])
 
+def load_mappings() -> list[dict[str, Any]]:
+    """Mappings of the current config generation. Treat as read-only; change them through a transaction."""
+    return config_store.snapshot().mappings
 
-def save_mappings(mappings: list[dict[str, Any]]) -> None:
+
+@contextmanager
+def edit_config(expected_generation: int | None = None, conflict_status: int = 409) -> Iterator[dict[str, Any]]:
+    """Run a config transaction, turning conflicts and invalid results into HTTP errors."""
     try:
-        config: dict[str, Any] = {"version": "1.0", "mappings": mappings}
-        with open("/app/config/revproxauth.json", "w") as f:
-            json.dump(config, f, indent=2)
-    except Exception as e:
-        logging.error(f"Error saving mappings: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to save mappings: {str(e)}") from None
+        with config_store.transaction(expected_generation) as config:
+            yield config
+    except ConfigConflictError as e:
+        raise HTTPException(
+            status_code=conflict_status,
+            detail=f"{e}; reload and try again",
+            headers={"ETag": f'"{e.current}"'},
+        ) from None
+    except ConfigValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from None
+    except ConfigLoadError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from None
+
+
+def parse_if_match(request: Request) -> int | None:
+    """Generation named by an If-Match header ("5", W/"5" or 5); None when absent or "*"."""
+    value = request.headers.get("if-match", "").strip()
+    if not value or value == "*":
+        return None
+    try:
+        return int(value.removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="If-Match must be a config generation") from None
+
+
+def apply_json_patch(document: dict[str, Any], operations: Any) -> None:
+    """Apply RFC 6902 JSON Patch operations to ``document`` in place.
+
+    Raises ConfigValidationError for malformed operations, missing paths or a failed "test".
+    """
+
+    def parse(pointer: Any) -> list[str]:
+        if not isinstance(pointer, str) or (pointer and not pointer.startswith("/")):
+            raise ConfigValidationError(f"Invalid JSON pointer: {pointer!r}")
+        return [t.replace("~1", "/").replace("~0", "~") for t in pointer.split("/")[1:]]
+
+    def resolve(tokens: list[str]) -> tuple[Any, str]:
+        """Return the container holding the last token, and that token."""
+        if not tokens:
+            raise ConfigValidationError("Operations on the whole document are not supported")
+        target: Any = document
+        for token in tokens[:-1]:
+            target = child(target, token)
+        return target, tokens[-1]
+
+    def child(container: Any, token: str) -> Any:
+        try:
+            if isinstance(container, list):
+                return container[int(token)]
+            return container[token]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise ConfigValidationError(f"Path not found: /{token}") from None
+
+    def get(tokens: list[str]) -> Any:
+        container, token = resolve(tokens)
+        return child(container, token)
+
+    def remove(tokens: list[str]) -> Any:
+        container, token = resolve(tokens)
+        value = child(container, token)
+        if isinstance(container, list):
+            del container[int(token)]
+        else:
+            del container[token]
+        return value
+
+    def add(tokens: list[str], value: Any) -> None:
+        container, token = resolve(tokens)
+        if isinstance(container, list):
+            index = len(container) if token == "-" else int(token) if token.isdigit() else -1
+            if not 0 <= index <= len(container):
+                raise ConfigValidationError(f"Invalid array index: {token}")
+            container.insert(index, value)
+        elif isinstance(container, dict):
+            container[token] = value
+        else:
+            raise ConfigValidationError(f"Cannot add to a {type(container).__name__}")
+
+    if not isinstance(operations, list):
+        raise ConfigValidationError("A JSON Patch must be a list of operations")
+    for i, op in enumerate(cast(list[Any], operations)):
+        if not isinstance(op, dict) or "op" not in op or "path" not in op:
+            raise ConfigValidationError(f"Operation {i} needs 'op' and 'path'")
+        op = cast(dict[str, Any], op)
+        path = parse(op["path"])
+        if op["op"] in ("add", "replace", "test") and "value" not in op:
+            raise ConfigValidationError(f"Operation {i} ({op['op']}) needs 'value'")
+        if op["op"] == "add":
+            add(path, copy.deepcopy(op["value"]))
+        elif op["op"] == "remove":
+            remove(path)
+        elif op["op"] == "replace":
+            remove(path)
+            add(path, copy.deepcopy(op["value"]))
+        elif op["op"] == "move":
+            add(path, remove(parse(op.get("from"))))
+        elif op["op"] == "copy":
+            add(path, copy.deepcopy(get(parse(op.get("from")))))
+        elif op["op"] == "test":
+            if get(path) != op["value"]:
+                raise ConfigValidationError(f"Test failed at {op['path']}")
+        else:
+            raise ConfigValidationError(f"Unknown operation: {op['op']}")
+
+
+def find_mapping_conflicts(mappings: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Report duplicate match_url values and enabled mappings that can never match.
+
+    A mapping is shadowed when an enabled mapping tried before it matches every request
+    it could match (see Route.shadows). When an earlier path regex overlaps it but is too
+    complex to tell whether it catches everything, the mapping is reported as unverified.
+    """
+    conflicts: list[dict[str, Any]] = []
+    positions: defaultdict[str, list[int]] = defaultdict(list)
+    for i, mapping in enumerate(mappings):
+        positions[mapping.get("match_url", "")].append(i)
+    for match_url, indexes in positions.items():
+        if len(indexes) > 1:
+            conflicts.append({"type": "duplicate", "match_url": match_url, "indexes": indexes})
+
+    # Only routes with the same host can shadow each other; walk them in the order they are tried
+    unreachable: list[dict[str, Any]] = []
+    earlier_by_host: defaultdict[str, list[Route]] = defaultdict(list)
+    for route in sorted(ConfigSnapshot(0, mappings).routes, key=lambda r: r.precedence):
+        overlapping = [candidate for candidate in earlier_by_host[route.host] if candidate.overlaps(route)]
+        shadowed_by = next((c for c in overlapping if c.shadows(route)), None)
+        if overlapping:
+            candidate = shadowed_by or overlapping[0]
+            unreachable.append(
+                {
+                    "type": "shadowed" if shadowed_by else "unverified",
+                    "index": route.index,
+                    "match_url": route.match_url,
+                    "shadowed_by": {"index": candidate.index, "match_url": candidate.match_url},
+                }
+            )
+        earlier_by_host[route.host].append(route)
+    return conflicts + sorted(unreachable, key=lambda c: c["index"])
+
+
+def import_mappings(mappings: list[dict[str, Any]], incoming: Any, mode: str) -> dict[str, int]:
+    """Replace the mappings with ``incoming``, or merge them in by match_url (update in place, append new)."""
+    validate_mappings(incoming)
+    if mode == "replace":
+        summary = {"added": len(incoming), "updated": 0, "removed": len(mappings)}
+        mappings[:] = incoming
+        return summary
+    summary = {"added": 0, "updated": 0, "removed": 0}
+    positions = {m.get("match_url"): i for i, m in enumerate(mappings)}
+    for mapping in cast(list[dict[str, Any]], incoming):
+        if mapping["match_url"] in positions:
+            mappings[positions[mapping["match_url"]]] = mapping
+            summary["updated"] += 1
+        else:
+            positions[mapping["match_url"]] = len(mappings)
+            mappings.append(mapping)
+            summary["added"] += 1
+    return summary
+
+
+def apply_mapping_batch(mappings: list[dict[str, Any]], operations: Any) -> dict[str, int]:
+    """Apply batch operations addressed by match_url.
+
+    Operations: {"op": "add", "mapping": {...}, "position": n (optional)},
+    {"op": "update", "match_url": ..., "set": {...}} (merged into the mapping) and
+    {"op": "delete", "match_url": ...}.
+    """
+    if not isinstance(operations, list):
+        raise ConfigValidationError("operations must be a list")
+    summary = {"added": 0, "updated": 0, "removed": 0}
+
+    def find(match_url: Any) -> int:
+        for i, mapping in enumerate(mappings):
+            if mapping.get("match_url") == match_url:
+                return i
+        raise ConfigValidationError(f"No mapping with match_url {match_url!r}")
+
+    for i, op in enumerate(cast(list[Any], operations)):
+        if not isinstance(op, dict):
+            raise ConfigValidationError(f"Operation {i} must be an object")
+        op = cast(dict[str, Any], op)
+        if op.get("op") == "add" and isinstance(op.get("mapping"), dict):
+            position = op.get("position", len(mappings))
+            if not isinstance(position, int) or not 0 <= position <= len(mappings):
+                raise ConfigValidationError(f"Operation {i} has an invalid position")
+            mappings.insert(position, op["mapping"])
+            summary["added"] += 1
+        elif op.get("op") == "update" and isinstance(op.get("set"), dict):
+            index = find(op.get("match_url"))
+            mappings[index] = {**mappings[index], **op["set"]}
+            summary["updated"] += 1
+        elif op.get("op") == "delete":
+            mappings.pop(find(op.get("match_url")))
+            summary["removed"] += 1
+        else:
+            raise ConfigValidationError(f"Operation {i} is not a valid add, update or delete")
+    return summary
+
+
+def run_bulk_change(
+    request: Request, change: Callable[[list[dict[str, Any]]], dict[str, int]], dry_run: bool
+) -> dict[str, Any]:
+    """Apply a bulk mapping change as one transaction, or only report what it would do.
+
+    Duplicate match_url values fail the change; shadowed mappings are reported but allowed.
+    """
+    expected_generation = parse_if_match(request)
+    if dry_run:
+        snapshot = config_store.snapshot()
+        if expected_generation is not None and expected_generation != snapshot.generation:
+            raise HTTPException(status_code=412, detail=f"Config is at generation {snapshot.generation}")
+        mappings = copy.deepcopy(snapshot.mappings)
+        try:
+            summary = change(mappings)
+            validate_mappings(mappings, snapshot.mappings)
+        except ConfigValidationError as e:
+            raise HTTPException(status_code=422, detail=str(e)) from None
+        return {
+            "dry_run": True,
+            "generation": snapshot.generation,
+            **summary,
+            "conflicts": find_mapping_conflicts(mappings),
+        }
+
+    with edit_config(expected_generation, conflict_status=412) as config:
+        summary = change(config["mappings"])
+        conflicts = find_mapping_conflicts(config["mappings"])
+        duplicates = [c for c in conflicts if c["type"] == "duplicate"]
+        if duplicates:
+            raise HTTPException(
+                status_code=422, detail={"message": "Duplicate match_url values", "conflicts": duplicates}
+            )
+    return {"dry_run": False, "generation": config_store.snapshot().generation, **summary, "conflicts": conflicts}
 
 
 def update_metrics(
@@ -197,15 +998,217 @@ def update_metrics(
     """Update metrics incrementally. Can update bytes and/or increment request count."""
     with metrics_lock:
         key = (mapping_url, username)
+        if key not in metrics_storage and METRICS_MAX_KEYS and len(metrics_storage) >= METRICS_MAX_KEYS:
+            evict_metrics()
         metrics = metrics_storage[key]
+        if metrics["first_access"] is None:
+            metrics["count_error_bound"] = metrics_floor
+            metrics_by_mapping[mapping_url].add(username)
+            metrics_by_user[username].add(mapping_url)
         if increment_request:
             metrics["requests"] += 1
+            metrics_totals["requests"] += 1
         metrics["bytes_sent"] += bytes_sent
         metrics["bytes_received"] += bytes_received
+        metrics_totals["bytes_sent"] += bytes_sent
+        metrics_totals["bytes_received"] += bytes_received
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         if metrics["first_access"] is None:
             metrics["first_access"] = now
         metrics["last_access"] = now
+        transferred = bytes_sent + bytes_received
+        quota_scopes = config_store.current.quota_scopes
+        if transferred and quota_scopes:
+            for period in current_quota_periods():
+                for scope in ("*", mapping_url):
+                    if scope not in quota_scopes:
+                        continue
+                    quota_key = (period, scope, username)
+                    quota_usage[quota_key] = quota_usage.get(quota_key, 0) + transferred
+
+
+def evict_metrics() -> None:
+    """Fold the lightest tenth of the tracked (mapping, user) pairs into their mapping's "(other)" row.
+
+    Pairs are ranked by requests plus their count error bound. Evicting a batch at a
+    time keeps the cost of sorting amortized to O(log n) per new pair. Must be
+    called with metrics_lock held.
+    """
+    global metrics_floor, metrics_evicted
+    ranked = sorted(
+        metrics_storage.items(),
+        key=lambda item: (item[1]["requests"] + item[1]["count_error_bound"], item[1]["last_access"] or ""),
+    )
+    for (mapping_url, user), metrics in ranked[: max(1, len(ranked) // 10)]:
+        other = metrics_other.setdefault(
+            mapping_url,
+            MetricsDict(
+                requests=0, bytes_sent=0, bytes_received=0, first_access=None, last_access=None, count_error_bound=0
+            ),
+        )
+        other["requests"] += metrics["requests"]
+        other["bytes_sent"] += metrics["bytes_sent"]
+        other["bytes_received"] += metrics["bytes_received"]
+        first, last = metrics["first_access"] or "", metrics["last_access"] or ""
+        other["first_access"] = min(other["first_access"] or first, first)
+        other["last_access"] = max(other["last_access"] or last, last)
+        metrics_floor = max(metrics_floor, metrics["requests"] + metrics["count_error_bound"])
+        metrics_evicted += 1
+        del metrics_storage[(mapping_url, user)]
+        for index, outer, inner in ((metrics_by_mapping, mapping_url, user), (metrics_by_user, user, mapping_url)):
+            index[outer].discard(inner)
+            if not index[outer]:
+                del index[outer]
+
+
+METRICS_SORT_FIELDS = ("requests", "bytes_sent", "bytes_received", "first_access", "last_access", "mapping", "user")
+
+
+def metrics_time_bound(value: str, end_of_day: bool = False) -> str:
+    """Normalize an ISO date or datetime to the "YYYY-MM-DD HH:MM:SS" local time the metrics store.
+
+    A bare date stands for its whole day, so as an upper bound it means the end of that day.
+    Raises ValueError when the value does not parse.
+    """
+    moment = datetime.fromisoformat(value.strip())
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    if end_of_day and len(value.strip()) == 10:
+        moment = moment.replace(hour=23, minute=59, second=59)
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def query_metrics(
+    mapping: str = "",
+    user: str = "",
+    since: str = "",
+    until: str = "",
+    group_by: str = "",
+    sort: str = "requests",
+    order: str = "desc",
+    limit: int = 50,
+    cursor: str = "",
+) -> dict[str, Any]:
+    """Filter, group, sort and page the metrics table.
+
+    Exact mapping/user filters are answered from the secondary indexes, and only
+    the matching rows are copied while metrics_lock is held; the time filter,
+    grouping and sorting run on that copy. The cursor encodes the sort position
+    of the last row returned, so pages stay stable as new rows are added.
+    """
+    with metrics_lock:
+        if mapping and user:
+            keys = [(mapping, user)] if user in metrics_by_mapping.get(mapping, ()) else []
+        elif mapping:
+            keys = [(mapping, u) for u in metrics_by_mapping.get(mapping, ())]
+        elif user:
+            keys = [(m, user) for m in metrics_by_user.get(user, ())]
+        else:
+            keys = list(metrics_storage)
+        rows = [{"mapping": m, "user": u, **metrics_storage[(m, u)]} for m, u in keys]
+        if user in ("", OTHER_USER):
+            rows += [
+                {"mapping": m, "user": OTHER_USER, **metrics}
+                for m, metrics in metrics_other.items()
+                if not mapping or m == mapping
+            ]
+
+    # Keep rows whose activity overlaps [since, until] (both inclusive, as normalized by
+    # metrics_time_bound); timestamps in that format sort lexically
+    if since:
+        rows = [r for r in rows if (r["last_access"] or "") >= since]
+    if until:
+        rows = [r for r in rows if (r["first_access"] or "") <= until]
+
+    if group_by:
+        groups: dict[str, dict[str, Any]] = {}
+        for r in rows:
+            group = groups.setdefault(
+                r[group_by],
+                {
+                    group_by: r[group_by],
+                    "pairs": 0,
+                    "requests": 0,
+                    "bytes_sent": 0,
+                    "bytes_received": 0,
+                    "count_error_bound": 0,
+                },
+            )
+            group["pairs"] += 1
+            for field in ("requests", "bytes_sent", "bytes_received", "count_error_bound"):
+                group[field] += r[field]
+            for field, pick in (("first_access", min), ("last_access", max)):
+                values = [v for v in (group.get(field), r[field]) if v]
+                group[field] = pick(values) if values else None
+        rows = list(groups.values())
+
+    def row_id(r: dict[str, Any]) -> str:
+        return r[group_by] if group_by else f"{r['mapping']}\n{r['user']}"
+
+    def position(r: dict[str, Any]) -> tuple[Any, str]:
+        value = r.get(sort)
+        return (value if value is not None else "", row_id(r))
+
+    descending = order == "desc"
+    rows.sort(key=position, reverse=descending)
+    total_rows = len(rows)
+    if cursor:
+        after = tuple(json.loads(base64.urlsafe_b64decode(cursor.encode())))
+        rows = [r for r in rows if (position(r) < after if descending else position(r) > after)]
+
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = base64.urlsafe_b64encode(json.dumps(position(page[-1])).encode()).decode()
+    return {"rows": page, "total_rows": total_rows, "next_cursor": next_cursor}
+
+
+def quota_periods_at(moment: datetime) -> tuple[str, str]:
+    """Return the (day, month) quota periods that `moment` falls in."""
+    return (f"d:{moment:%Y-%m-%d}", f"m:{moment:%Y-%m}")
+
+
+def current_quota_periods() -> tuple[str, str]:
+    """Return the current (day, month) quota periods, dropping usage from older ones.
+
+    Must be called with metrics_lock held.
+    """
+    global quota_periods
+    periods = quota_periods_at(datetime.now())
+    if periods != quota_periods:
+        for key in [k for k in quota_usage if k[0] not in periods]:
+            del quota_usage[key]
+        quota_periods = periods
+    return periods
+
+
+def quota_retry_after(mapping: dict[str, Any], username: str, now: datetime | None = None) -> int | None:
+    """Return seconds until the exhausted quota resets, or None if the user is within quota.
+
+    Only reads the usage counters: usage from an earlier period is simply not
+    looked up, and update_metrics drops it when it next records a transfer.
+    """
+    now = now or datetime.now()
+    match_url = mapping.get("match_url", "")
+    limits = [
+        (0, "*", USER_DAILY_QUOTA),
+        (1, "*", USER_MONTHLY_QUOTA),
+        (0, match_url, parse_size(str(mapping.get("daily_quota", 0)))),
+        (1, match_url, parse_size(str(mapping.get("monthly_quota", 0)))),
+    ]
+    periods = quota_periods_at(now)
+    exhausted = [
+        which
+        for which, scope, limit in limits
+        if limit and quota_usage.get((periods[which], scope, username), 0) >= limit
+    ]
+    if not exhausted:
+        return None
+    reset = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    if 1 in exhausted:
+        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        reset = (month_start + timedelta(days=32)).replace(day=1)
+    return int((reset - now).total_seconds()) + 1
 
 
 def format_bytes(byte_count: int) -> str:
@@ -218,6 +1221,535 @@ def format_bytes(byte_count: int) -> str:
     return f"{count:.1f} PB"
 
 
+class AdmissionRejectedError(Exception):
+    """Raised when a mapping's wait queue is full or the queue wait timed out."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """Bounded concurrency with a FIFO wait queue for a single upstream mapping.
+
+    Slots are handed directly from a releasing request to the oldest waiter so
+    a burst of new arrivals cannot overtake requests that are already queued.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters: deque[asyncio.Future[None]] = deque()
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.peak_queue = 0
+        self.queued_total = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def configure(self, max_concurrency: int, max_queue: int, queue_timeout: float) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # A raised limit may free slots for requests that are already waiting
+        self._drain()
+
+    def _has_capacity(self) -> bool:
+        return self.max_concurrency <= 0 or self.active < self.max_concurrency
+
+    async def acquire(self) -> None:
+        if self._has_capacity() and not self.waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+
+        if self.max_queue > 0 and len(self.waiters) >= self.max_queue:
+            self.shed += 1
+            raise AdmissionRejectedError("queue full")
+
+        waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.peak_queue = max(self.peak_queue, len(self.waiters))
+        self.queued_total += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout or None)
+        except (TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up - pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.timed_out += 1
+            raise AdmissionRejectedError("queue timeout") from None
+        finally:
+            waited = time.monotonic() - started
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        self.admitted += 1
+
+    def release(self) -> None:
+        self.active = max(0, self.active - 1)
+        self._drain()
+
+    def _drain(self) -> None:
+        """Hand free slots to the oldest waiters, skipping ones that gave up."""
+        while self.waiters and self._has_capacity():
+            waiter = self.waiters.popleft()
+            if waiter.done():
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "queued": len(self.waiters),
+            "max_queue": self.max_queue,
+            "peak_queue": self.peak_queue,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": (self.total_wait / self.queued_total * 1000) if self.queued_total else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+class TokenBucket:
+    """Byte token bucket used to pace response streams to a target rate."""
+
+    def __init__(self, rate: int, burst: int | None = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else rate
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    async def consume(self, amount: int) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Go into debt rather than splitting chunks; concurrent streams sharing the
+        # bucket then wait in turn for the debt to be repaid.
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+# Token buckets keyed by ("mapping", match_url) or ("user", match_url or "*", username)
+bandwidth_buckets: dict[tuple[str, ...], TokenBucket] = {}
+
+
+def get_bandwidth_buckets(mapping: dict[str, Any], username: str) -> list[TokenBucket]:
+    """Return the token buckets a response stream for this mapping and user must pass."""
+    match_url = mapping.get("match_url", "")
+    wanted: list[tuple[tuple[str, ...], int]] = []
+    mapping_limit = parse_size(str(mapping.get("bandwidth_limit", 0)))
+    if mapping_limit:
+        wanted.append((("mapping", match_url), mapping_limit))
+    mapping_user_limit = parse_size(str(mapping.get("user_bandwidth_limit", 0)))
+    if mapping_user_limit:
+        wanted.append((("user", match_url, username), mapping_user_limit))
+    if USER_BANDWIDTH_LIMIT:
+        wanted.append((("user", "*", username), USER_BANDWIDTH_LIMIT))
+
+    if len(bandwidth_buckets) > 4096:
+        # Forget buckets that have been idle long enough to have fully refilled
+        cutoff = time.monotonic() - 60
+        for key in [k for k, b in bandwidth_buckets.items() if b.updated < cutoff]:
+            del bandwidth_buckets[key]
+
+    buckets: list[TokenBucket] = []
+    for key, rate in wanted:
+        bucket = bandwidth_buckets.get(key)
+        if bucket is None or bucket.rate != rate:
+            bucket = TokenBucket(rate)
+            bandwidth_buckets[key] = bucket
+        buckets.append(bucket)
+    return buckets
+
+
+class LoopMonitor:
+    """Continuously measures event-loop scheduling lag and catches blocking calls.
+
+    A task on the loop sleeps for a fixed interval and records how late it wakes up.
+    A watchdog thread notices when that heartbeat stops and captures the stack of
+    the loop thread while it is still blocked, so the offending handler is visible.
+    """
+
+    def __init__(self, interval: float, alert_ms: float, window: int = 600):
+        self.interval = interval
+        self.alert_ms = alert_ms
+        self.lag_samples: deque[float] = deque(maxlen=window)
+        self.slow_events: deque[dict[str, Any]] = deque(maxlen=20)
+        self.slow_event_count = 0
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = 0
+        self.stall_captured = False
+        self.running = False
+
+    async def run(self) -> None:
+        self.loop_thread_id = get_ident()
+        self.heartbeat = time.monotonic()
+        self.running = True
+        Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+        while self.running:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag_ms = max(0.0, now - started - self.interval) * 1000
+            self.heartbeat = now
+            self.lag_samples.append(lag_ms)
+            if lag_ms >= self.alert_ms:
+                if self.stall_captured and self.slow_events:
+                    # The watchdog recorded this stall while it was happening; fill in its full length
+                    self.slow_events[-1]["lag_ms"] = lag_ms
+                logging.warning(f"Event loop lag {lag_ms:.0f} ms exceeded {self.alert_ms:.0f} ms threshold")
+            self.stall_captured = False
+
+    def stop(self) -> None:
+        self.running = False
+
+    def _watchdog(self) -> None:
+        while self.running:
+            time.sleep(self.interval)
+            stalled_ms = (time.monotonic() - self.heartbeat - self.interval) * 1000
+            if stalled_ms < self.alert_ms or self.stall_captured:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame, limit=15)) if frame else "(no stack available)"
+            self.stall_captured = True
+            self.slow_event_count += 1
+            self.slow_events.append(
+                {"at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "lag_ms": stalled_ms, "stack": stack}
+            )
+            logging.warning(f"Event loop blocked for {stalled_ms:.0f} ms, current stack:\n{stack}")
+
+    def stats(self) -> dict[str, Any]:
+        samples = sorted(self.lag_samples)
+
+        def pct(p: float) -> float:
+            return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] if samples else 0.0
+
+        return {
+            "p50_ms": pct(50),
+            "p95_ms": pct(95),
+            "p99_ms": pct(99),
+            "max_ms": samples[-1] if samples else 0.0,
+            "samples": len(samples),
+            "slow_events": self.slow_event_count,
+            "alert_ms": self.alert_ms,
+        }
+
+
+loop_monitor = LoopMonitor(LOOP_MONITOR_INTERVAL, LOOP_LAG_ALERT_MS)
+
+
+class SamplingProfiler:
+    """Wall-clock sampling profiler that runs in a background thread for a fixed duration.
+
+    Each tick records the running stack of every thread and, optionally, the await
+    chain of every suspended asyncio task, so time spent waiting on upstreams or
+    RADIUS shows up next to CPU time. Output is in the collapsed-stack format read
+    by flamegraph.pl and speedscope ("frame;frame;frame count" per line).
+    """
+
+    max_stacks = 20000
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float, include_tasks: bool):
+        self.loop = loop
+        self.interval = interval
+        self.include_tasks = include_tasks
+        self.counts: dict[str, int] = {}
+        self.samples = 0
+        self.dropped = 0
+
+    @staticmethod
+    def _label(code: Any) -> str:
+        # Label by definition site rather than current line so a function aggregates into one frame
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+    def _record(self, frames: list[str]) -> None:
+        stack = ";".join(frames)
+        if stack not in self.counts and len(self.counts) >= self.max_stacks:
+            self.dropped += 1
+            return
+        self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def _sample_threads(self, own_ident: int) -> None:
+        names = {t.ident: t.name for t in enumerate_threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            frames: list[str] = []
+            current = frame
+            while current is not None and len(frames) < 64:
+                frames.append(self._label(current.f_code))
+                current = current.f_back
+            frames.append(f"thread:{names.get(ident, ident)}")
+            self._record(frames[::-1])
+
+    def _sample_tasks(self) -> None:
+        try:
+            tasks = list(asyncio.all_tasks(self.loop))
+        except RuntimeError:
+            # The task set changed while we copied it; skip this tick
+            return
+        for task in tasks[:PROFILE_MAX_TASKS]:
+            frames = ["await"]
+            coro: Any = task.get_coro()
+            while coro is not None and len(frames) < 64:
+                frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+                if frame is None:
+                    break
+                frames.append(self._label(frame.f_code))
+                coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+            if len(frames) > 1:
+                self._record(frames)
+
+    def run(self, seconds: float) -> None:
+        own_ident = get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self._sample_threads(own_ident)
+            if self.include_tasks:
+                self._sample_tasks()
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self) -> str:
+        lines = [f"{stack} {count}" for stack, count in sorted(self.counts.items())]
+        if self.dropped:
+            lines.append(f"[truncated] {self.dropped}")
+        return "\n".join(lines) + "\n"
+
+
+# Only one profile may run at a time so profiling cannot pile up on a struggling process
+profile_lock = asyncio.Lock()
+
+
+# OTLP span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+# W3C traceparent: version-trace_id-parent_id-flags in lowercase hex. Later versions
+# may append fields; version 00 may not, and version ff is invalid.
+TRACEPARENT_PATTERN = re.compile(r"(?!ff)([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}(-.*)?")
+
+
+class SpanExporter:
+    """Buffers finished spans and writes them out in batches from a background task.
+
+    The buffer is bounded; when the target cannot keep up, new spans are dropped
+    and counted rather than holding memory or slowing down requests.
+    """
+
+    def __init__(self, target: str, batch_size: int, flush_interval: float, max_queue: int):
+        self.target = target
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.queue: deque[dict[str, Any]] = deque()
+        self.wakeup = asyncio.Event()
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def submit(self, spans: list[dict[str, Any]]) -> None:
+        if len(self.queue) + len(spans) > self.max_queue:
+            self.dropped += len(spans)
+            return
+        self.queue.extend(spans)
+        if len(self.queue) >= self.batch_size:
+            self.wakeup.set()
+
+    async def run(self) -> None:
+        async with httpx.AsyncClient(timeout=10.0) as http:
+            try:
+                while True:
+                    with suppress(TimeoutError):
+                        await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+                    self.wakeup.clear()
+                    await self.flush(http)
+            finally:
+                await self.flush(http)
+
+    async def flush(self, http: httpx.AsyncClient) -> None:
+        while self.queue:
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            try:
+                if self.target.startswith(("http://", "https://")):
+                    resp = await http.post(self.target, json=self._otlp(batch))
+                    resp.raise_for_status()
+                else:
+                    await asyncio.to_thread(self._append_jsonl, batch)
+                self.exported += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                logging.warning(f"Failed to export {len(batch)} spans to {self.target}: {type(e).__name__}: {e}")
+                return
+
+    def _append_jsonl(self, batch: list[dict[str, Any]]) -> None:
+        with open(self.target, "a") as f:
+            f.writelines(json.dumps(span) + "\n" for span in batch)
+
+    @staticmethod
+    def _otlp(batch: list[dict[str, Any]]) -> dict[str, Any]:
+        """Encode spans as an OTLP/HTTP JSON ExportTraceServiceRequest."""
+
+        def value(v: Any) -> dict[str, Any]:
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+
+        spans = [
+            {
+                "traceId": span["trace_id"],
+                "spanId": span["span_id"],
+                "parentSpanId": span["parent_span_id"],
+                "name": span["name"],
+                "kind": span["kind"],
+                "startTimeUnixNano": str(span["start_unix_nano"]),
+                "endTimeUnixNano": str(span["end_unix_nano"]),
+                "attributes": [{"key": k, "value": value(v)} for k, v in span["attributes"].items()],
+                "status": {"code": 2 if span["attributes"].get("error") else 0},
+            }
+            for span in batch
+        ]
+        resource = {"attributes": [{"key": "service.name", "value": {"stringValue": "revproxauth"}}]}
+        return {
+            "resourceSpans": [
+                {"resource": resource, "scopeSpans": [{"scope": {"name": "revproxauth"}, "spans": spans}]}
+            ]
+        }
+
+    def stats(self) -> dict[str, Any]:
+        return {"queued": len(self.queue), "exported": self.exported, "dropped": self.dropped, "failed": self.failed}
+
+
+span_exporter = (
+    SpanExporter(TRACE_EXPORT, TRACE_BATCH_SIZE, TRACE_FLUSH_INTERVAL, TRACE_MAX_QUEUE) if TRACE_EXPORT else None
+)
+
+
+class RequestTrace:
+    """Phase spans for one proxied request, linked to the caller's W3C trace context.
+
+    The sampling decision is made once, up front, from the trace ID (so every
+    service sampling the same ratio keeps the same traces). Unsampled requests
+    only carry the IDs needed to propagate ``traceparent`` and record nothing.
+    """
+
+    def __init__(self, traceparent: str | None):
+        parent_span_id = ""
+        match = TRACEPARENT_PATTERN.fullmatch(traceparent.strip()) if traceparent else None
+        if match and not (match[1] == "00" and match[4] is not None) and match[2] != "0" * 32 and match[3] != "0" * 16:
+            self.trace_id, parent_span_id = match[2], match[3]
+        else:
+            # Invalid or missing: start a new trace rather than continue a broken one
+            self.trace_id = os.urandom(16).hex()
+        self.sampled = span_exporter is not None and int(self.trace_id[16:], 16) < TRACE_SAMPLE_RATE * 2**64
+        self.spans: list[dict[str, Any]] = []
+        self.finished = False
+        self.root: dict[str, Any] = {}
+        self.root = self.start("proxy", kind=SPAN_KIND_SERVER, parent_span_id=parent_span_id)
+
+    def start(
+        self,
+        name: str,
+        parent: dict[str, Any] | None = None,
+        kind: int = SPAN_KIND_INTERNAL,
+        parent_span_id: str = "",
+    ) -> dict[str, Any]:
+        parent = parent or self.root
+        span: dict[str, Any] = {
+            "trace_id": self.trace_id,
+            "span_id": os.urandom(8).hex(),
+            "parent_span_id": parent["span_id"] if parent else parent_span_id,
+            "name": name,
+            "kind": kind,
+            "start_unix_nano": time.time_ns(),
+            "end_unix_nano": 0,
+            "attributes": {},
+        }
+        if self.sampled:
+            self.spans.append(span)
+        return span
+
+    def end(self, span: dict[str, Any], **attributes: Any) -> None:
+        span["end_unix_nano"] = time.time_ns()
+        span["attributes"].update(attributes)
+
+    def traceparent(self, span: dict[str, Any]) -> str:
+        """Header value that makes ``span`` the parent of the upstream's spans."""
+        return f"00-{self.trace_id}-{span['span_id']}-{'01' if self.sampled else '00'}"
+
+    def httpx_hook(self, parent: dict[str, Any]) -> Callable[[str, dict[str, Any]], Awaitable[None]]:
+        """httpx "trace" extension callback that records connect and time-to-first-byte spans."""
+        phases: dict[str, dict[str, Any]] = {}
+
+        async def on_event(event_name: str, info: dict[str, Any]) -> None:
+            if event_name == "connection.connect_tcp.started":
+                phases["connect"] = self.start("upstream_connect", parent)
+            elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                # TLS setup, when there is one, counts as part of connecting
+                self.end(phases["connect"])
+            elif event_name.endswith("send_request_headers.started"):
+                phases["ttfb"] = self.start("upstream_ttfb", parent)
+            elif event_name.endswith("receive_response_headers.complete"):
+                self.end(phases["ttfb"])
+
+        return on_event
+
+    def finish(self, **attributes: Any) -> None:
+        """End the request span (and any phase left open by an early return) and queue the trace for export."""
+        if self.finished:
+            return
+        self.finished = True
+        self.end(self.root, **attributes)
+        if not self.sampled or span_exporter is None:
+            return
+        for span in self.spans:
+            if not span["end_unix_nano"]:
+                span["end_unix_nano"] = self.root["end_unix_nano"]
+        span_exporter.submit(self.spans)
+
+
+# Admission controllers keyed by match_url; only touched from the event loop
+admission_controllers: dict[str, AdmissionController] = {}
+
+
+def get_admission_controller(mapping: dict[str, Any]) -> AdmissionController:
+    """Return the admission controller for a mapping, applying its current limits."""
+    match_url = mapping.get("match_url", "")
+    max_concurrency = int(mapping.get("max_concurrency", UPSTREAM_MAX_CONCURRENCY))
+    max_queue = int(mapping.get("max_queue", UPSTREAM_MAX_QUEUE))
+    queue_timeout = float(mapping.get("queue_timeout", UPSTREAM_QUEUE_TIMEOUT))
+    controller = admission_controllers.get(match_url)
+    if controller is None:
+        controller = AdmissionController(max_concurrency, max_queue, queue_timeout)
+        admission_controllers[match_url] = controller
+    elif (controller.max_concurrency, controller.max_queue, controller.queue_timeout) != (
+        max_concurrency,
+        max_queue,
+        queue_timeout,
+    ):
+        controller.configure(max_concurrency, max_queue, queue_timeout)
+    return controller
+
+
 class AuthRequestModel(BaseModel):
     username: str
     password: str
@@ -237,6 +1769,329 @@ def is_admin_user(username: str) -> bool:
     return username.strip().lower() in [u.strip().lower() for u in ADMIN_USERS]
 
 
+class Identity:
+    """The verified session behind a request, built once by AuthContextMiddleware."""
+
+    __slots__ = ("username", "allowed_urls", "expires_at", "is_admin", "group_digests", "auth_time", "session_id")
+
+    def __init__(
+        self,
+        username: str,
+        allowed_urls: frozenset[str],
+        expires_at: int,
+        group_digests: frozenset[str] = frozenset(),
+        auth_time: float | None = None,
+        session_id: str | None = None,
+    ):
+        self.username = username
+        self.allowed_urls = allowed_urls
+        self.expires_at = expires_at
+        self.is_admin = is_admin_user(username)
+        self.group_digests = group_digests
+        # When the user last authenticated against RADIUS; None for tokens that cannot be renewed
+        self.auth_time = auth_time
+        # The token's jti: one per login, carried over when the token is renewed
+        self.session_id = session_id
+
+    def due_for_renewal(self, now: float) -> bool:
+        if self.auth_time is None or self.expires_at - now > AUTHZ_REFRESH_WINDOW:
+            return False
+        # Already capped at the absolute lifetime: renewing would not extend it
+        return self.expires_at < int(self.auth_time + AUTHZ_MAX_LIFETIME)
+
+
+def group_digest(group: str) -> str:
+    """Keyed digest of a group name, so tokens can carry membership without revealing group names."""
+    key = (SESSION_SECRET or "").encode()
+    return hmac.new(key, group.strip().lower().encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def compute_allowed_urls(mappings: list[dict[str, Any]], username: str, group_digests: frozenset[str]) -> list[str]:
+    """Match URLs of the mappings a user may access, given their RADIUS group digests."""
+    allowed_urls: list[str] = []
+    try:
+        for mapping in mappings:
+            # Handle empty lists properly
+            au: list[str] = mapping.get("allowed_users", None) or []
+            ag: list[str] = mapping.get("allowed_groups", None) or []
+            match_url = mapping.get("match_url", "")
+            user_allowed = bool(au) and any(username.strip().lower() == u.strip().lower() for u in au)
+            if not user_allowed and ag:
+                # No RADIUS groups returned but mapping specifies allowed_groups:
+                # treat as allowed for any authenticated user.
+                user_allowed = not group_digests or any(group_digest(g) in group_digests for g in ag)
+            logging.debug(
+                f"Permissions for mapping {match_url}: allowed_users={au}, allowed_groups={ag}, "
+                f"user_allowed={user_allowed}, unrestricted={not au and not ag}"
+            )
+            # If user is allowed or mapping has no restrictions, and the URL is valid
+            if (user_allowed or (not au and not ag)) and match_url:
+                allowed_urls.append(match_url)
+    except Exception:
+        logging.debug("Error computing allowed mappings; defaulting to none")
+        return []
+    return allowed_urls
+
+
+def issue_session(
+    username: str, group_digests: frozenset[str], auth_time: float, session_id: str
+) -> tuple[str, Identity]:
+    """Sign a new authz token with freshly computed permissions."""
+    now = int(time.time())
+    jitter = random.randint(0, max(min(AUTHZ_JITTER, AUTHZ_TTL // 2), 0))
+    expires_at = min(now + AUTHZ_TTL - jitter, int(auth_time + AUTHZ_MAX_LIFETIME))
+    allowed_urls = compute_allowed_urls(load_mappings(), username, group_digests)
+    payload: dict[str, Any] = {
+        "u": username,
+        "m": allowed_urls,
+        "g": sorted(group_digests),
+        "at": auth_time,
+        "jti": session_id,
+        "exp": expires_at,
+    }
+    token = jwt.encode(payload, SESSION_SECRET, algorithm="HS256")
+    return token, Identity(username, frozenset(allowed_urls), expires_at, group_digests, auth_time, session_id)
+
+
+def set_authz_cookie(response: Response, token: str, expires_at: int) -> None:
+    # Set secure=False for local HTTP testing (change to True in production with HTTPS)
+    response.set_cookie(
+        key=AUTHZ_COOKIE_NAME,
+        value=token,
+        httponly=True,
+        secure=False,
+        max_age=max(expires_at - int(time.time()), 0),
+    )
+
+
+verified_sessions: dict[str, Identity] = {}
+
+
+def verify_session(token: str) -> Identity | None:
+    """Verify an authz JWT; None if it is expired, forged or malformed.
+
+    Tokens that verified before are answered from memory until they expire.
+    """
+    identity = verified_sessions.get(token)
+    if identity is not None:
+        if identity.expires_at > time.time():
+            return identity
+        verified_sessions.pop(token, None)
+    identity = _decode_session(token)
+    if identity is not None and SESSION_CACHE_SIZE:
+        if len(verified_sessions) >= SESSION_CACHE_SIZE:
+            # Drop the oldest entry (dicts keep insertion order)
+            verified_sessions.pop(next(iter(verified_sessions)), None)
+        verified_sessions[token] = identity
+    return identity
+
+
+def _decode_session(token: str) -> Identity | None:
+    try:
+        payload = jwt.decode(token, SESSION_SECRET, algorithms=["HS256"], options={"require": ["exp"]})
+    except jwt.InvalidTokenError:
+        return None
+    username, allowed = payload.get("u"), payload.get("m")
+    if not isinstance(username, str) or not username or not isinstance(allowed, list):
+        return None
+    allowed_urls = frozenset(url for url in cast(list[Any], allowed) if isinstance(url, str))
+    groups = payload.get("g")
+    group_digests = frozenset(cast(list[str], groups)) if isinstance(groups, list) else frozenset[str]()
+    auth_time, session_id = payload.get("at"), payload.get("jti")
+    return Identity(
+        username,
+        allowed_urls,
+        int(payload["exp"]),
+        group_digests,
+        auth_time if isinstance(auth_time, (int, float)) else None,
+        session_id if isinstance(session_id, str) else None,
+    )
+
+
+class RevocationStore:
+    """Revoked sessions and per-user "log out everywhere" cutoffs.
+
+    The tables are plain dicts, so checking a request that is not revoked costs
+    one dict probe (plus one more only while some user has a cutoff). Entries are
+    dropped once every token they cover has passed AUTHZ_MAX_LIFETIME. Changes are
+    made on the event loop and saved to disk with a write-then-rename in a thread,
+    so the fsync does not stall other requests.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()  # serializes the writer threads
+        self.version = 0
+        self.saved_version = 0
+        self.sessions: dict[str, int] = {}  # jti -> time after which the session is dead anyway
+        self.users: dict[str, float] = {}  # lowercased username -> sessions started at or before this are revoked
+        # Tokens from before session IDs existed have no jti or login time, and all predate the
+        # tokens that do; logging one out ends every such token of the user. username -> keep until
+        self.legacy_users: dict[str, int] = {}
+        self._load()
+
+    def is_revoked(self, identity: Identity) -> bool:
+        if identity.session_id in self.sessions:
+            return True
+        if self.users:
+            cutoff = self.users.get(identity.username.lower())
+            # Tokens from before session IDs existed have no login time; a cutoff covers them too
+            if cutoff is not None and (identity.auth_time is None or identity.auth_time <= cutoff):
+                return True
+        if self.legacy_users and identity.session_id is None:
+            return identity.username.lower() in self.legacy_users
+        return False
+
+    async def revoke_session(self, identity: Identity) -> None:
+        if identity.session_id is not None:
+            # A renewed token can live until the absolute lifetime, so remember the jti that long
+            auth_time = identity.auth_time
+            until = int(auth_time) + AUTHZ_MAX_LIFETIME if auth_time is not None else identity.expires_at
+            self.sessions[identity.session_id] = until
+        else:
+            until = max(identity.expires_at, int(time.time()) + AUTHZ_MAX_LIFETIME)
+            self.legacy_users[identity.username.lower()] = until
+        await self._save()
+
+    async def revoke_user(self, username: str) -> None:
+        self.users[username.strip().lower()] = time.time()
+        await self._save()
+
+    def stats(self) -> dict[str, int]:
+        return {"sessions": len(self.sessions), "users": len(self.users), "legacy_users": len(self.legacy_users)}
+
+    def _prune(self) -> None:
+        now = int(time.time())
+        self.sessions = {jti: until for jti, until in self.sessions.items() if until > now}
+        self.users = {user: cutoff for user, cutoff in self.users.items() if cutoff + AUTHZ_MAX_LIFETIME > now}
+        self.legacy_users = {user: until for user, until in self.legacy_users.items() if until > now}
+
+    def _load(self) -> None:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.sessions = {str(k): int(v) for k, v in data.get("sessions", {}).items()}
+            self.users = {str(k): float(v) for k, v in data.get("users", {}).items()}
+            self.legacy_users = {str(k): int(v) for k, v in data.get("legacy_users", {}).items()}
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logging.error(f"Error loading revocations from {self.path}: {str(e)}")
+            return
+        self._prune()
+        logging.info(f"Loaded {len(self.sessions)} revoked sessions and {len(self.users)} user cutoffs")
+
+    async def _save(self) -> None:
+        self._prune()
+        self.version += 1
+        # Copies, since the loop keeps changing the tables while the thread writes them
+        data = {"sessions": dict(self.sessions), "users": dict(self.users), "legacy_users": dict(self.legacy_users)}
+        await asyncio.to_thread(self._write, self.version, data)
+
+    def _write(self, version: int, data: dict[str, Any]) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with self.lock:
+            # A later change may have been written already by another thread
+            if version <= self.saved_version:
+                return
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(data, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                self.saved_version = version
+            except OSError as e:
+                # Still enforced in memory; only a restart would forget it
+                logging.error(f"Error saving revocations to {self.path}: {str(e)}")
+
+
+revocations = RevocationStore(REVOCATION_FILE)
+
+
+session_renewals = 0
+
+
+class AuthContextMiddleware:
+    """Parses the cookie header and verifies the session once per request.
+
+    The result is stored as ``request.state.identity`` (None when there is no
+    valid session), so routes never scan or decode cookies themselves. Sessions
+    close to expiry are renewed here and the new token is added to the response.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] in ("http", "websocket"):
+            identity = None
+            cookie_header = b"; ".join(value for name, value in scope["headers"] if name == b"cookie")
+            if cookie_header:
+                token = cookie_parser(cookie_header.decode("latin-1")).get(AUTHZ_COOKIE_NAME)
+                if token:
+                    identity = verify_session(token)
+                    if identity is not None and revocations.is_revoked(identity):
+                        identity = None
+            if identity is not None and scope["type"] == "http" and identity.due_for_renewal(time.time()):
+                renewed = self.renew(identity)
+                if renewed is not None:
+                    identity, cookie_headers = renewed
+                    send = self.with_cookie(send, cookie_headers)
+            scope.setdefault("state", {})["identity"] = identity
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    def renew(identity: Identity) -> tuple[Identity, list[tuple[bytes, bytes]]] | None:
+        global session_renewals
+        assert identity.auth_time is not None
+        # Tokens from before session IDs existed get one on their first renewal
+        session_id = identity.session_id or secrets.token_urlsafe(12)
+        try:
+            token, renewed = issue_session(identity.username, identity.group_digests, identity.auth_time, session_id)
+        except Exception:
+            logging.exception(f"Failed to renew session for '{identity.username}'")
+            return None
+        session_renewals += 1
+        logging.debug(f"Renewed session for '{renewed.username}' until {renewed.expires_at}")
+        carrier = Response()
+        set_authz_cookie(carrier, token, renewed.expires_at)
+        return renewed, [header for header in carrier.raw_headers if header[0] == b"set-cookie"]
+
+    @staticmethod
+    def with_cookie(send: Send, cookie_headers: list[tuple[bytes, bytes]]) -> Send:
+        prefix = f"{AUTHZ_COOKIE_NAME}=".encode()
+
+        async def send_with_cookie(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                # Login and logout set (or clear) the cookie themselves
+                if not any(name == b"set-cookie" and value.startswith(prefix) for name, value in headers):
+                    message = {**message, "headers": headers + cookie_headers}
+            await send(message)
+
+        return send_with_cookie
+
+
+app.add_middleware(AuthContextMiddleware)
+
+
+def require_user(request: Request) -> Identity:
+    """Return the caller's identity or fail with 401."""
+    identity: Identity | None = request.state.identity
+    if identity is None:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    return identity
+
+
+def require_admin(request: Request) -> Identity:
+    """Return the caller's identity or fail with 401/403 unless they are an admin."""
+    identity = require_user(request)
+    if not identity.is_admin:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return identity
+
+
 def get_login_url(request: Request, next_path: str):
     domain = LOGIN_DOMAIN if LOGIN_DOMAIN else request.headers.get("host", "localhost")
     # Check if domain already includes protocol
@@ -247,6 +2102,204 @@ def get_login_url(request: Request, next_path: str):
         return f"http://{domain}/login?next={next_path}"
 
 
+def radius_exchange(username: str, password: str) -> Any:
+    """Send one Access-Request and return the reply. Blocks, so run it in a thread.
+
+    Each exchange gets its own Client: pyrad reads replies off the client's socket
+    and drops ones that are not for the current packet, so threads sharing a
+    socket would throw away each other's replies.
+    """
+    assert RADIUS_SERVER is not None and RADIUS_SECRET is not None
+    radius_client = Client(
+        server=RADIUS_SERVER,
+        secret=RADIUS_SECRET.encode(),
+        authport=RADIUS_PORT,
+        dict=radius_dict,
+    )
+    # Create RADIUS auth request (code 1 = Access-Request)
+    req = radius_client.CreateAuthPacket(code=1, User_Name=username.encode())
+
+    # Set password - pyrad will encrypt it properly
+    req["User-Password"] = req.PwCrypt(password.encode())
+
+    # Add NAS-Identifier attribute
+    req["NAS-Identifier"] = RADIUS_NAS_IDENTIFIER.encode()
+
+    # Enable Message-Authenticator for security (required by Synology RADIUS)
+    req.add_message_authenticator()
+
+    logging.debug(f"Sending RADIUS packet to {RADIUS_SERVER}:{RADIUS_PORT}")
+    return radius_client.SendPacket(req)
+
+
+class RadiusAuthenticator:
+    """Single-flight RADIUS authentication with an optional cache of accepts.
+
+    Concurrent logins with the same username and password (double-clicked
+    submits, several tabs, scripted clients) share one in-flight exchange and
+    all get its reply. Requests are keyed by an HMAC of the credentials under a
+    random per-process key, so neither the keys nor the cache hold passwords.
+    """
+
+    def __init__(self, cache_ttl: float, cache_size: int):
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.key = secrets.token_bytes(32)
+        self.in_flight: dict[str, asyncio.Task[Any]] = {}
+        self.accepted: dict[str, tuple[Any, float]] = {}  # credential hash -> (Access-Accept reply, expires)
+        self.exchanges = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+
+    def _credential_hash(self, username: str, password: str) -> str:
+        return hmac.new(self.key, f"{username}\0{password}".encode(), hashlib.sha256).hexdigest()
+
+    async def authenticate(self, username: str, password: str) -> Any:
+        key = self._credential_hash(username, password)
+        if self.cache_ttl > 0:
+            cached = self.accepted.get(key)
+            if cached is not None and cached[1] > time.monotonic():
+                self.cache_hits += 1
+                return cached[0]
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._exchange(key, username, password))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # Shielded so one waiter giving up (client disconnect) does not cancel the others
+        return await asyncio.shield(task)
+
+    async def _exchange(self, key: str, username: str, password: str) -> Any:
+        self.exchanges += 1
+        reply = await asyncio.to_thread(radius_exchange, username, password)
+        if self.cache_ttl > 0 and reply.code == 2:  # Access-Accept
+            now = time.monotonic()
+            if len(self.accepted) >= self.cache_size:
+                self.accepted = {k: v for k, v in self.accepted.items() if v[1] > now}
+                if len(self.accepted) >= self.cache_size:
+                    # Drop the oldest entry (dicts keep insertion order)
+                    self.accepted.pop(next(iter(self.accepted)))
+            self.accepted[key] = (reply, now + self.cache_ttl)
+        return reply
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "exchanges": self.exchanges,
+            "coalesced": self.coalesced,
+            "cache_hits": self.cache_hits,
+            "in_flight": len(self.in_flight),
+            "cached": len(self.accepted),
+        }
+
+
+radius_authenticator = RadiusAuthenticator(RADIUS_AUTH_CACHE_TTL, RADIUS_AUTH_CACHE_SIZE)
+
+
+class LoginThrottle:
+    """Sliding-window login attempt limits with exponential lockout, per key.
+
+    Keys are usernames or client IPs. Each key keeps only the attempt counts of
+    the current and previous fixed windows (weighted into a sliding estimate)
+    and its lockout state, and idle keys are dropped, so a burst cycling through
+    many usernames costs a few dozen bytes per key and stays bounded.
+    """
+
+    def __init__(self, limit: int, window: float, lockout: float, max_lockout: float, max_keys: int):
+        self.limit = limit
+        self.window = window
+        self.lockout = lockout
+        self.max_lockout = max_lockout
+        self.max_keys = max_keys
+        # key -> [window start, previous window count, current window count, locked until, lockouts]
+        self.entries: dict[str, list[float]] = {}
+        self.rejected = 0
+
+    def _idle(self, entry: list[float], now: float) -> bool:
+        # Nothing counted in the last two windows and no lockout pending
+        return entry[3] <= now and now - entry[0] >= 2 * self.window
+
+    def locked_for(self, key: str, now: float) -> float:
+        """Seconds the key stays locked out (0 = not locked)."""
+        entry = self.entries.get(key)
+        if entry is None or entry[3] <= now:
+            return 0
+        self.rejected += 1
+        return entry[3] - now
+
+    def failure(self, key: str, now: float) -> float:
+        """Count a failed attempt; returns seconds the key is now locked out (0 = not locked)."""
+        if not self.limit:
+            return 0
+        entry = self.entries.get(key)
+        if entry is None or self._idle(entry, now):
+            if entry is None and len(self.entries) >= self.max_keys > 0:
+                self._prune(now)
+            entry = self.entries[key] = [now, 0, 0, 0, 0]
+        if entry[3] > now:
+            # Already locked by a failure that was in flight alongside this one
+            return entry[3] - now
+        elapsed = now - entry[0]
+        if elapsed >= self.window:
+            entry[1] = entry[2] if elapsed < 2 * self.window else 0
+            entry[2] = 0
+            entry[0] += self.window * (elapsed // self.window)
+            elapsed = now - entry[0]
+        entry[2] += 1
+        if entry[1] * (1 - elapsed / self.window) + entry[2] >= self.limit:
+            # Each lockout of the same key lasts twice as long as the one before
+            entry[4] += 1
+            entry[3] = now + min(self.lockout * 2 ** (entry[4] - 1), self.max_lockout)
+            entry[1] = entry[2] = 0
+            return entry[3] - now
+        return 0
+
+    def reset(self, key: str) -> None:
+        self.entries.pop(key, None)
+
+    def stats(self) -> dict[str, int]:
+        now = time.time()
+        locked = sum(1 for entry in self.entries.values() if entry[3] > now)
+        return {"keys": len(self.entries), "locked": locked, "rejected": self.rejected}
+
+    def _prune(self, now: float) -> None:
+        self.entries = {key: entry for key, entry in self.entries.items() if not self._idle(entry, now)}
+        # Still full of live keys: drop the oldest tenth rather than pruning on every attempt
+        excess = len(self.entries) - int(self.max_keys * 0.9)
+        for key in list(self.entries)[: max(excess, 0)]:
+            del self.entries[key]
+
+
+login_throttle_users = LoginThrottle(
+    LOGIN_USER_LIMIT, LOGIN_WINDOW, LOGIN_LOCKOUT, LOGIN_MAX_LOCKOUT, LOGIN_THROTTLE_MAX_KEYS
+)
+login_throttle_ips = LoginThrottle(
+    LOGIN_IP_LIMIT, LOGIN_WINDOW, LOGIN_LOCKOUT, LOGIN_MAX_LOCKOUT, LOGIN_THROTTLE_MAX_KEYS
+)
+if LOGIN_IP_LIMIT and not TRUSTED_PROXY_HEADERS:
+    logging.warning(
+        "LOGIN_IP_LIMIT is on but FORWARDED_ALLOW_IPS is not set: behind a reverse proxy every client "
+        "shares the proxy's address, so failed logins from one client can lock out everyone"
+    )
+shared_ip_warned = False
+
+
+def warn_if_shared_client_ip(client_ip: str) -> None:
+    """Warn once when the per-IP login limit is keyed on a private address, such as a proxy or Docker gateway."""
+    global shared_ip_warned
+    if shared_ip_warned or not LOGIN_IP_LIMIT:
+        return
+    with suppress(ValueError):
+        address = ipaddress.ip_address(client_ip)
+        if address.is_private or address.is_loopback:
+            shared_ip_warned = True
+            logging.warning(
+                f"Login from private address {client_ip} counted against LOGIN_IP_LIMIT; if this is a proxy "
+                "or gateway rather than the user's machine, set FORWARDED_ALLOW_IPS to it or LOGIN_IP_LIMIT=0"
+            )
+
+
 @app.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request, next: str = "/"):
     return templates.TemplateResponse(
@@ -268,52 +2321,46 @@ async def login(
     password: str = Form(...),
     next: str = Form("/"),
 ):
+    # Throttle before doing any RADIUS work. Only rejected passwords are counted, once
+    # RADIUS has answered, so a double submit or several tabs logging in at once cannot
+    # lock the user out, and hammering a locked username does not also lock out its IP.
+    client_ip = request.client.host if request.client else "unknown"
+    warn_if_shared_client_ip(client_ip)
+    user_key = username.strip().lower()
+    now = time.time()
+    retry_after = max(login_throttle_ips.locked_for(client_ip, now), login_throttle_users.locked_for(user_key, now))
+    if retry_after:
+        logging.warning(f"Login throttled for user '{username}' from {client_ip}; retry in {retry_after:.0f}s")
+        return templates.TemplateResponse(
+            "login.html",
+            {
+                "request": request,
+                "next": next,
+                "error": f"Too many login attempts. Try again in {int(retry_after) + 1} seconds.",
+                "unrestricted_access": not ADMIN_USERS,
+            },
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            headers={"Retry-After": str(int(retry_after) + 1)},
+        )
+
     try:
         logging.info(f"Login attempt for user: {username}")
         logging.debug(f"RADIUS Server: {RADIUS_SERVER}:{RADIUS_PORT}")
 
-        # Create RADIUS auth request (code 1 = Access-Request)
-        logging.debug("Creating RADIUS auth packet")
-        req = client.CreateAuthPacket(code=1, User_Name=username.encode())
-
-        # Set password - pyrad will encrypt it properly
-        req["User-Password"] = req.PwCrypt(password.encode())
-
-        # Add NAS-Identifier attribute
-        req["NAS-Identifier"] = RADIUS_NAS_IDENTIFIER.encode()
-
-        # Enable Message-Authenticator for security (required by Synology RADIUS)
-        req.add_message_authenticator()
-
-        # Send request and get response
-        logging.debug(f"Sending RADIUS packet to {RADIUS_SERVER}:{RADIUS_PORT}")
-        reply = client.SendPacket(req)
+        reply = await radius_authenticator.authenticate(username, password)
         logging.debug(f"Received RADIUS reply with code: {reply.code}")
         logging.debug("RADIUS reply attributes:")
         for attr_name, values in reply.items():
             logging.debug(f"  {attr_name}: {values}")
 
         if reply.code == 2:  # Access-Accept
+            login_throttle_users.reset(user_key)
             response = RedirectResponse(url=next, status_code=status.HTTP_303_SEE_OTHER)
-            # Set secure=False for local HTTP testing (change to True in production with HTTPS)
-            response.set_cookie(
-                key="auth",
-                value="authenticated",
-                httponly=True,
-                secure=False,
-                max_age=3600,
-            )
-            response.set_cookie(
-                key="username",
-                value=username,
-                httponly=True,
-                secure=False,
-                max_age=3600,
-            )
             # Best-effort: extract group-like attributes from the RADIUS reply
             # and compute which mappings the user is allowed to access. We do
             # NOT store raw groups on the client. Instead we create a signed
-            # JWT containing allowed mapping indices and expiry (stateless).
+            # JWT containing allowed mapping URLs, keyed digests of the groups
+            # (so the session can be renewed without RADIUS) and expiry.
             groups: list[str] = []
             try:
                 for attr in ("Filter-Id", "Group", "Cisco-AVPair"):
@@ -334,65 +2381,21 @@ async def login(
                 logging.debug("Could not extract groups from RADIUS reply; continuing")
             logging.debug(f"Extracted groups from RADIUS reply: {groups}")
 
-            # Determine allowed mapping URLs based on mapping config
-            allowed_urls: list[str] = []
-            try:
-                mappings = load_mappings()
-                for mapping in mappings:
-                    # Handle empty lists properly
-                    au: list[str] = mapping.get("allowed_users", None) or []
-                    ag: list[str] = mapping.get("allowed_groups", None) or []
-                    logging.debug(f"Raw allowed_users: {mapping.get('allowed_users')}, processed: {au}")
-                    logging.debug(f"Raw allowed_groups: {mapping.get('allowed_groups')}, processed: {ag}")
-                    match_url = mapping.get("match_url", "")
-                    user_allowed = False
-                    if au and username and any(username.strip().lower() == u.strip().lower() for u in au):
-                        user_allowed = True
-                    if not user_allowed and ag:
-                        if groups:
-                            logging.debug(f"Checking if user groups {groups} match any of allowed groups {ag}")
-                            for g in groups:
-                                if any(g.strip().lower() == agv.strip().lower() for agv in ag):
-                                    logging.debug(f"Found matching group: {g}")
-                                    user_allowed = True
-                                    break
-                        else:
-                            # No RADIUS groups returned but mapping specifies allowed_groups.
-                            # Treat as allowed for any authenticated user.
-                            logging.debug(
-                                "No groups from RADIUS, but mapping specifies allowed_groups – treating as allowed"
-                            )
-                            user_allowed = True
-                    # Debug log the authorization check
-                    logging.debug(f"Checking permissions for mapping {match_url}:")
-                    logging.debug(f"  - Allowed users: {au}")
-                    logging.debug(f"  - Allowed groups: {ag}")
-                    logging.debug(f"  - User allowed by username: {user_allowed}")
-                    logging.debug(f"  - No restrictions: {not au and not ag}")
-
-                    # If user is allowed or mapping has no restrictions, and the URL is valid
-                    if (user_allowed or (not au and not ag)) and match_url:
-                        logging.debug(f"  => Adding {match_url} to allowed URLs")
-                        allowed_urls.append(match_url)
-            except Exception:
-                logging.debug("Error computing allowed mappings; defaulting to none")
-
-            # Create stateless JWT with allowed mapping URLs
-            payload: dict[str, Any] = {"u": username, "m": allowed_urls, "exp": int(time.time()) + AUTHZ_TTL}
-            logging.info(f"User '{username}' logged in successfully. Allowed mappings: {allowed_urls}")
+            group_digests = frozenset(group_digest(g) for g in groups)
             try:
-                token = jwt.encode(payload, SESSION_SECRET, algorithm="HS256")
-                response.set_cookie(
-                    key=AUTHZ_COOKIE_NAME,
-                    value=token,
-                    httponly=True,
-                    secure=False,
-                    max_age=AUTHZ_TTL,
+                token, identity = issue_session(username, group_digests, time.time(), secrets.token_urlsafe(12))
+                set_authz_cookie(response, token, identity.expires_at)
+                logging.info(
+                    f"User '{username}' logged in successfully. Allowed mappings: {sorted(identity.allowed_urls)}"
                 )
             except Exception:
                 logging.exception("Failed to create authz token")
             return response
         else:  # Access-Reject
+            now = time.time()
+            locked = max(login_throttle_ips.failure(client_ip, now), login_throttle_users.failure(user_key, now))
+            if locked:
+                logging.warning(f"Login locked for user '{username}' from {client_ip} for {locked:.0f}s")
             return templates.TemplateResponse(
                 "login.html",
                 {
@@ -420,19 +2423,104 @@ async def login(
 
 @app.get("/logout")
 async def logout(request: Request):
+    identity: Identity | None = request.state.identity
+    if identity is not None:
+        # Deleting the cookie is not enough: a copy of the token would stay valid until it expires
+        await revocations.revoke_session(identity)
     response = RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
+    response.delete_cookie(key=AUTHZ_COOKIE_NAME)
+    # Cookies set by older versions; the session now lives only in the authz token
     response.delete_cookie(key="auth")
     response.delete_cookie(key="username")
     return response
 
 
-def get_username_from_cookie(request: Request) -> str:
-    """Extract username from cookie."""
-    cookies = request.headers.get("cookie", "")
-    for cookie in cookies.split(";"):
-        if "username=" in cookie:
-            return cookie.split("username=")[1].strip()
-    return ""
+@app.post("/logout/everywhere")
+async def logout_everywhere(request: Request):
+    """End every session of the current user, on all devices."""
+    identity = require_user(request)
+    await revocations.revoke_user(identity.username)
+    logging.info(f"User '{identity.username}' logged out everywhere")
+    response = RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
+    response.delete_cookie(key=AUTHZ_COOKIE_NAME)
+    return response
+
+
+@app.post("/revproxauth/users/{username}/revoke")
+async def revoke_user_sessions(request: Request, username: str):
+    """End every session of a user, e.g. for a stolen device or a removed account."""
+    admin = require_admin(request).username
+    await revocations.revoke_user(username)
+    logging.warning(f"All sessions of '{username}' revoked by {admin}")
+    return {"revoked": username}
+
+
+def nginx_upstream(http_dest: str) -> str:
+    """http_dest in the form nginx's proxy_pass expects (unix:/path.sock:/base for sockets)."""
+    base_url, socket_path = parse_upstream(http_dest)
+    if socket_path is None:
+        return http_dest.rstrip("/")
+    return f"http://unix:{socket_path}:{urlsplit(base_url).path.rstrip('/')}"
+
+
+def accel_redirect_response(http_dest: str, target_path: str, query: str, username: str, match_url: str) -> Response:
+    """Hand an authorized request back to nginx, which proxies it from ACCEL_REDIRECT_LOCATION."""
+    upstream_path = quote(target_path, safe="/:@!$&'()*+,;=~")
+    if query:
+        upstream_path += f"?{query}"
+    return Response(
+        status_code=200,
+        headers={
+            "X-Accel-Redirect": ACCEL_REDIRECT_LOCATION,
+            "X-Accel-Upstream": nginx_upstream(http_dest),
+            "X-Accel-Path": upstream_path,
+            "X-Auth-User": username,
+            "X-Auth-Mapping": match_url,
+        },
+    )
+
+
+@app.api_route("/revproxauth/auth", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS", "HEAD"])
+async def forward_auth(request: Request, redirect: bool = False):
+    """Auth decision for a front proxy that carries the bytes itself.
+
+    For nginx auth_request, Traefik ForwardAuth and Caddy forward_auth. The original
+    request is read from X-Forwarded-Host and X-Forwarded-Uri (or X-Original-URI) and
+    matched against the mappings like a proxied request. Answers 200 with X-Auth-User
+    and X-Auth-Mapping, 401 without a valid session (or, with ?redirect=true, a
+    redirect to the login page for proxies that pass it on), or 403.
+    """
+    forwarded_host = request.headers.get("x-forwarded-host") or request.headers.get("host", "")
+    host = forwarded_host.split(",")[0].strip().lower().split(":")[0]
+    original_uri = request.headers.get("x-forwarded-uri") or request.headers.get("x-original-uri") or "/"
+    request_path = unquote(urlsplit(original_uri).path).rstrip("/") or "/"
+
+    route = config_store.snapshot().match(host, request_path)
+    if route is None:
+        logging.info(f"Forward auth: no mapping for {host}{request_path}")
+        return PlainTextResponse("App not found", status_code=403)
+
+    identity: Identity | None = request.state.identity
+    if identity is None:
+        if not redirect:
+            return PlainTextResponse("Unauthorized", status_code=401)
+        next_url = quote(original_uri, safe="/")
+        if LOGIN_DOMAIN:
+            login_url = get_login_url(request, next_url)
+        else:
+            proto = request.headers.get("x-forwarded-proto", "http")
+            login_url = f"{proto}://{forwarded_host.split(',')[0].strip()}/login?next={next_url}"
+        return RedirectResponse(url=login_url, status_code=status.HTTP_302_FOUND)
+
+    if route.match_url not in identity.allowed_urls:
+        logging.warning(f"Forward auth denied: user '{identity.username}' not authorized for '{route.match_url}'")
+        return PlainTextResponse("Forbidden", status_code=403)
+
+    update_metrics(route.match_url, identity.username, increment_request=True)
+    return PlainTextResponse(
+        "OK",
+        headers={"X-Auth-User": identity.username, "X-Auth-Mapping": route.match_url},
+    )
 
 
 @app.get("/health")
@@ -446,21 +2534,43 @@ async def favicon():
 
 
 @app.get("/revproxauth", response_class=HTMLResponse)
-async def read_mappings(request: Request):
-    if "auth=authenticated" not in request.headers.get("cookie", ""):
+async def read_mappings(
+    request: Request,
+    q: str = "",
+    flag: str = "",
+    user: str = "",
+    group: str = "",
+    page: int = 1,
+    per_page: int = 50,
+):
+    identity: Identity | None = request.state.identity
+    if identity is None:
         login_url = get_login_url(request, "/revproxauth")
         return RedirectResponse(url=login_url, status_code=status.HTTP_302_FOUND)
 
-    username = get_username_from_cookie(request)
-    is_admin = is_admin_user(username)
+    snapshot = config_store.snapshot()
+
+    # Search the cached index for this generation and render only the requested page
+    per_page = min(max(per_page, 10), 500)
+    matches = snapshot.index.search(q, flag, user, group)
+    pages = max(1, -(-len(matches) // per_page))
+    page = min(max(page, 1), pages)
+    entries = [{"index": i, "mapping": snapshot.mappings[i]} for i in matches[(page - 1) * per_page : page * per_page]]
 
     return templates.TemplateResponse(
         "mappings.html",
         {
             "request": request,
-            "mappings": load_mappings(),
-            "is_admin": is_admin,
-            "username": username,
+            "entries": entries,
+            "total_mappings": len(snapshot.mappings),
+            "matched": len(matches),
+            "filters": {"q": q, "flag": flag, "user": user, "group": group},
+            "page": page,
+            "pages": pages,
+            "per_page": per_page,
+            "generation": snapshot.generation,
+            "is_admin": identity.is_admin,
+            "username": identity.username,
             "unrestricted_access": not ADMIN_USERS,
             "app_name": APP_NAME,
             "app_tagline": APP_TAGLINE,
@@ -470,47 +2580,36 @@ async def read_mappings(request: Request):
 
 @app.get("/revproxauth/metrics", response_class=HTMLResponse)
 async def show_metrics(request: Request):
-    if "auth=authenticated" not in request.headers.get("cookie", ""):
+    identity: Identity | None = request.state.identity
+    if identity is None:
         login_url = get_login_url(request, "/revproxauth/metrics")
         return RedirectResponse(url=login_url, status_code=status.HTTP_302_FOUND)
 
-    username = get_username_from_cookie(request)
-
-    # Prepare metrics data for display
-    metrics_data: list[dict[str, Any]] = []
-    total_requests = 0
-    total_bytes_sent = 0
-    total_bytes_received = 0
-    active_users_set: set[str] = set()
-
+    # Only the summary is rendered here; the table pages through /revproxauth/metrics/query
     with metrics_lock:
-        for (mapping_url, user), metrics in sorted(metrics_storage.items()):
-            metrics_data.append(
-                {
-                    "mapping": mapping_url,
-                    "user": user,
-                    "requests": metrics["requests"],
-                    "bytes_sent": metrics["bytes_sent"],
-                    "bytes_received": metrics["bytes_received"],
-                    "first_access": metrics["first_access"] or "N/A",
-                    "last_access": metrics["last_access"] or "N/A",
-                }
-            )
-            total_requests += metrics["requests"]
-            total_bytes_sent += metrics["bytes_sent"]
-            total_bytes_received += metrics["bytes_received"]
-            active_users_set.add(user)
+        totals = dict(metrics_totals)
+        active_users = len(metrics_by_user)
+        evicted = metrics_evicted
+
+    admission_stats = [
+        {"mapping": mapping_url, **controller.stats()}
+        for mapping_url, controller in sorted(admission_controllers.items())
+    ]
 
     return templates.TemplateResponse(
         "metrics.html",
         {
             "request": request,
-            "metrics_data": metrics_data,
-            "total_requests": total_requests,
-            "total_bytes_sent": total_bytes_sent,
-            "total_bytes_received": total_bytes_received,
-            "active_users": len(active_users_set),
-            "username": username,
+            "total_requests": totals["requests"],
+            "total_bytes_sent": totals["bytes_sent"],
+            "total_bytes_received": totals["bytes_received"],
+            "active_users": active_users,
+            "metrics_evicted": evicted,
+            "metrics_max_keys": METRICS_MAX_KEYS,
+            "admission_stats": admission_stats,
+            "loop_stats": loop_monitor.stats() if LOOP_MONITOR_ENABLED else None,
+            "slow_events": list(reversed(loop_monitor.slow_events)),
+            "username": identity.username,
             "format_bytes": format_bytes,
             "app_name": APP_NAME,
             "app_tagline": APP_TAGLINE,
@@ -518,6 +2617,205 @@ async def show_metrics(request: Request):
     )
 
 
+@app.get("/revproxauth/metrics/query")
+async def metrics_query(
+    request: Request,
+    mapping: str = "",
+    user: str = "",
+    since: str = "",
+    until: str = "",
+    group_by: str = "",
+    sort: str = "requests",
+    order: str = "desc",
+    limit: int = 50,
+    cursor: str = "",
+):
+    """JSON view of the metrics table with filtering, grouping, sorting and cursor pagination."""
+    require_user(request)
+
+    if group_by not in ("", "mapping", "user"):
+        raise HTTPException(status_code=400, detail="group_by must be 'mapping' or 'user'")
+    if sort not in METRICS_SORT_FIELDS or (group_by and sort in ("mapping", "user") and sort != group_by):
+        raise HTTPException(status_code=400, detail=f"Cannot sort by '{sort}'")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be 'asc' or 'desc'")
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+    try:
+        since = metrics_time_bound(since) if since else ""
+        until = metrics_time_bound(until, end_of_day=True) if until else ""
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since and until must be ISO dates or datetimes") from None
+
+    try:
+        result = query_metrics(mapping, user, since, until, group_by, sort, order, limit, cursor)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from e
+
+    with metrics_lock:
+        result["totals"] = {**metrics_totals, "users": len(metrics_by_user), "evicted": metrics_evicted}
+    return result
+
+
+@app.get("/revproxauth/runtime")
+async def runtime_stats(request: Request):
+    """Process health snapshot for soak testing: tasks, file descriptors, loop lag and in-memory table sizes."""
+    require_admin(request)
+
+    # Time how long it takes to get scheduled again behind everything already queued
+    started = time.perf_counter()
+    await asyncio.sleep(0)
+    loop_lag_ms = (time.perf_counter() - started) * 1000
+
+    try:
+        open_fds = len(os.listdir("/proc/self/fd"))
+    except OSError:
+        open_fds = -1
+
+    with metrics_lock:
+        metrics_keys = len(metrics_storage) + len(metrics_other)
+        quota_keys = len(quota_usage)
+
+    return {
+        "tasks": len(asyncio.all_tasks()),
+        "open_fds": open_fds,
+        "loop_lag_ms": loop_lag_ms,
+        "metrics_keys": metrics_keys,
+        "quota_keys": quota_keys,
+        "admission_controllers": len(admission_controllers),
+        "bandwidth_buckets": len(bandwidth_buckets),
+        "active_upstream_requests": sum(c.active for c in admission_controllers.values()),
+        "session_renewals": session_renewals,
+        "revocations": revocations.stats(),
+        "radius": radius_authenticator.stats(),
+        "upstream_dns": upstream_dns.stats(),
+        "login_throttle": {"users": login_throttle_users.stats(), "ips": login_throttle_ips.stats()},
+        "loop_lag": loop_monitor.stats(),
+        "tracing": span_exporter.stats() if span_exporter else None,
+    }
+
+
+@app.get("/revproxauth/profile")
+async def profile(request: Request, seconds: float = 10, interval: float = 0.01, tasks: bool = True):
+    """Sample the live process for a few seconds and return a collapsed-stack file for flamegraph tools."""
+    username = require_admin(request).username
+
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {PROFILE_MAX_SECONDS:g}")
+    interval = max(interval, PROFILE_MIN_INTERVAL)
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+
+    async with profile_lock:
+        logging.info(f"Profiling for {seconds:g}s at {interval * 1000:g} ms intervals (requested by {username})")
+        profiler = SamplingProfiler(asyncio.get_running_loop(), interval, tasks)
+        # The sampler sleeps between ticks in its own thread, so the loop keeps serving while it runs
+        sampler = Thread(target=profiler.run, args=(seconds,), name="profiler", daemon=True)
+        sampler.start()
+        while sampler.is_alive():
+            await asyncio.sleep(0.1)
+
+    logging.info(f"Profile finished: {profiler.samples} samples, {len(profiler.counts)} distinct stacks")
+    filename = f"revproxauth-{datetime.now().strftime('%Y%m%d-%H%M%S')}.collapsed"
+    return PlainTextResponse(
+        profiler.collapsed(),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/revproxauth/config")
+async def get_config(request: Request):
+    """Current mappings with their config generation, also sent as the ETag for If-Match."""
+    require_user(request)
+
+    snapshot = config_store.snapshot()
+    return JSONResponse(
+        {"generation": snapshot.generation, "mappings": snapshot.mappings},
+        headers={"ETag": f'"{snapshot.generation}"'},
+    )
+
+
+@app.patch("/revproxauth/config")
+async def patch_config(request: Request):
+    """Apply a JSON Patch (RFC 6902) to {"mappings": [...]} as one transaction.
+
+    Send If-Match with the generation the patch was written against; a stale
+    generation gets 412 and nothing is applied.
+    """
+    username = require_admin(request).username
+
+    try:
+        operations = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON Patch document") from None
+
+    with edit_config(parse_if_match(request), conflict_status=412) as config:
+        try:
+            apply_json_patch(config, operations)
+        except ConfigValidationError as e:
+            raise HTTPException(status_code=422, detail=str(e)) from None
+    generation = config_store.snapshot().generation
+    logging.info(f"Config patched to generation {generation} by {username} ({len(operations)} operations)")
+    return JSONResponse({"generation": generation}, headers={"ETag": f'"{generation}"'})
+
+
+@app.get("/revproxauth/mappings/export")
+async def export_mappings(request: Request):
+    """Download the mappings as a config file that /revproxauth/mappings/import accepts."""
+    require_admin(request)
+
+    snapshot = config_store.snapshot()
+    return JSONResponse(
+        {"version": "1.0", "generation": snapshot.generation, "mappings": snapshot.mappings},
+        headers={
+            "ETag": f'"{snapshot.generation}"',
+            "Content-Disposition": f'attachment; filename="revproxauth-mappings-{snapshot.generation}.json"',
+        },
+    )
+
+
+@app.post("/revproxauth/mappings/import")
+async def import_mappings_endpoint(request: Request, mode: str = "replace", dry_run: bool = False):
+    """Import mappings from a JSON body ({"mappings": [...]}, e.g. an export) as one change.
+
+    mode=replace swaps in the whole list; mode=merge updates mappings with the same
+    match_url and appends the rest. dry_run=true only reports counts and conflicts.
+    """
+    username = require_admin(request).username
+
+    if mode not in ("replace", "merge"):
+        raise HTTPException(status_code=400, detail="mode must be 'replace' or 'merge'")
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be JSON") from None
+    if not isinstance(body, dict) or "mappings" not in body:
+        raise HTTPException(status_code=400, detail='Body must be an object with a "mappings" list')
+
+    incoming = cast(dict[str, Any], body)["mappings"]
+    result = run_bulk_change(request, lambda mappings: import_mappings(mappings, incoming, mode), dry_run)
+    if not dry_run:
+        logging.info(f"Mappings imported ({mode}) by {username}: generation {result['generation']}")
+    return JSONResponse(result, headers={"ETag": f'"{result["generation"]}"'})
+
+
+@app.post("/revproxauth/mappings/batch")
+async def batch_mappings(request: Request, dry_run: bool = False):
+    """Apply a list of add/update/delete operations addressed by match_url as one change."""
+    username = require_admin(request).username
+
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be JSON") from None
+    operations = body.get("operations") if isinstance(body, dict) else body
+
+    result = run_bulk_change(request, lambda mappings: apply_mapping_batch(mappings, operations), dry_run)
+    if not dry_run:
+        logging.info(f"Mapping batch applied by {username}: generation {result['generation']}")
+    return JSONResponse(result, headers={"ETag": f'"{result["generation"]}"'})
+
+
 @app.post("/revproxauth/add")
 async def add_mapping(
     request: Request,
@@ -526,15 +2824,10 @@ async def add_mapping(
     flags: str = Form(""),
     allowed_users: str = Form(""),
     allowed_groups: str = Form(""),
+    generation: int | None = Form(None),
 ):
-    if "auth=authenticated" not in request.headers.get("cookie", ""):
-        raise HTTPException(status_code=401, detail="Authentication required")
+    require_admin(request)
 
-    username = get_username_from_cookie(request)
-    if not is_admin_user(username):
-        raise HTTPException(status_code=403, detail="Admin access required")
-
-    mappings = load_mappings()
     # Parse flags from comma-separated string
     flags_list = [f.strip() for f in flags.split(",") if f.strip()]
     allowed_users_list = [u.strip() for u in allowed_users.split(",") if u.strip()]
@@ -546,8 +2839,8 @@ async def add_mapping(
         "allowed_users": allowed_users_list,
         "allowed_groups": allowed_groups_list,
     }
-    mappings.append(new_mapping)
-    save_mappings(mappings)
+    with edit_config(generation) as config:
+        config["mappings"].append(new_mapping)
     return RedirectResponse(url="/revproxauth", status_code=status.HTTP_303_SEE_OTHER)
 
 
@@ -560,107 +2853,314 @@ async def update_mapping(
     flags: str = Form(""),
     allowed_users: str = Form(""),
     allowed_groups: str = Form(""),
+    generation: int | None = Form(None),
 ):
-    if "auth=authenticated" not in request.headers.get("cookie", ""):
-        raise HTTPException(status_code=401, detail="Authentication required")
-
-    username = get_username_from_cookie(request)
-    if not is_admin_user(username):
-        raise HTTPException(status_code=403, detail="Admin access required")
+    require_admin(request)
 
-    mappings = load_mappings()
-    if 0 <= index < len(mappings):
-        # Parse flags from comma-separated string
-        flags_list = [f.strip() for f in flags.split(",") if f.strip()]
-        allowed_users_list = [u.strip() for u in allowed_users.split(",") if u.strip()]
-        allowed_groups_list = [g.strip() for g in allowed_groups.split(",") if g.strip()]
+    # Parse flags from comma-separated string
+    flags_list = [f.strip() for f in flags.split(",") if f.strip()]
+    allowed_users_list = [u.strip() for u in allowed_users.split(",") if u.strip()]
+    allowed_groups_list = [g.strip() for g in allowed_groups.split(",") if g.strip()]
+    with edit_config(generation) as config:
+        mappings = config["mappings"]
+        if not 0 <= index < len(mappings):
+            raise HTTPException(status_code=404, detail="Mapping not found")
+        # Keep settings the form does not edit (e.g. admission limits)
         mappings[index] = {
+            **mappings[index],
             "match_url": match_url,
             "http_dest": http_dest,
             "flags": flags_list,
             "allowed_users": allowed_users_list,
             "allowed_groups": allowed_groups_list,
         }
-        save_mappings(mappings)
     return RedirectResponse(url="/revproxauth", status_code=status.HTTP_303_SEE_OTHER)
 
 
 @app.post("/revproxauth/move/{index}")
-async def move_mapping(request: Request, index: int, direction: int = Form(...)):
-    if "auth=authenticated" not in request.headers.get("cookie", ""):
-        raise HTTPException(status_code=401, detail="Authentication required")
-
-    username = get_username_from_cookie(request)
-    if not is_admin_user(username):
-        raise HTTPException(status_code=403, detail="Admin access required")
+async def move_mapping(request: Request, index: int, direction: int = Form(...), generation: int | None = Form(None)):
+    require_admin(request)
 
-    mappings = load_mappings()
-    if 0 <= index < len(mappings):
+    with edit_config(generation) as config:
+        mappings = config["mappings"]
         new_index = index + direction
-        if 0 <= new_index < len(mappings):
-            # Swap the mappings
-            mappings[index], mappings[new_index] = mappings[new_index], mappings[index]
-            save_mappings(mappings)
+        if not (0 <= index < len(mappings) and 0 <= new_index < len(mappings)):
+            raise HTTPException(status_code=400, detail="Cannot move mapping there")
+        # Swap the mappings
+        mappings[index], mappings[new_index] = mappings[new_index], mappings[index]
     return RedirectResponse(url="/revproxauth", status_code=status.HTTP_303_SEE_OTHER)
 
 
 @app.post("/revproxauth/delete/{index}")
-async def delete_mapping(request: Request, index: int):
-    if "auth=authenticated" not in request.headers.get("cookie", ""):
-        raise HTTPException(status_code=401, detail="Authentication required")
+async def delete_mapping(request: Request, index: int, generation: int | None = Form(None)):
+    require_admin(request)
 
-    username = get_username_from_cookie(request)
-    if not is_admin_user(username):
-        raise HTTPException(status_code=403, detail="Admin access required")
-
-    mappings = load_mappings()
-    if 0 <= index < len(mappings):
+    with edit_config(generation) as config:
+        mappings = config["mappings"]
+        if not 0 <= index < len(mappings):
+            raise HTTPException(status_code=404, detail="Mapping not found")
         mappings.pop(index)
-        save_mappings(mappings)
     return RedirectResponse(url="/revproxauth", status_code=status.HTTP_303_SEE_OTHER)
 
 
+def parse_upstream(dest_url: str) -> tuple[str, str | None]:
+    """Split an http_dest into the base URL to request and the Unix socket to reach it by.
+
+    ``unix:/run/app.sock`` (optionally followed by ``:/base/path``, as in nginx) and
+    ``http+unix://%2Frun%2Fapp.sock/base/path`` go through the socket, with
+    ``localhost`` as the Host. For anything else the socket is None.
+    """
+    if dest_url.startswith("unix:"):
+        socket_path, sep, base_path = dest_url.removeprefix("unix:").partition(":/")
+        return f"http://localhost/{base_path}" if sep else "http://localhost", socket_path
+    if dest_url.startswith("http+unix://"):
+        socket_path, _, base_path = dest_url.removeprefix("http+unix://").partition("/")
+        return f"http://localhost/{base_path}", unquote(socket_path)
+    return dest_url, None
+
+
+class DNSEntry:
+    """One cached lookup: the addresses found, or the error of a failed lookup."""
+
+    __slots__ = ("addresses", "error", "expires", "stale_until", "next")
+
+    def __init__(self, addresses: list[str], error: str | None, expires: float, stale_until: float):
+        self.addresses = addresses
+        self.error = error
+        self.expires = expires
+        self.stale_until = stale_until
+        self.next = 0
+
+    def pick(self) -> str:
+        # Rotate through the addresses, like a resolver answering in round-robin order
+        address = self.addresses[self.next % len(self.addresses)]
+        self.next += 1
+        return address
+
+
+class DNSCache:
+    """Async cache of upstream hostname lookups.
+
+    Lookups use the event loop's getaddrinfo, which does not report record TTLs,
+    so answers are kept for a fixed ``ttl``. After that an answer is still served
+    for up to ``stale_ttl`` seconds while a background task refreshes it, so a slow
+    or briefly failing resolver (e.g. Docker's embedded DNS) never stalls requests.
+    Failed lookups are remembered for ``negative_ttl`` seconds, and concurrent
+    misses for the same name share one lookup.
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float, negative_ttl: float, timeout: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.entries: dict[tuple[str, int], DNSEntry] = {}
+        self.lookups: dict[tuple[str, int], asyncio.Task[DNSEntry]] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    async def resolve(self, host: str, port: int) -> str:
+        """One address for host; raises httpx.ConnectError if it cannot be resolved."""
+        key = (host.lower(), port)
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if now < entry.expires:
+                if entry.error is not None:
+                    self.negative_hits += 1
+                    raise httpx.ConnectError(entry.error)
+                self.hits += 1
+                return entry.pick()
+            if entry.error is None and now < entry.stale_until:
+                self.stale_hits += 1
+                if key not in self.lookups:
+                    self.refreshes += 1
+                    self._lookup(key)
+                return entry.pick()
+        self.misses += 1
+        # Shielded so a cancelled request does not cancel the lookup other requests wait on
+        entry = await asyncio.shield(self._lookup(key))
+        if entry.error is not None:
+            raise httpx.ConnectError(entry.error)
+        return entry.pick()
+
+    def _lookup(self, key: tuple[str, int]) -> asyncio.Task[DNSEntry]:
+        task = self.lookups.get(key)
+        if task is None:
+            task = asyncio.create_task(self._query(key))
+            self.lookups[key] = task
+            task.add_done_callback(lambda _: self.lookups.pop(key, None))
+        return task
+
+    async def _query(self, key: tuple[str, int]) -> DNSEntry:
+        host, port = key
+        try:
+            infos = await asyncio.wait_for(
+                asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM), self.timeout
+            )
+            now = time.monotonic()
+            addresses = list(dict.fromkeys(str(info[4][0]) for info in infos))
+            entry = DNSEntry(addresses, None, now + self.ttl, now + self.ttl + self.stale_ttl)
+        except (OSError, UnicodeError) as e:
+            self.failures += 1
+            now = time.monotonic()
+            previous = self.entries.get(key)
+            if previous is not None and previous.error is None and now < previous.stale_until:
+                # A failed refresh keeps the old answer until it is fully stale
+                logging.warning(f"DNS refresh for upstream {host} failed, still using cached addresses: {e!r}")
+                return previous
+            logging.error(f"DNS lookup for upstream {host} failed: {e!r}")
+            error = f"DNS lookup for {host} failed: {str(e) or type(e).__name__}"
+            entry = DNSEntry([], error, now + self.negative_ttl, now + self.negative_ttl)
+        if key not in self.entries and len(self.entries) >= self.max_entries:
+            self.entries = {k: e for k, e in self.entries.items() if e.stale_until > now}
+            if len(self.entries) >= self.max_entries:
+                # Drop the oldest entry (dicts keep insertion order)
+                self.entries.pop(next(iter(self.entries)))
+        self.entries[key] = entry
+        return entry
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
+
+
+upstream_dns = DNSCache(UPSTREAM_DNS_TTL, UPSTREAM_DNS_STALE_TTL, UPSTREAM_DNS_NEGATIVE_TTL, UPSTREAM_DNS_TIMEOUT)
+
+
+async def resolve_upstream(url: str) -> tuple[str, dict[str, Any]]:
+    """Swap the hostname in an upstream URL for a cached address.
+
+    Returns the URL to connect to and the httpx request extensions to send with
+    it. The caller keeps the Host header; for https the hostname is passed as the
+    SNI name, so certificates are still checked against it.
+    """
+    parts = urlsplit(url)
+    host = parts.hostname
+    if not UPSTREAM_DNS_TTL or not host or parts.username is not None:
+        return url, {}
+    try:
+        ipaddress.ip_address(host)
+        return url, {}
+    except ValueError:
+        pass
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    address = await upstream_dns.resolve(host, port)
+    netloc = f"[{address}]" if ":" in address else address
+    if parts.port:
+        netloc = f"{netloc}:{parts.port}"
+    extensions = {"sni_hostname": host} if parts.scheme == "https" else {}
+    return parts._replace(netloc=netloc).geturl(), extensions
+
+
+class ProxyStreamingResponse(StreamingResponse):
+    """StreamingResponse that always runs its cleanup callback.
+
+    A generator's ``finally`` block never runs if the client disconnects before
+    the first chunk is pulled, so cleanup is tied to the ASGI call as well.
+    """
+
+    def __init__(self, content: Any, on_close: Callable[[], Awaitable[None]], **kwargs: Any):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
+
+
+# One TLS context shared by every upstream client. Building one loads the CA bundle,
+# which takes tens of milliseconds on the event loop, so it must not happen per request.
+upstream_ssl_context = httpx.create_ssl_context()
+
+
 # HTTP proxy handler with WebSocket upgrade support
-async def proxy_request(request: Request, dest_url: str, path: str, mapping_url: str = "", username: str = ""):
+async def proxy_request(
+    request: Request,
+    dest_url: str,
+    path: str,
+    mapping_url: str = "",
+    username: str = "",
+    on_complete: Callable[[], None] | None = None,
+    mapping: dict[str, Any] | None = None,
+    trace: RequestTrace | None = None,
+):
+    trace = trace or RequestTrace(None)
+
     # Check if this is a WebSocket upgrade request
     upgrade_header = request.headers.get("upgrade", "").lower()
     connection_header = request.headers.get("connection", "").lower()
 
     if upgrade_header == "websocket" and "upgrade" in connection_header:
         # Handle WebSocket upgrade
-        return await handle_websocket_upgrade(request, dest_url, path)
+        return await handle_websocket_upgrade(request, dest_url, path, on_complete)
 
     # Regular HTTP proxy
+    base_url, socket_path = parse_upstream(dest_url)
     headers = {k: v for k, v in request.headers.items() if k.lower() not in ("host", "connection", "upgrade")}
-    headers["Host"] = dest_url.split("://")[1].split("/")[0]
-
-    full_url = dest_url.rstrip("/") + "/" + path.lstrip("/")
+    headers["Host"] = urlsplit(base_url).netloc
+
+    full_url = base_url.rstrip("/") + "/" + path.lstrip("/")
+    upstream_span = trace.start("upstream", kind=SPAN_KIND_CLIENT)
+    upstream_span["attributes"]["url.full"] = full_url
+    if span_exporter is not None:
+        headers["traceparent"] = trace.traceparent(upstream_span)
+    extensions: dict[str, Any] = {"trace": trace.httpx_hook(upstream_span)} if trace.sampled else {}
+    client: httpx.AsyncClient | None = None
+    resp: httpx.Response | None = None
+    # Once the response exists, it owns the upstream connection and the admission slot
+    response: ProxyStreamingResponse | None = None
     try:
         logging.debug(f"Proxying {request.method} request to: {full_url}")
 
         # Create a client that will stay open during streaming
-        client = httpx.AsyncClient(timeout=300.0)
+        transport = httpx.AsyncHTTPTransport(uds=socket_path, verify=upstream_ssl_context) if socket_path else None
+        client = httpx.AsyncClient(timeout=300.0, transport=transport, verify=upstream_ssl_context)
+        if socket_path:
+            connect_url = full_url
+        else:
+            connect_url, dns_extensions = await resolve_upstream(full_url)
+            extensions |= dns_extensions
 
         # Prepare request based on method
         body_bytes = 0
         if request.method == "GET":
-            req = client.build_request("GET", full_url, headers=headers, params=request.query_params)
+            req = client.build_request(
+                "GET", connect_url, headers=headers, params=request.query_params, extensions=extensions
+            )
         elif request.method == "POST":
             body = await request.body()
             body_bytes = len(body)
             req = client.build_request(
                 "POST",
-                full_url,
+                connect_url,
                 headers=headers,
                 content=body,
                 params=request.query_params,
+                extensions=extensions,
             )
         else:
-            await client.aclose()
             raise HTTPException(status_code=405, detail="Method not allowed")
 
         # Send request with streaming enabled
         resp = await client.send(req, stream=True)
+        upstream, upstream_client = resp, client
+        upstream_span["attributes"]["http.response.status_code"] = resp.status_code
+        stream_span = trace.start("stream", upstream_span)
 
         # Filter out headers that can cause decoding issues
         response_headers = {
@@ -682,6 +3182,8 @@ async def proxy_request(request: Request, dest_url: str, path: str, mapping_url:
         content_type = (resp.headers.get("content-type") or "").lower()
         is_sse = "text/event-stream" in content_type
 
+        buckets = get_bandwidth_buckets(mapping, username) if mapping and username else []
+
         # Track bytes received and batch threshold for incremental updates
         bytes_received = 0
         bytes_since_last_update = 0
@@ -691,84 +3193,142 @@ async def proxy_request(request: Request, dest_url: str, path: str, mapping_url:
         if mapping_url and username:
             update_metrics(mapping_url, username, bytes_sent=body_bytes, increment_request=True)
 
+        closed = False
+
+        async def close_upstream():
+            nonlocal bytes_since_last_update, closed
+            if closed:
+                return
+            closed = True
+            try:
+                await upstream.aclose()
+                await upstream_client.aclose()
+            finally:
+                # Record any remaining bytes not yet recorded
+                if mapping_url and username and bytes_since_last_update > 0:
+                    update_metrics(mapping_url, username, bytes_received=bytes_since_last_update)
+                    bytes_since_last_update = 0
+                if on_complete:
+                    on_complete()
+                trace.end(stream_span, **{"revproxauth.bytes_received": bytes_received})
+                trace.end(upstream_span)
+                trace.finish(**{"http.response.status_code": resp.status_code})
+
         async def generate():
             nonlocal bytes_received, bytes_since_last_update
             try:
                 if is_sse:
                     # aiter_lines yields text without newline; re-add newline and
                     # encode to bytes for StreamingResponse.
-                    async for line in resp.aiter_lines():
-                        chunk = (line + "\n").encode("utf-8")
-                        chunk_size = len(chunk)
-                        bytes_received += chunk_size
-                        bytes_since_last_update += chunk_size
-
-                        # Update metrics incrementally when batch threshold reached
-                        if mapping_url and username and bytes_since_last_update >= update_batch_size:
-                            update_metrics(mapping_url, username, bytes_received=bytes_since_last_update)
-                            bytes_since_last_update = 0
-
-                        yield chunk
+                    chunks = ((line + "\n").encode("utf-8") async for line in resp.aiter_lines())
                 else:
-                    async for chunk in resp.aiter_bytes(chunk_size=8192):
-                        chunk_size = len(chunk)
-                        bytes_received += chunk_size
-                        bytes_since_last_update += chunk_size
+                    chunks = resp.aiter_bytes(chunk_size=8192)
+                async for chunk in chunks:
+                    chunk_size = len(chunk)
+                    bytes_received += chunk_size
+                    bytes_since_last_update += chunk_size
+
+                    # Update metrics incrementally when batch threshold reached
+                    if mapping_url and username and bytes_since_last_update >= update_batch_size:
+                        update_metrics(mapping_url, username, bytes_received=bytes_since_last_update)
+                        bytes_since_last_update = 0
+                        if mapping and quota_retry_after(mapping, username) is not None:
+                            logging.warning(
+                                f"Byte quota exhausted for user '{username}' on {mapping_url}; cutting stream"
+                            )
+                            break
 
-                        # Update metrics incrementally when batch threshold reached
-                        if mapping_url and username and bytes_since_last_update >= update_batch_size:
-                            update_metrics(mapping_url, username, bytes_received=bytes_since_last_update)
-                            bytes_since_last_update = 0
+                    # Pace the stream to the configured bandwidth caps
+                    for bucket in buckets:
+                        await bucket.consume(chunk_size)
 
-                        yield chunk
+                    yield chunk
             finally:
-                await resp.aclose()
-                await client.aclose()
-                # Record any remaining bytes not yet recorded
-                if mapping_url and username and bytes_since_last_update > 0:
-                    update_metrics(mapping_url, username, bytes_received=bytes_since_last_update)
+                await close_upstream()
 
-        return StreamingResponse(
+        response = ProxyStreamingResponse(
             generate(),
+            on_close=close_upstream,
             status_code=resp.status_code,
             headers=response_headers,
             media_type=resp.headers.get("content-type"),
         )
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
+        trace.end(upstream_span, error=True, **{"exception.type": type(e).__name__})
         logging.error(f"Proxy error for {request.method} {full_url}: {type(e).__name__}: {str(e)}")
         logging.exception("Full proxy error traceback:")
         raise HTTPException(status_code=500, detail=str(e)) from e
+    finally:
+        if response is None:
+            # Rejected, failed or cancelled (the client went away) before there was a
+            # response to clean up after it, so free the connection and slot here
+            if resp is not None:
+                await resp.aclose()
+            if client is not None:
+                await client.aclose()
+            if on_complete:
+                on_complete()
+
+
+# Headers of the client's own WebSocket handshake; the connection to the backend makes its own
+WEBSOCKET_HANDSHAKE_HEADERS = frozenset(
+    {
+        "host",
+        "connection",
+        "upgrade",
+        "content-length",
+        "sec-websocket-key",
+        "sec-websocket-version",
+        "sec-websocket-extensions",
+        "sec-websocket-protocol",
+    }
+)
 
 
-# WebSocket upgrade handler using httpx for upgrade
-async def handle_websocket_upgrade(request: Request, dest_url: str, path: str):
-    import asyncio
-
+# WebSocket upgrade handler: relays messages between the client and a websockets connection to the backend
+async def handle_websocket_upgrade(
+    request: HTTPConnection, dest_url: str, path: str, on_complete: Callable[[], None] | None = None
+):
     from starlette.responses import Response
-    from starlette.types import Receive, Scope, Send
 
     # Build WebSocket URL from HTTP URL
-    full_url = dest_url.rstrip("/") + "/" + path.lstrip("/")
+    base_url, socket_path = parse_upstream(dest_url)
+    full_url = base_url.rstrip("/") + "/" + path.lstrip("/")
     ws_url = full_url.replace("http://", "ws://").replace("https://", "wss://")
-    logging.info(f"WebSocket upgrade request to: {ws_url}")
+    if request.url.query:
+        ws_url += f"?{request.url.query}"
+    logging.info(f"WebSocket upgrade request to: {ws_url}{f' via {socket_path}' if socket_path else ''}")
 
-    # Forward all WebSocket-related headers
-    headers = {}
-    for k, v in request.headers.items():
-        if k.lower() not in ("host",):
-            headers[k] = v
-    headers["Host"] = dest_url.split("://")[1].split("/")[0]
+    # Forward the client's headers, except those of its own handshake (Host comes from ws_url)
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in WEBSOCKET_HANDSHAKE_HEADERS}
+    subprotocols = [p.strip() for p in request.headers.get("sec-websocket-protocol", "").split(",") if p.strip()]
 
     async def websocket_proxy(scope: Scope, receive: Receive, send: Send):
         import websockets
 
         try:
+            # The client's User-Agent is forwarded with the other headers
+            options: dict[str, Any] = {
+                "additional_headers": headers,
+                "subprotocols": subprotocols or None,
+                "user_agent_header": None,
+            }
+            if ws_url.startswith("wss://"):
+                options["ssl"] = upstream_ssl_context
+            if socket_path:
+                connection = websockets.unix_connect(socket_path, ws_url, **options)
+            else:
+                connection = websockets.connect(ws_url, **options)
             # Connect to backend WebSocket
-            async with websockets.connect(ws_url, extra_headers=headers) as backend_ws:
-                # Accept the client connection
+            async with connection as backend_ws:
+                # Accept the client connection with the subprotocol the backend chose
                 await send(
                     {
                         "type": "websocket.accept",
+                        "subprotocol": backend_ws.subprotocol,
                     }
                 )
 
@@ -807,13 +3367,31 @@ async def handle_websocket_upgrade(request: Request, dest_url: str, path: str):
                     except Exception as e:
                         logging.error(f"Backend to client error: {str(e)}")
 
-                # Run both tasks concurrently
-                await asyncio.gather(client_to_backend(), backend_to_client(), return_exceptions=True)
+                # Relay until either side ends, then stop the other pump. Waiting for both would
+                # hold the admission slot, task and socket of an abandoned client until the
+                # backend happens to close.
+                client_pump = asyncio.create_task(client_to_backend())
+                backend_pump = asyncio.create_task(backend_to_client())
+                try:
+                    done, _ = await asyncio.wait({client_pump, backend_pump}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    for pump in (client_pump, backend_pump):
+                        pump.cancel()
+                    await asyncio.gather(client_pump, backend_pump, return_exceptions=True)
+                if client_pump not in done:
+                    # The backend closed first: pass its close code on to the client. 1005 and 1006
+                    # only describe a missing or dropped close frame and must not be sent.
+                    code = {None: 1000, 1005: 1000, 1006: 1011}.get(backend_ws.close_code, backend_ws.close_code)
+                    with suppress(Exception):
+                        await send({"type": "websocket.close", "code": code})
 
         except Exception as e:
             logging.error(f"WebSocket upgrade error for {ws_url}: {type(e).__name__}: {str(e)}")
             logging.exception("Full WebSocket error traceback:")
             await send({"type": "websocket.close", "code": 1011, "reason": str(e)})
+        finally:
+            if on_complete:
+                on_complete()
 
     # Return a custom response that handles WebSocket at ASGI level
     class WebSocketProxyResponse(Response):
@@ -826,104 +3404,143 @@ async def handle_websocket_upgrade(request: Request, dest_url: str, path: str):
     return WebSocketProxyResponse()
 
 
-# Catch-all route for proxying (handles both HTTP and WebSocket upgrades)
+@app.websocket("/{full_path:path}")
+async def handle_websocket(websocket: WebSocket, full_path: str = ""):
+    """Proxy a WebSocket connection with the same mapping, authorization and admission checks as HTTP.
+
+    Refused connections are closed before the handshake completes, which clients see as HTTP 403.
+    """
+    host = websocket.headers.get("host", "").lower().split(":")[0]
+    request_path = f"/{full_path}".rstrip("/") if full_path else "/"
+    identity: Identity | None = websocket.state.identity
+    username = identity.username if identity else "anonymous"
+    route = config_store.snapshot().match(host, request_path)
+    if route is None or identity is None or route.match_url not in identity.allowed_urls:
+        logging.warning(f"WebSocket refused: {host}{request_path} for user '{username}'")
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if quota_retry_after(route.mapping, username) is not None:
+        logging.warning(f"Byte quota exhausted for user '{username}' on mapping {route.index} ({route.match_url})")
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    admission = get_admission_controller(route.mapping)
+    try:
+        await admission.acquire()
+    except AdmissionRejectedError as e:
+        logging.warning(f"Shedding WebSocket for mapping {route.index} ({route.match_url}): {e.reason}")
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    logging.info(f"WebSocket granted: user '{username}' authorized for mapping {route.index} ({route.match_url})")
+    update_metrics(route.match_url, username, increment_request=True)
+    response = await handle_websocket_upgrade(
+        websocket, route.mapping["http_dest"], route.target_path(full_path), admission.release
+    )
+    await response(websocket.scope, websocket.receive, websocket.send)
+
+
+# Catch-all route for proxying (WebSocket connections are handled by handle_websocket)
 @app.api_route(
     "/{full_path:path}",
     methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS", "HEAD"],
 )
 async def handle_request(request: Request, full_path: str = ""):
+    trace = RequestTrace(request.headers.get("traceparent"))
+    try:
+        response = await route_request(request, full_path, trace)
+    except HTTPException as e:
+        trace.finish(**{"http.response.status_code": e.status_code})
+        raise
+    except Exception:
+        trace.finish(error=True)
+        raise
+    # Streamed proxy responses finish their trace when the stream closes
+    if not isinstance(response, ProxyStreamingResponse):
+        trace.finish(**{"http.response.status_code": response.status_code})
+    return response
+
+
+async def route_request(request: Request, full_path: str, trace: RequestTrace):
     host_header = request.headers.get("host", "").lower()
     # Strip port number from host header for matching
     host_without_port = host_header.split(":")[0] if ":" in host_header else host_header
     request_path = f"/{full_path}".rstrip("/") if full_path else "/"
-    username = get_username_from_cookie(request)
+    identity: Identity | None = request.state.identity
+    username = identity.username if identity else ""
     logging.info(
         f"Access attempt: {request.method} {host_without_port}{request_path} by user '{username or 'anonymous'}'"
     )
+    trace.root["attributes"].update(
+        {"http.request.method": request.method, "server.address": host_without_port, "url.path": request_path}
+    )
 
-    # Check mappings (reload on each request to pick up changes)
-    for idx, mapping in enumerate(load_mappings()):
-        flags = mapping.get("flags", [])
-
-        # Skip disabled mappings
-        if "disabled" in flags:
-            continue
-
-        match_url = mapping.get("match_url", "")
-        http_dest = mapping.get("http_dest", "")
-        strip_path = "strip_path" in flags
-
-        if not http_dest or not match_url:
-            continue
-
-        # Parse match_url into host and path components
-        # Format can be: "host.com" or "host.com/path" or "/path"
-        if "/" in match_url:
-            parts = match_url.split("/", 1)
-            host = parts[0] if parts[0] else ""
-            path = parts[1] if len(parts) > 1 else ""
-        else:
-            host = match_url
-            path = ""
-
-        # Match host and path
-        host_matches = (not host) or (host == host_without_port)
-        path_matches = (not path) or request_path.startswith(f"/{path}")
+    # Check enabled mappings in order (the route table is rebuilt when the config changes)
+    route_span = trace.start("route_match")
+    route = config_store.snapshot().match(host_without_port, request_path)
+    if route is None:
+        raise HTTPException(status_code=404, detail="App not found")
+    idx, mapping, match_url = route.index, route.mapping, route.match_url
+    http_dest: str = mapping["http_dest"]
+    trace.end(route_span, **{"revproxauth.mapping": match_url})
+    trace.root["attributes"]["revproxauth.mapping"] = match_url
+
+    # The session was verified by AuthContextMiddleware; a missing, expired or
+    # invalid authz token means the user has to log in again
+    if identity is None:
+        # Use full_path (without root_path prefix) for the next parameter
+        next_url = f"/{full_path}" if full_path else "/"
+        login_url = get_login_url(request, next_url)
+        return RedirectResponse(url=login_url, status_code=status.HTTP_302_FOUND)
 
-        logging.info(
-            f"Checking mapping {idx} ({match_url}): host_match={host_matches} ({host_without_port}={host}), "
-            f"path_match={path_matches} (request={request_path}, pattern=/{path})"
+    authorize_span = trace.start("authorize")
+    if match_url not in identity.allowed_urls:
+        trace.end(authorize_span, error=True)
+        logging.warning(f"Access denied: user '{username}' not authorized for mapping '{match_url}'")
+        raise HTTPException(status_code=403, detail="Access to this mapping is restricted")
+    logging.info(f"Access granted: user '{username}' authorized for mapping {idx} ({match_url})")
+    trace.end(authorize_span)
+    trace.root["attributes"]["enduser.id"] = username
+
+    # Determine target path, stripping the mapping's path if configured
+    target_path = route.target_path(full_path)
+
+    if ACCEL_REDIRECT_LOCATION and request.method in ("GET", "HEAD"):
+        # nginx fetches the upstream itself; byte quotas and bandwidth limits do not apply
+        update_metrics(match_url, username, increment_request=True)
+        return accel_redirect_response(http_dest, target_path, request.url.query, username, match_url)
+
+    retry_after = quota_retry_after(mapping, username)
+    if retry_after is not None:
+        logging.warning(f"Byte quota exhausted for user '{username}' on mapping {idx} ({match_url})")
+        raise HTTPException(
+            status_code=429,
+            detail="Transfer quota exceeded",
+            headers={"Retry-After": str(retry_after)},
         )
 
-        if host_matches and path_matches:
-            # Check authentication
-            if "auth=authenticated" not in request.headers.get("cookie", ""):
-                # Use full_path (without root_path prefix) for the next parameter
-                next_url = f"/{full_path}" if full_path else "/"
-                login_url = get_login_url(request, next_url)
-                return RedirectResponse(url=login_url, status_code=status.HTTP_302_FOUND)
-
-            # Validate the stateless authz JWT and ensure this mapping index
-            # is present in the token's allowed mapping list. If the token is
-            # missing, expired or invalid, redirect to login so the user can
-            # reauthenticate and receive a fresh token.
-            token = request.cookies.get(AUTHZ_COOKIE_NAME)
-            if not token:
-                next_url = f"/{full_path}" if full_path else "/"
-                login_url = get_login_url(request, next_url)
-                return RedirectResponse(url=login_url, status_code=status.HTTP_302_FOUND)
-
-            try:
-                payload = cast(dict[str, Any], jwt.decode(token, SESSION_SECRET, algorithms=["HS256"]))
-                logging.debug(f"JWT payload for user '{payload.get('u')}': allowed mappings {payload.get('m', [])}")
-            except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
-                # Token is either expired or invalid - force login
-                next_url = f"/{full_path}" if full_path else "/"
-                login_url = get_login_url(request, next_url)
-                return RedirectResponse(url=login_url, status_code=status.HTTP_302_FOUND)
-
-            allowed_urls: list[str] = (
-                cast(list[str], payload.get("m", [])) if isinstance(payload.get("m", []), list) else []
-            )
-            if match_url not in allowed_urls:
-                logging.warning(
-                    f"Access denied: user '{payload.get('u')}' not authorized for mapping '{mapping.get('match_url')}'"
-                )
-                raise HTTPException(status_code=403, detail="Access to this mapping is restricted")
-            logging.info(
-                f"Access granted: user '{payload.get('u')}' authorized for mapping {idx} ({mapping.get('match_url')})"
-            )
-
-            # Determine target path
-            target_path = f"/{full_path}" if full_path else "/"
-
-            # Strip the path portion if configured
-            if strip_path and path:
-                prefix_to_strip = f"/{path}"
-                if target_path.startswith(prefix_to_strip):
-                    target_path = target_path[len(prefix_to_strip) :] or "/"
-
-            # Proxy HTTP or WebSocket upgrade - pass the modified path and metrics info
-            return await proxy_request(request, http_dest, target_path, match_url, payload.get("u", ""))
-
-    raise HTTPException(status_code=404, detail="App not found")
+    # Wait for a free upstream slot so one slow mapping cannot starve the others
+    admission = get_admission_controller(mapping)
+    admission_span = trace.start("admission_wait")
+    try:
+        await admission.acquire()
+    except AdmissionRejectedError as e:
+        trace.end(admission_span, error=True, **{"revproxauth.shed_reason": e.reason})
+        logging.warning(f"Shedding request for mapping {idx} ({match_url}): {e.reason}")
+        raise HTTPException(
+            status_code=503,
+            detail="Upstream is busy, please retry later",
+            headers={"Retry-After": str(UPSTREAM_RETRY_AFTER)},
+        ) from None
+    trace.end(admission_span)
+
+    # Proxy HTTP or WebSocket upgrade - pass the modified path and metrics info
+    return await proxy_request(
+        request,
+        http_dest,
+        target_path,
+        match_url,
+        username,
+        on_complete=admission.release,
+        mapping=mapping,
+        trace=trace,
+    )
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "fastapi",
+#     "uvicorn",
+#     "pyrad",
+#     "jinja2",
+#     "httpx",
+#     "websockets",
+#     "python-multipart",
+#     "PyJWT",
+#     "psutil",
+# ]
+# ///
+
+"""
+Comparative benchmark of the auth backends in this repo.
+
+Runs each backend from the working tree against the stub RADIUS responder (see
+stubs.py), one at a time and as a single process, and measures:
+
+- login: logins of distinct users through RADIUS (RPS, latency, CPU)
+- memory: RSS growth per 100k live sessions, from the sessions created by the logins
+- auth_valid: forward-auth checks with a random one of those sessions
+- auth_anonymous: forward-auth checks without a session (the 401 path)
+
+Backends: revproxauth (its /revproxauth/auth endpoint), radius-auth-py with the
+in-memory and the signed-cookie session backends, and radius-auth-go (built with
+`go build`; skipped when Go or its modules are unavailable).
+
+    uv run tools/bench/bench_auth.py run --output auth-$(git rev-parse --short HEAD).json
+    uv run tools/bench/bench_auth.py report auth-abc123.json > auth-report.md
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime
+from http.cookiejar import DefaultCookiePolicy
+from pathlib import Path
+from typing import Any
+
+import httpx
+import psutil
+from bench_proxy import ResourceSampler, drive, percentile
+from stubs import (
+    DICTIONARY,
+    ROOT,
+    SOAK_PASSWORD,
+    free_port,
+    git_commit,
+    spawn_revproxauth,
+    spawn_stub,
+    stop_processes,
+    wait_for_http,
+)
+
+SECRET = "bench-secret"
+RADIUS_AUTH_PY_DIR = ROOT / "apps" / "radius-auth-py"
+RADIUS_AUTH_GO_DIR = ROOT / "apps" / "radius-auth-go"
+
+# name -> description
+BACKENDS: dict[str, str] = {
+    "revproxauth": "revproxauth built-in login, JWT sessions, /revproxauth/auth",
+    "radius-auth-py": "radius-auth-py, in-memory sessions",
+    "radius-auth-py-signed": "radius-auth-py, stateless signed-cookie sessions",
+    "radius-auth-go": "radius-auth-go, in-memory sessions",
+}
+
+
+class Backend:
+    """How to start one auth backend and talk to it."""
+
+    def __init__(self, name: str, port: int, process: subprocess.Popen[bytes]):
+        self.name = name
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.process = process
+        if name == "revproxauth":
+            self.login_path, self.auth_path, self.cookie = "/login", "/revproxauth/auth", "authz"
+            # Forward auth matches the original request against the mappings
+            self.auth_headers = {"X-Forwarded-Host": "127.0.0.1", "X-Forwarded-Uri": "/"}
+        else:
+            self.login_path, self.auth_path, self.cookie = "/do-login", "/auth", "session_id"
+            self.auth_headers = {}
+
+
+def spawn_backend(
+    name: str, port: int, radius_port: int, workdir: Path, args: argparse.Namespace
+) -> subprocess.Popen[bytes]:
+    radius_env = {
+        "RADIUS_SERVER": "127.0.0.1",
+        "RADIUS_SECRET": SECRET,
+        "RADIUS_PORT": str(radius_port),
+        "RADIUS_DICTIONARY": str(DICTIONARY),
+        # Answer 401 rather than a redirect, as behind nginx auth_request
+        "PROXY_TYPE": "nginx",
+        # Every login comes from one IP for a handful of seconds; measure the backend, not the throttle
+        "LOGIN_USER_LIMIT": "0",
+        "LOGIN_IP_LIMIT": "0",
+    }
+    if name == "revproxauth":
+        config_file = workdir / "revproxauth.json"
+        # Forward auth only matches the mapping; nothing is proxied to http_dest
+        mapping = {
+            "match_url": "127.0.0.1",
+            "http_dest": "http://127.0.0.1:9",
+            "flags": [],
+            "allowed_users": [],
+            "allowed_groups": [],
+        }
+        config_file.write_text(json.dumps({"version": "1.0", "mappings": [mapping]}, indent=2))
+        return spawn_revproxauth(
+            port,
+            config_file,
+            radius_port,
+            SECRET,
+            workdir / f"{name}.log",
+            {**radius_env, "LOG_LEVEL": args.log_level, "REVOCATION_FILE": str(workdir / "revocations.json")},
+        )
+    log = open(workdir / f"{name}.log", "wb")  # noqa: SIM115
+    if name.startswith("radius-auth-py"):
+        env = {
+            **os.environ,
+            **radius_env,
+            "SESSION_MAX": str(max(args.sessions * 2, 100000)),
+            "AUTH_LOG_SAMPLE_RATE": str(args.log_sample_rate),
+        }
+        if name == "radius-auth-py-signed":
+            env |= {"SESSION_BACKEND": "signed", "SESSION_KEYS": "bench:bench-signing-key"}
+        return subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "auth:app", "--host", "127.0.0.1", "--port", str(port), "--workers", "1"],
+            cwd=RADIUS_AUTH_PY_DIR,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    binary = workdir / "radius-auth-go"
+    return subprocess.Popen(
+        [str(binary)], env={**os.environ, **radius_env, "PORT": str(port)}, stdout=log, stderr=subprocess.STDOUT
+    )
+
+
+def build_go(workdir: Path) -> str | None:
+    """Build radius-auth-go into workdir; returns why it could not be built, or None."""
+    if shutil.which("go") is None:
+        return "go toolchain not found"
+    result = subprocess.run(
+        ["go", "build", "-o", str(workdir / "radius-auth-go"), "."],
+        cwd=RADIUS_AUTH_GO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return f"go build failed: {result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'unknown'}"
+    return None
+
+
+def summarize(
+    latencies: list[float], errors: int, elapsed: float, cpu_seconds: float, concurrency: int
+) -> dict[str, Any]:
+    count = len(latencies)
+    return {
+        "concurrency": concurrency,
+        "requests": count,
+        "errors": errors,
+        "rps": count / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "cpu_ms_per_request": cpu_seconds / count * 1000 if count else 0.0,
+    }
+
+
+async def create_sessions(
+    backend: Backend, client: httpx.AsyncClient, count: int, concurrency: int
+) -> tuple[list[str], list[float], int, float]:
+    """Log in `count` distinct users; returns (session cookies, latencies, errors, elapsed)."""
+    sessions: list[str] = []
+    latencies: list[float] = []
+    errors = 0
+    next_user = iter(range(count))
+
+    async def worker() -> None:
+        nonlocal errors
+        for n in next_user:
+            started = time.perf_counter()
+            try:
+                resp = await client.post(
+                    f"{backend.base_url}{backend.login_path}",
+                    data={"username": f"soak-{n}", "password": SOAK_PASSWORD, "next": "/"},
+                    follow_redirects=False,
+                )
+                token = resp.cookies.get(backend.cookie)
+                if resp.status_code != 303 or not token:
+                    raise RuntimeError(f"login failed with {resp.status_code}")
+                latencies.append(time.perf_counter() - started)
+                sessions.append(token)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return sessions, latencies, errors, time.perf_counter() - started
+
+
+def auth_operation(
+    backend: Backend, client: httpx.AsyncClient, sessions: list[str], expected: int
+) -> Callable[[], Awaitable[int]]:
+    url = f"{backend.base_url}{backend.auth_path}"
+
+    async def check() -> int:
+        headers = dict(backend.auth_headers)
+        if sessions:
+            headers["Cookie"] = f"{backend.cookie}={random.choice(sessions)}"
+        resp = await client.get(url, headers=headers)
+        if resp.status_code != expected:
+            raise RuntimeError(f"auth check returned {resp.status_code}")
+        return 0
+
+    return check
+
+
+async def measure(backend: Backend, args: argparse.Namespace) -> dict[str, Any]:
+    process = psutil.Process(backend.process.pid)
+    limits = httpx.Limits(max_connections=256, max_keepalive_connections=256)
+    async with httpx.AsyncClient(timeout=60.0, limits=limits) as client:
+        # Sessions are sent explicitly; the jar must not carry one login's cookie into the next request
+        client.cookies.jar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        # Warm up code paths before taking the memory baseline
+        warm, _, _, _ = await create_sessions(backend, client, 20, 4)
+        await drive(auth_operation(backend, client, warm, 200), 4, args.warmup)
+        rss_before = process.memory_info().rss
+
+        sampler = ResourceSampler(backend.process.pid)
+        sampler.start()
+        sessions, latencies, errors, elapsed = await create_sessions(
+            backend, client, args.sessions, args.login_concurrency
+        )
+        cpu_seconds, _ = await sampler.stop()
+        results: dict[str, Any] = {"login": summarize(latencies, errors, elapsed, cpu_seconds, args.login_concurrency)}
+        print_row(backend.name, "login", results["login"])
+
+        # Present every session once so per-session caches are populated too
+        for start in range(0, len(sessions), 256):
+            await asyncio.gather(
+                *(
+                    client.get(
+                        f"{backend.base_url}{backend.auth_path}",
+                        headers={**backend.auth_headers, "Cookie": f"{backend.cookie}={token}"},
+                    )
+                    for token in sessions[start : start + 256]
+                )
+            )
+        rss_after = process.memory_info().rss
+        results["memory"] = {
+            "sessions": len(sessions),
+            "rss_before_mb": rss_before / 1024 / 1024,
+            "rss_after_mb": rss_after / 1024 / 1024,
+            "mb_per_100k_sessions": (rss_after - rss_before) / 1024 / 1024 / len(sessions) * 100000
+            if sessions
+            else 0.0,
+        }
+
+        for scenario, pool, expected in (("auth_valid", sessions, 200), ("auth_anonymous", [], 401)):
+            operation = auth_operation(backend, client, pool, expected)
+            sampler = ResourceSampler(backend.process.pid)
+            sampler.start()
+            latencies, errors, _, elapsed = await drive(operation, args.concurrency, args.duration)
+            cpu_seconds, _ = await sampler.stop()
+            results[scenario] = summarize(latencies, errors, elapsed, cpu_seconds, args.concurrency)
+            print_row(backend.name, scenario, results[scenario])
+        print(f"{backend.name:<24}{'memory':<16}{results['memory']['mb_per_100k_sessions']:>9.1f} MB per 100k sessions")
+        return results
+
+
+def print_header() -> None:
+    print(f"{'backend':<24}{'scenario':<16}{'rps':>9}{'p50 ms':>9}{'p99 ms':>9}{'err':>6}{'cpu ms/req':>11}")
+
+
+def print_row(backend: str, scenario: str, r: dict[str, Any]) -> None:
+    print(
+        f"{backend:<24}{scenario:<16}{r['rps']:>9.1f}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['errors']:>6}"
+        f"{r['cpu_ms_per_request']:>11.3f}",
+        flush=True,
+    )
+
+
+def run(args: argparse.Namespace) -> None:
+    workdir = Path(tempfile.mkdtemp(prefix="auth-bench-"))
+    radius_port = free_port()
+    radius = spawn_stub(
+        "radius",
+        "--port",
+        str(radius_port),
+        "--secret",
+        SECRET,
+        "--delay",
+        str(args.radius_delay),
+        log_path=workdir / "radius.log",
+    )
+    print(f"Benchmarking commit {git_commit()} (logs in {workdir})")
+    print_header()
+    backends: dict[str, Any] = {}
+    try:
+        for name in args.backends:
+            if name == "radius-auth-go":
+                problem = build_go(workdir)
+                if problem:
+                    print(f"{name:<24}skipped: {problem}")
+                    backends[name] = {"skipped": problem}
+                    continue
+            port = free_port()
+            process = spawn_backend(name, port, radius_port, workdir, args)
+            backend = Backend(name, port, process)
+            try:
+                wait_for_http(f"{backend.base_url}/login")
+                backends[name] = asyncio.run(measure(backend, args))
+            finally:
+                stop_processes([process])
+    finally:
+        stop_processes([radius])
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": psutil.cpu_count(),
+        "settings": {
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "login_concurrency": args.login_concurrency,
+            "sessions": args.sessions,
+            "log_level": args.log_level,
+            "log_sample_rate": args.log_sample_rate,
+            "radius_delay": args.radius_delay,
+        },
+        "backends": backends,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"Results written to {args.output}")
+
+
+def report(args: argparse.Namespace) -> None:
+    """Print a Markdown comparison of one run."""
+    data = json.loads(Path(args.results).read_text())
+    settings = data["settings"]
+    print(f"# Auth backend comparison ({data['commit']})\n")
+    print(
+        f"{data['timestamp']}, Python {data['python']}, {data['cpu_count']} CPUs. Each backend runs as one process; "
+        f"{settings['sessions']} logins at concurrency {settings['login_concurrency']}, "
+        f"auth checks for {settings['duration']:g}s at concurrency {settings['concurrency']}.\n"
+    )
+    measured = {name: r for name, r in data["backends"].items() if "skipped" not in r}
+    print(
+        "| Backend | Login RPS | Login p99 ms | Auth RPS | Auth p50 ms | Auth p99 ms | Auth CPU ms/req "
+        "| Anonymous RPS | MB per 100k sessions |"
+    )
+    print("|---|---:|---:|---:|---:|---:|---:|---:|---:|")
+    for name, r in measured.items():
+        login, valid, anonymous = r["login"], r["auth_valid"], r["auth_anonymous"]
+        errors = sum(r[s]["errors"] for s in ("login", "auth_valid", "auth_anonymous"))
+        print(
+            f"| {name}{f' ({errors} errors)' if errors else ''} | {login['rps']:.0f} | {login['p99_ms']:.1f} "
+            f"| {valid['rps']:.0f} | {valid['p50_ms']:.2f} | {valid['p99_ms']:.2f} "
+            f"| {valid['cpu_ms_per_request']:.3f} | {anonymous['rps']:.0f} "
+            f"| {r['memory']['mb_per_100k_sessions']:.1f} |"
+        )
+    for name, r in data["backends"].items():
+        if "skipped" in r:
+            print(f"\n{name} was skipped: {r['skipped']}")
+    if measured:
+        fastest = max(measured, key=lambda n: measured[n]["auth_valid"]["rps"])
+        cheapest = min(measured, key=lambda n: measured[n]["auth_valid"]["cpu_ms_per_request"])
+        print(f"\nHighest auth throughput: **{fastest}**; least CPU per auth check: **{cheapest}**.")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="Benchmark the auth backends")
+    run_parser.add_argument("--backends", nargs="+", choices=list(BACKENDS), default=list(BACKENDS))
+    run_parser.add_argument("--sessions", type=int, default=20000, help="Logins (and live sessions) per backend")
+    run_parser.add_argument("--duration", type=float, default=10.0, help="Seconds per auth scenario")
+    run_parser.add_argument("--warmup", type=float, default=2.0, help="Warm-up seconds per backend")
+    run_parser.add_argument("--concurrency", type=int, default=32, help="Concurrent auth checks")
+    run_parser.add_argument("--login-concurrency", type=int, default=16, help="Concurrent logins")
+    run_parser.add_argument("--log-level", default="INFO", help="LOG_LEVEL for revproxauth")
+    run_parser.add_argument(
+        "--log-sample-rate", type=float, default=1.0, help="AUTH_LOG_SAMPLE_RATE for radius-auth-py"
+    )
+    run_parser.add_argument("--radius-delay", type=float, default=0.0, help="Stub RADIUS reply delay in seconds")
+    run_parser.add_argument("--output", help="Write JSON results to this file")
+
+    report_parser = sub.add_parser("report", help="Print a Markdown comparison of a JSON result file")
+    report_parser.add_argument("results")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        report(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "fastapi",
+#     "uvicorn",
+#     "pyrad",
+#     "jinja2",
+#     "httpx",
+#     "websockets",
+#     "python-multipart",
+#     "PyJWT",
+#     "psutil",
+# ]
+# ///
+
+"""
+Reproducible load benchmark for revproxauth.
+
+Starts revproxauth from the working tree together with a stub upstream and a
+stub RADIUS responder (see stubs.py), drives each scenario with a concurrent
+load generator and records RPS, p50/p99 latency, proxy CPU and peak RSS.
+
+Results are written as JSON tagged with the git commit so runs can be compared:
+
+    uv run tools/bench/bench_proxy.py run --output bench-$(git rev-parse --short HEAD).json
+    uv run tools/bench/bench_proxy.py compare bench-old.json bench-new.json
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import httpx
+import psutil
+import websockets
+from stubs import TEST_USERS, free_port, git_commit, spawn_revproxauth, spawn_stub, stop_processes, wait_for_http
+
+SECRET = "bench-secret"
+USERNAME = "benchuser"
+
+# name -> (default concurrency, description)
+SCENARIOS: dict[str, tuple[int, str]] = {
+    "small_get": (32, "GET 1 KB response"),
+    "large_download": (4, "GET 16 MB streamed response"),
+    "upload": (8, "POST 1 MB request body"),
+    "sse": (16, "SSE stream of 20 events"),
+    "websocket": (16, "WebSocket connect + 50 echo round-trips"),
+    "login_burst": (16, "POST /login through stub RADIUS"),
+}
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class ResourceSampler:
+    """Samples CPU time and RSS of the proxy process while a scenario runs."""
+
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.peak_rss = 0
+        self._task: asyncio.Task[None] | None = None
+
+    async def _run(self) -> None:
+        while True:
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        times = self.process.cpu_times()
+        self.cpu_start = times.user + times.system
+        self.peak_rss = self.process.memory_info().rss
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> tuple[float, int]:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        times = self.process.cpu_times()
+        return times.user + times.system - self.cpu_start, self.peak_rss
+
+
+async def drive(
+    operation: Callable[[], Awaitable[int]], concurrency: int, duration: float
+) -> tuple[list[float], int, int, float]:
+    """Run operation from `concurrency` workers for `duration` seconds.
+
+    Returns (latencies, errors, bytes, elapsed).
+    """
+    latencies: list[float] = []
+    errors = 0
+    transferred = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker() -> None:
+        nonlocal errors, transferred
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                transferred += await operation()
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, transferred, time.perf_counter() - started
+
+
+def make_operation(
+    name: str, base_url: str, client: httpx.AsyncClient, cookie_header: str
+) -> Callable[[], Awaitable[int]]:
+    upload_body = b"u" * (1024 * 1024)
+    ws_url = base_url.replace("http://", "ws://") + "/ws"
+
+    async def small_get() -> int:
+        resp = await client.get(f"{base_url}/small?size=1024")
+        resp.raise_for_status()
+        return len(resp.content)
+
+    async def large_download() -> int:
+        total = 0
+        async with client.stream("GET", f"{base_url}/download?size={16 * 1024 * 1024}") as resp:
+            resp.raise_for_status()
+            async for chunk in resp.aiter_raw():
+                total += len(chunk)
+        return total
+
+    async def upload() -> int:
+        resp = await client.post(f"{base_url}/upload", content=upload_body)
+        resp.raise_for_status()
+        return len(upload_body)
+
+    async def sse() -> int:
+        total = 0
+        async with client.stream("GET", f"{base_url}/sse?events=20&interval=0.005") as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                total += len(line)
+        return total
+
+    async def websocket() -> int:
+        async with websockets.connect(ws_url, additional_headers={"Cookie": cookie_header}) as ws:
+            for i in range(50):
+                await ws.send(f"ping {i}")
+                await ws.recv()
+        return 50
+
+    async def login_burst() -> int:
+        resp = await client.post(
+            f"{base_url}/login",
+            data={"username": USERNAME, "password": TEST_USERS[USERNAME], "next": "/"},
+            follow_redirects=False,
+        )
+        if resp.status_code != 303:
+            raise RuntimeError(f"login failed with {resp.status_code}")
+        return 0
+
+    return {
+        "small_get": small_get,
+        "large_download": large_download,
+        "upload": upload,
+        "sse": sse,
+        "websocket": websocket,
+        "login_burst": login_burst,
+    }[name]
+
+
+async def run_scenarios(args: argparse.Namespace, base_url: str, proxy_pid: int) -> dict[str, Any]:
+    results: dict[str, Any] = {}
+    limits = httpx.Limits(max_connections=256, max_keepalive_connections=256)
+    async with httpx.AsyncClient(timeout=60.0, limits=limits) as client:
+        # Log in once through the real login flow to get session cookies
+        resp = await client.post(
+            f"{base_url}/login",
+            data={"username": USERNAME, "password": TEST_USERS[USERNAME], "next": "/"},
+            follow_redirects=False,
+        )
+        if resp.status_code != 303 or "authz" not in client.cookies:
+            raise RuntimeError(f"Benchmark login failed ({resp.status_code}); see proxy log")
+        cookie_header = "; ".join(f"{k}={v}" for k, v in client.cookies.items())
+
+        for name in args.scenarios:
+            concurrency = args.concurrency or SCENARIOS[name][0]
+            operation = make_operation(name, base_url, client, cookie_header)
+            # Warm up connections and caches so runs are comparable
+            await drive(operation, min(concurrency, 4), args.warmup)
+
+            sampler = ResourceSampler(proxy_pid)
+            sampler.start()
+            latencies, errors, transferred, elapsed = await drive(operation, concurrency, args.duration)
+            cpu_seconds, peak_rss = await sampler.stop()
+
+            count = len(latencies)
+            results[name] = {
+                "description": SCENARIOS[name][1],
+                "concurrency": concurrency,
+                "requests": count,
+                "errors": errors,
+                "rps": count / elapsed if elapsed else 0.0,
+                "mb_per_s": transferred / elapsed / 1024 / 1024 if elapsed else 0.0,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+                "cpu_percent": cpu_seconds / elapsed * 100 if elapsed else 0.0,
+                "cpu_ms_per_request": cpu_seconds / count * 1000 if count else 0.0,
+                "peak_rss_mb": peak_rss / 1024 / 1024,
+            }
+            print_row(name, results[name])
+    return results
+
+
+def print_header() -> None:
+    print(
+        f"{'scenario':<16}{'conc':>5}{'reqs':>8}{'err':>5}{'rps':>9}{'MB/s':>8}"
+        f"{'p50 ms':>9}{'p99 ms':>9}{'cpu %':>7}{'cpu ms/req':>11}{'rss MB':>8}"
+    )
+
+
+def print_row(name: str, r: dict[str, Any]) -> None:
+    print(
+        f"{name:<16}{r['concurrency']:>5}{r['requests']:>8}{r['errors']:>5}{r['rps']:>9.1f}{r['mb_per_s']:>8.1f}"
+        f"{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['cpu_percent']:>7.0f}{r['cpu_ms_per_request']:>11.3f}"
+        f"{r['peak_rss_mb']:>8.1f}",
+        flush=True,
+    )
+
+
+def run(args: argparse.Namespace) -> None:
+    workdir = Path(tempfile.mkdtemp(prefix="revproxauth-bench-"))
+    upstream_port = free_port()
+    radius_port = free_port()
+    proxy_port = free_port()
+
+    config_file = workdir / "revproxauth.json"
+    config = {
+        "version": "1.0",
+        "mappings": [
+            {
+                "match_url": "127.0.0.1",
+                "http_dest": f"http://127.0.0.1:{upstream_port}",
+                "flags": [],
+                "allowed_users": [],
+                "allowed_groups": [],
+                # Measure the proxy itself, not admission control back-pressure
+                "max_concurrency": 0,
+            }
+        ],
+    }
+    config_file.write_text(json.dumps(config, indent=2))
+
+    processes = [
+        spawn_stub("upstream", "--port", str(upstream_port), log_path=workdir / "upstream.log"),
+        spawn_stub(
+            "radius",
+            "--port",
+            str(radius_port),
+            "--secret",
+            SECRET,
+            "--delay",
+            str(args.radius_delay),
+            log_path=workdir / "radius.log",
+        ),
+    ]
+    # The login throttle is off so login_burst measures login throughput, not lockouts
+    proxy_env = {"LOG_LEVEL": args.log_level, "LOGIN_USER_LIMIT": "0"}
+    proxy = spawn_revproxauth(proxy_port, config_file, radius_port, SECRET, workdir / "proxy.log", proxy_env)
+    processes.append(proxy)
+    base_url = f"http://127.0.0.1:{proxy_port}"
+    try:
+        wait_for_http(f"http://127.0.0.1:{upstream_port}/small")
+        wait_for_http(f"{base_url}/health")
+        print(f"Benchmarking commit {git_commit()} (logs in {workdir})")
+        print_header()
+        scenarios = asyncio.run(run_scenarios(args, base_url, proxy.pid))
+    finally:
+        stop_processes(processes)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": psutil.cpu_count(),
+        "settings": {
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "log_level": args.log_level,
+            "radius_delay": args.radius_delay,
+        },
+        "scenarios": scenarios,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"Results written to {args.output}")
+
+
+def compare(args: argparse.Namespace) -> None:
+    base = json.loads(Path(args.baseline).read_text())
+    new = json.loads(Path(args.candidate).read_text())
+    if base.get("settings") != new.get("settings"):
+        print("Warning: runs used different settings; deltas may not be meaningful", file=sys.stderr)
+    print(f"baseline {base['commit']} vs candidate {new['commit']}")
+    print(f"{'scenario':<16}{'metric':<20}{'baseline':>12}{'candidate':>12}{'change':>9}")
+    for name, before in base["scenarios"].items():
+        after = new["scenarios"].get(name)
+        if after is None:
+            continue
+        for metric in ("rps", "p50_ms", "p99_ms", "cpu_ms_per_request", "peak_rss_mb", "errors"):
+            old, cur = before[metric], after[metric]
+            change = f"{(cur - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{name:<16}{metric:<20}{old:>12.2f}{cur:>12.2f}{change:>9}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="Run the benchmark scenarios")
+    run_parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    run_parser.add_argument("--duration", type=float, default=10.0, help="Seconds per scenario")
+    run_parser.add_argument("--warmup", type=float, default=2.0, help="Warm-up seconds per scenario")
+    run_parser.add_argument("--concurrency", type=int, default=0, help="Override per-scenario concurrency")
+    run_parser.add_argument("--log-level", default="INFO", help="LOG_LEVEL for the proxy (default matches production)")
+    run_parser.add_argument("--radius-delay", type=float, default=0.0, help="Stub RADIUS reply delay in seconds")
+    run_parser.add_argument("--output", help="Write JSON results to this file")
+
+    compare_parser = sub.add_parser("compare", help="Compare two JSON result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
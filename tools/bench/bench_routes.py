@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "fastapi",
+#     "uvicorn",
+#     "pyrad",
+#     "jinja2",
+#     "httpx",
+#     "websockets",
+#     "python-multipart",
+#     "PyJWT",
+# ]
+# ///
+
+"""
+Route matching benchmark for revproxauth.
+
+Imports revproxauth from the working tree and times ConfigSnapshot.match, the
+combined matcher compiled once per config generation, against a linear scan of
+the same routes in the same precedence order (how matching worked before). Each
+rule set is generated at several sizes, so the numbers show how matching cost
+grows with the number of mappings:
+
+- exact: one mapping per host, app<n>.example.com
+- wildcard: one mapping per wildcard host, *.t<n>.example.com
+- prefix: literal path prefixes on one host, example.com/svc<n>
+- regex: regex paths on one host, example.com/~v<n>/items/[0-9]+
+- mixed: a quarter of each
+
+A sample of the lookups is checked against the linear scan, so a run also
+verifies that both pick the same mapping.
+
+    uv run tools/bench/bench_routes.py run --output routes-$(git rev-parse --short HEAD).json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+from stubs import DICTIONARY, REVPROXAUTH_DIR, git_commit
+
+RULE_SETS = ["exact", "wildcard", "prefix", "regex", "mixed"]
+
+
+def load_revproxauth(workdir: Path) -> Any:
+    """Import revproxauth's main module with a throwaway config and without its startup banner."""
+    config_file = workdir / "revproxauth.json"
+    config_file.write_text(json.dumps({"version": "1.0", "mappings": []}))
+    os.environ.update(
+        {
+            "RADIUS_SERVER": "127.0.0.1",
+            "RADIUS_SECRET": "bench-secret",
+            "RADIUS_DICTIONARY": str(DICTIONARY),
+            "REVPROXAUTH_CONFIG_FILE": str(config_file),
+            "LOG_LEVEL": "WARNING",
+            "LOOP_MONITOR": "0",
+        }
+    )
+    # main.py resolves templates and static files relative to its directory
+    os.chdir(REVPROXAUTH_DIR)
+    sys.path.insert(0, str(REVPROXAUTH_DIR))
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main  # noqa: PLC0415
+
+    return main
+
+
+def mapping(match_url: str) -> dict[str, Any]:
+    return {"match_url": match_url, "http_dest": "http://127.0.0.1:8080", "flags": [], "allowed_users": []}
+
+
+def generate(rule_set: str, count: int) -> tuple[list[dict[str, Any]], list[tuple[str, str]]]:
+    """Mappings of a rule set and one request (host, path) that each of them should serve."""
+    if rule_set == "mixed":
+        mappings: list[dict[str, Any]] = []
+        requests: list[tuple[str, str]] = []
+        for part in RULE_SETS[:-1]:
+            part_mappings, part_requests = generate(part, max(1, count // 4))
+            mappings += part_mappings
+            requests += part_requests
+        return mappings, requests
+    if rule_set == "exact":
+        hosts = [f"app{n}.example.com" for n in range(count)]
+        return [mapping(h) for h in hosts], [(h, "/index.html") for h in hosts]
+    if rule_set == "wildcard":
+        return (
+            [mapping(f"*.t{n}.example.com") for n in range(count)],
+            [(f"user{n}.t{n}.example.com", "/index.html") for n in range(count)],
+        )
+    if rule_set == "prefix":
+        return (
+            [mapping(f"example.com/svc{n}") for n in range(count)],
+            [("example.com", f"/svc{n}/status") for n in range(count)],
+        )
+    return (
+        [mapping(f"example.com/~v{n}/items/[0-9]+") for n in range(count)],
+        [("example.com", f"/v{n}/items/{n * 7}") for n in range(count)],
+    )
+
+
+def linear_match(routes: list[Any], host: str, request_path: str) -> Any:
+    """Try every route in precedence order, like matching did before the combined matcher."""
+    path = request_path[1:]
+    for route in routes:
+        if route.host_suffix is not None:
+            host_ok = host.endswith(f".{route.host_suffix}")
+        else:
+            host_ok = not route.host or route.host == host
+        if route.path_regex is not None:
+            path_ok = route.path_pattern.match(path) is not None
+        else:
+            path_ok = path.startswith(route.path)
+        if host_ok and path_ok:
+            return route
+    return None
+
+
+def time_lookups(match: Callable[[str, str], Any], requests: list[tuple[str, str]], duration: float) -> float:
+    """Nanoseconds per lookup, repeating a random batch of requests for about `duration` seconds."""
+    batch = [random.choice(requests) for _ in range(256)]
+    lookups = 0
+    started = time.perf_counter()
+    deadline = started + duration
+    while time.perf_counter() < deadline:
+        for host, path in batch:
+            match(host, path)
+        lookups += len(batch)
+    return (time.perf_counter() - started) / lookups * 1e9
+
+
+def measure(main: Any, rule_set: str, count: int, args: argparse.Namespace) -> dict[str, Any]:
+    mappings, requests = generate(rule_set, count)
+    # Requests for a host and a path no mapping serves exercise the full miss path
+    misses = [("unknown.example.org", "/nothing/here")] * max(1, len(requests) // 10)
+
+    started = time.perf_counter()
+    snapshot = main.ConfigSnapshot(1, mappings)
+    table = snapshot.table
+    compile_ms = (time.perf_counter() - started) * 1000
+    ordered = sorted(snapshot.routes, key=lambda route: route.precedence)
+
+    for host, path in random.sample(requests, min(len(requests), 200)) + misses[:1]:
+        expected = linear_match(ordered, host, path)
+        if table.match(host, path) is not expected:
+            raise RuntimeError(f"Matchers disagree on {host}{path} with {rule_set} x {count}")
+
+    workload = requests + misses
+    return {
+        "mappings": len(mappings),
+        "compile_ms": compile_ms,
+        "compiled_ns": time_lookups(table.match, workload, args.duration),
+        "linear_ns": time_lookups(lambda h, p: linear_match(ordered, h, p), workload, args.duration),
+    }
+
+
+def print_header() -> None:
+    print(f"{'rule set':<10}{'mappings':>10}{'compile ms':>12}{'compiled ns':>13}{'linear ns':>12}{'speedup':>9}")
+
+
+def print_row(rule_set: str, r: dict[str, Any]) -> None:
+    print(
+        f"{rule_set:<10}{r['mappings']:>10}{r['compile_ms']:>12.1f}{r['compiled_ns']:>13.0f}{r['linear_ns']:>12.0f}"
+        f"{r['linear_ns'] / r['compiled_ns']:>8.1f}x",
+        flush=True,
+    )
+
+
+def run(args: argparse.Namespace) -> None:
+    # Resolved first: importing revproxauth changes the working directory
+    output = Path(args.output).resolve() if args.output else None
+    main = load_revproxauth(Path(tempfile.mkdtemp(prefix="routes-bench-")))
+    random.seed(args.seed)
+    print(f"Benchmarking commit {git_commit()}")
+    print_header()
+    results: dict[str, list[dict[str, Any]]] = {}
+    for rule_set in args.rule_sets:
+        results[rule_set] = []
+        for count in args.counts:
+            result = measure(main, rule_set, count, args)
+            results[rule_set].append(result)
+            print_row(rule_set, result)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"counts": args.counts, "duration": args.duration, "seed": args.seed},
+        "rule_sets": results,
+    }
+    if output:
+        output.write_text(json.dumps(report, indent=2))
+        print(f"Results written to {output}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="Benchmark route matching")
+    run_parser.add_argument("--rule-sets", nargs="+", choices=RULE_SETS, default=RULE_SETS)
+    run_parser.add_argument("--counts", nargs="+", type=int, default=[10, 100, 1000, 5000], help="Mappings per run")
+    run_parser.add_argument("--duration", type=float, default=1.0, help="Seconds per matcher and size")
+    run_parser.add_argument("--seed", type=int, default=1, help="Seed for the lookup order")
+    run_parser.add_argument("--output", help="Write JSON results to this file")
+
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "fastapi",
+#     "uvicorn",
+#     "pyrad",
+#     "jinja2",
+#     "httpx",
+#     "websockets",
+#     "python-multipart",
+#     "PyJWT",
+#     "psutil",
+# ]
+# ///
+
+"""
+Long-running soak test with fault injection for revproxauth.
+
+Runs a mixed workload against revproxauth (started from the working tree with
+stub upstream and RADIUS services) while injecting faults:
+
+- upstream resets mid-stream (downloads and SSE)
+- slow readers that trickle-read large downloads and then give up
+- clients disconnecting in the middle of SSE streams
+- WebSocket connect/abort churn
+- RADIUS timeouts (dropped Access-Requests) and a stream of new users logging in
+
+It samples proxy RSS, open file descriptors, asyncio task count and event-loop
+lag over time, then lets the proxy go idle and flags leaks automatically.
+Exits with status 1 when a leak or stall is detected.
+
+    uv run tools/bench/soak_proxy.py --duration 3600 --output soak.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import httpx
+import psutil
+import websockets
+from stubs import (
+    SOAK_PASSWORD,
+    TEST_USERS,
+    free_port,
+    git_commit,
+    spawn_revproxauth,
+    spawn_stub,
+    stop_processes,
+    wait_for_http,
+)
+
+SECRET = "soak-secret"
+ADMIN_USER = "benchuser"
+
+
+def slope_per_hour(points: list[tuple[float, float]]) -> float:
+    """Least-squares slope of (seconds, value) points, scaled to units per hour."""
+    if len(points) < 3:
+        return 0.0
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    mean_x, mean_y = statistics.fmean(xs), statistics.fmean(ys)
+    denominator = sum((x - mean_x) ** 2 for x in xs)
+    if not denominator:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys, strict=True)) / denominator * 3600
+
+
+class Soak:
+    def __init__(self, args: argparse.Namespace, base_url: str, proxy_pid: int):
+        self.args = args
+        self.base_url = base_url
+        self.process = psutil.Process(proxy_pid)
+        self.samples: list[dict[str, Any]] = []
+        self.counters: dict[str, int] = {}
+        self.stop = asyncio.Event()
+        self.user_ids = itertools.count()
+        self.started = time.monotonic()
+
+    def count(self, name: str) -> None:
+        self.counters[name] = self.counters.get(name, 0) + 1
+
+    async def login(self, client: httpx.AsyncClient, username: str, password: str) -> bool:
+        resp = await client.post(
+            f"{self.base_url}/login",
+            data={"username": username, "password": password, "next": "/"},
+            follow_redirects=False,
+        )
+        return resp.status_code == 303
+
+    # -- sampling -----------------------------------------------------------
+
+    async def sample(self, admin: httpx.AsyncClient, phase: str) -> dict[str, Any]:
+        probe_started = time.perf_counter()
+        runtime: dict[str, Any] = {}
+        try:
+            resp = await admin.get(f"{self.base_url}/revproxauth/runtime", timeout=30.0)
+            if resp.status_code == 200:
+                runtime = resp.json()
+        except httpx.HTTPError:
+            self.count("sample_errors")
+        sample = {
+            "t": round(time.monotonic() - self.started, 2),
+            "phase": phase,
+            "rss_mb": self.process.memory_info().rss / 1024 / 1024,
+            "open_fds": self.process.num_fds(),
+            "probe_ms": (time.perf_counter() - probe_started) * 1000,
+            **runtime,
+        }
+        self.samples.append(sample)
+        return sample
+
+    async def sampler(self, admin: httpx.AsyncClient) -> None:
+        while not self.stop.is_set():
+            elapsed = time.monotonic() - self.started
+            sample = await self.sample(admin, "warmup" if elapsed < self.args.warmup else "soak")
+            if self.args.verbose:
+                print(
+                    f"[{sample['t']:>7.0f}s] rss={sample['rss_mb']:.1f}MB fds={sample['open_fds']} "
+                    f"tasks={sample.get('tasks')} lag={sample.get('loop_lag_ms', 0):.1f}ms "
+                    f"metrics_keys={sample.get('metrics_keys')}",
+                    flush=True,
+                )
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self.stop.wait(), timeout=self.args.sample_interval)
+
+    # -- workload -----------------------------------------------------------
+
+    async def loop_worker(self, name: str, operation: Callable[[], Awaitable[None]], pause: float = 0.0) -> None:
+        while not self.stop.is_set():
+            try:
+                await operation()
+                self.count(f"{name}_ok")
+            except Exception:
+                self.count(f"{name}_error")
+            if pause:
+                await asyncio.sleep(pause * random.uniform(0.5, 1.5))
+
+    def operations(
+        self, client: httpx.AsyncClient, cookie_header: str
+    ) -> list[tuple[str, Callable[[], Awaitable[None]], float]]:
+        base = self.base_url
+
+        async def steady_get() -> None:
+            resp = await client.get(f"{base}/small?size={random.randint(100, 8192)}")
+            resp.raise_for_status()
+
+        async def download() -> None:
+            async with client.stream("GET", f"{base}/download?size={4 * 1024 * 1024}") as resp:
+                resp.raise_for_status()
+                async for _ in resp.aiter_raw():
+                    pass
+
+        async def slow_reader() -> None:
+            give_up_after = random.uniform(1.0, 10.0)
+            started = time.monotonic()
+            async with client.stream("GET", f"{base}/download?size={64 * 1024 * 1024}") as resp:
+                async for _ in resp.aiter_raw(4096):
+                    await asyncio.sleep(0.05)
+                    if time.monotonic() - started > give_up_after:
+                        break
+
+        async def sse_disconnect() -> None:
+            stop_after = random.randint(1, 30)
+            async with client.stream("GET", f"{base}/sse?events=1000&interval=0.05") as resp:
+                seen = 0
+                async for line in resp.aiter_lines():
+                    if line.startswith("data:"):
+                        seen += 1
+                        if seen >= stop_after:
+                            break
+
+        async def websocket_churn() -> None:
+            ws_url = base.replace("http://", "ws://") + "/ws"
+            async with websockets.connect(ws_url, additional_headers={"Cookie": cookie_header}, open_timeout=10) as ws:
+                for i in range(random.randint(1, 20)):
+                    await ws.send(f"soak {i}")
+                    await ws.recv()
+                if random.random() < 0.5:
+                    # Abort without a close handshake, like a client losing its network
+                    ws.transport.abort()
+
+        async def user_churn() -> None:
+            # Every login is a new user, which grows any per-user state in the proxy
+            async with httpx.AsyncClient(timeout=60.0) as fresh:
+                if await self.login(fresh, f"soak-{next(self.user_ids)}", SOAK_PASSWORD):
+                    await fresh.get(f"{base}/small")
+
+        a = self.args
+        return (
+            [("steady_get", steady_get, 0.0)] * a.get_workers
+            + [("download", download, 0.5)] * a.download_workers
+            + [("slow_reader", slow_reader, 0.5)] * a.slow_readers
+            + [("sse_disconnect", sse_disconnect, 0.2)] * a.sse_workers
+            + [("websocket_churn", websocket_churn, 0.5)] * a.ws_workers
+            + [("user_churn", user_churn, a.login_interval)] * (1 if a.login_interval else 0)
+        )
+
+    async def run(self) -> None:
+        limits = httpx.Limits(max_connections=512, max_keepalive_connections=64)
+        async with httpx.AsyncClient(timeout=120.0, limits=limits) as client:
+            if not await self.login(client, ADMIN_USER, TEST_USERS[ADMIN_USER]):
+                raise RuntimeError("Soak login failed; see proxy log")
+            cookie_header = "; ".join(f"{k}={v}" for k, v in client.cookies.items())
+            async with httpx.AsyncClient(cookies=client.cookies, timeout=30.0) as admin:
+                await self.sample(admin, "baseline")
+                sampler = asyncio.create_task(self.sampler(admin))
+                workers = [
+                    asyncio.create_task(self.loop_worker(name, op, pause))
+                    for name, op, pause in self.operations(client, cookie_header)
+                ]
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(self.stop.wait(), timeout=self.args.warmup + self.args.duration)
+                self.stop.set()
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, sampler, return_exceptions=True)
+
+                # Let the proxy settle: everything the workload started should now be released
+                await asyncio.sleep(self.args.quiesce)
+                await self.sample(admin, "idle")
+
+    # -- analysis -----------------------------------------------------------
+
+    def analyse(self) -> tuple[dict[str, Any], list[str]]:
+        a = self.args
+        baseline = self.samples[0]
+        idle = self.samples[-1]
+        soak = [s for s in self.samples if s["phase"] == "soak"]
+        second_half = soak[len(soak) // 2 :]
+        findings: list[str] = []
+
+        rss_slope = slope_per_hour([(s["t"], s["rss_mb"]) for s in second_half])
+        if rss_slope > a.rss_slope_limit:
+            findings.append(f"RSS keeps growing under load: {rss_slope:+.1f} MB/hour (limit {a.rss_slope_limit})")
+
+        for key, limit in (("open_fds", a.fd_growth_limit), ("tasks", a.task_growth_limit)):
+            if key in idle and key in baseline and idle[key] - baseline[key] > limit:
+                findings.append(f"{key} did not return to baseline when idle: {baseline[key]} -> {idle[key]}")
+
+        if idle.get("active_upstream_requests"):
+            findings.append(f"{idle['active_upstream_requests']} admission slots still held when idle")
+
+        for key in ("metrics_keys", "quota_keys", "bandwidth_buckets"):
+            growth = slope_per_hour([(s["t"], s[key]) for s in second_half if key in s])
+            if growth > a.table_growth_limit:
+                findings.append(f"{key} grows without bound: {growth:+.0f} entries/hour")
+
+        lags = [s["loop_lag_ms"] for s in soak if "loop_lag_ms" in s]
+        probes = [s["probe_ms"] for s in soak]
+        if lags and max(lags) > a.lag_limit_ms:
+            findings.append(f"Event loop stalled: max lag {max(lags):.0f} ms (limit {a.lag_limit_ms:.0f} ms)")
+
+        summary = {
+            "baseline": baseline,
+            "idle": idle,
+            "rss_slope_mb_per_hour": rss_slope,
+            "loop_lag_ms": {
+                "p50": statistics.median(lags) if lags else 0.0,
+                "max": max(lags) if lags else 0.0,
+            },
+            "probe_ms": {
+                "p50": statistics.median(probes) if probes else 0.0,
+                "max": max(probes) if probes else 0.0,
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+        return summary, findings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=3600.0, help="Soak seconds after warm-up")
+    parser.add_argument("--warmup", type=float, default=60.0, help="Warm-up seconds excluded from leak analysis")
+    parser.add_argument("--quiesce", type=float, default=15.0, help="Idle seconds before the final sample")
+    parser.add_argument("--sample-interval", type=float, default=5.0)
+    parser.add_argument("--get-workers", type=int, default=8)
+    parser.add_argument("--download-workers", type=int, default=2)
+    parser.add_argument("--slow-readers", type=int, default=4)
+    parser.add_argument("--sse-workers", type=int, default=4)
+    parser.add_argument("--ws-workers", type=int, default=2)
+    parser.add_argument("--login-interval", type=float, default=2.0, help="Seconds between new-user logins, 0 = off")
+    parser.add_argument("--upstream-reset-rate", type=float, default=0.05, help="Fraction of streams reset mid-body")
+    parser.add_argument("--radius-drop-rate", type=float, default=0.02, help="Fraction of RADIUS requests dropped")
+    parser.add_argument("--rss-slope-limit", type=float, default=20.0, help="Allowed RSS growth, MB/hour")
+    parser.add_argument("--fd-growth-limit", type=int, default=10)
+    parser.add_argument("--task-growth-limit", type=int, default=5)
+    parser.add_argument("--table-growth-limit", type=float, default=100.0, help="Allowed table growth, entries/hour")
+    parser.add_argument("--lag-limit-ms", type=float, default=500.0)
+    parser.add_argument("--log-level", default="WARNING", help="LOG_LEVEL for the proxy")
+    parser.add_argument("--output", help="Write samples and findings as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Print every sample")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="revproxauth-soak-"))
+    upstream_port, radius_port, proxy_port = free_port(), free_port(), free_port()
+    config_file = workdir / "revproxauth.json"
+    mapping = {
+        "match_url": "127.0.0.1",
+        "http_dest": f"http://127.0.0.1:{upstream_port}",
+        "flags": [],
+        "allowed_users": [],
+        "allowed_groups": [],
+    }
+    config_file.write_text(json.dumps({"version": "1.0", "mappings": [mapping]}, indent=2))
+
+    processes = [
+        spawn_stub(
+            "upstream",
+            "--port",
+            str(upstream_port),
+            "--reset-rate",
+            str(args.upstream_reset_rate),
+            log_path=workdir / "upstream.log",
+        ),
+        spawn_stub(
+            "radius",
+            "--port",
+            str(radius_port),
+            "--secret",
+            SECRET,
+            "--drop-rate",
+            str(args.radius_drop_rate),
+            log_path=workdir / "radius.log",
+        ),
+    ]
+    proxy = spawn_revproxauth(
+        proxy_port, config_file, radius_port, SECRET, workdir / "proxy.log", {"LOG_LEVEL": args.log_level}
+    )
+    processes.append(proxy)
+    base_url = f"http://127.0.0.1:{proxy_port}"
+    soak = Soak(args, base_url, proxy.pid)
+    try:
+        wait_for_http(f"http://127.0.0.1:{upstream_port}/small")
+        wait_for_http(f"{base_url}/health")
+        print(f"Soaking commit {git_commit()} for {args.warmup + args.duration:.0f}s (logs in {workdir})", flush=True)
+        asyncio.run(soak.run())
+    except KeyboardInterrupt:
+        print("Interrupted; analysing samples collected so far")
+    finally:
+        stop_processes(processes)
+
+    if not soak.samples:
+        sys.exit("No samples collected")
+    summary, findings = soak.analyse()
+    print(json.dumps({k: v for k, v in summary.items() if k not in ("baseline", "idle")}, indent=2))
+    print(f"baseline: {summary['baseline']}")
+    print(f"idle:     {summary['idle']}")
+    if findings:
+        print("\nLEAKS / STALLS DETECTED:")
+        for finding in findings:
+            print(f"  - {finding}")
+    else:
+        print("\nNo leaks detected")
+
+    if args.output:
+        report = {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "settings": vars(args),
+            "summary": summary,
+            "findings": findings,
+            "samples": soak.samples,
+        }
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    sys.exit(1 if findings else 0)
+
+
+if __name__ == "__main__":
+    main()
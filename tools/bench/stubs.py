@@ -0,0 +1,422 @@
+"""
+Stub services shared by the benchmark and soak harnesses.
+
+- A tiny raw-ASGI upstream with configurable latency and body size, plus SSE
+  and WebSocket echo endpoints (kept framework-free so the upstream costs as
+  little CPU as possible and the numbers reflect the proxy).
+- A RADIUS responder built on pyrad that accepts fixed test credentials,
+  using the same dictionary file as revproxauth.
+- A Redis stand-in speaking enough of the protocol (PING, AUTH, SELECT, GET,
+  SET with EX/PX, DEL, EXPIRE, TTL) for the radius-auth-py session backend.
+
+Both can be run standalone, optionally injecting faults (streams reset
+mid-body, RADIUS requests dropped so the client times out):
+
+    python tools/bench/stubs.py upstream --port 18081 --reset-rate 0.05
+    python tools/bench/stubs.py radius --port 18120 --secret testing123 --drop-rate 0.01
+    python tools/bench/stubs.py redis --port 16379
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any
+from urllib.parse import parse_qs
+
+ROOT = Path(__file__).resolve().parent.parent.parent
+REVPROXAUTH_DIR = ROOT / "apps" / "revproxauth"
+DICTIONARY = REVPROXAUTH_DIR / "dictionary"
+
+TEST_USERS = {"benchuser": "benchpass", "testuser": "testpass"}
+# Any "soak-<n>" user with this password is accepted, so harnesses can log in as many distinct users
+SOAK_PASSWORD = "soakpass"
+CHUNK = b"x" * 65536
+
+
+# ---------------------------------------------------------------------------
+# Stub upstream
+# ---------------------------------------------------------------------------
+
+
+def _query(scope: dict[str, Any]) -> dict[str, str]:
+    return {k: v[0] for k, v in parse_qs(scope.get("query_string", b"").decode()).items()}
+
+
+class UpstreamFaults:
+    """Faults injected by the stub upstream (set from the command line)."""
+
+    reset_rate = 0.0  # probability that a streamed response is cut mid-body
+
+
+async def _send_body(send: Any, status: int, body: bytes, content_type: str = "text/plain") -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def upstream_app(scope: dict[str, Any], receive: Any, send: Any) -> None:
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] == "websocket":
+        await _websocket_echo(receive, send)
+        return
+
+    path = scope["path"]
+    params = _query(scope)
+    latency = float(params.get("latency", 0))
+    if latency:
+        await asyncio.sleep(latency)
+
+    if path == "/upload":
+        total = 0
+        more = True
+        while more:
+            message = await receive()
+            total += len(message.get("body", b""))
+            more = message.get("more_body", False)
+        await _send_body(send, 200, str(total).encode())
+    elif path == "/download":
+        await _stream_download(send, int(params.get("size", 1024 * 1024)))
+    elif path == "/sse":
+        await _stream_sse(send, int(params.get("events", 10)), float(params.get("interval", 0.01)))
+    else:
+        await _send_body(send, 200, CHUNK[: int(params.get("size", 1024))])
+
+
+async def _stream_download(send: Any, size: int) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/octet-stream")],
+        }
+    )
+    cut_at = random.randrange(max(size, 1)) if random.random() < UpstreamFaults.reset_rate else -1
+    sent = 0
+    while sent < size:
+        if 0 <= cut_at <= sent:
+            # Drop the connection mid-body like a crashing backend would
+            raise ConnectionResetError("injected upstream reset")
+        piece = CHUNK[: min(len(CHUNK), size - sent)]
+        sent += len(piece)
+        await send({"type": "http.response.body", "body": piece, "more_body": sent < size})
+
+
+async def _stream_sse(send: Any, events: int, interval: float) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")],
+        }
+    )
+    cut_at = random.randrange(max(events, 1)) if random.random() < UpstreamFaults.reset_rate else -1
+    for i in range(events):
+        if i == cut_at:
+            raise ConnectionResetError("injected upstream reset")
+        await send({"type": "http.response.body", "body": f"data: {i}\n\n".encode(), "more_body": True})
+        if interval:
+            await asyncio.sleep(interval)
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def _websocket_echo(receive: Any, send: Any) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "websocket.connect":
+            await send({"type": "websocket.accept"})
+        elif message["type"] == "websocket.receive":
+            if message.get("text") is not None:
+                await send({"type": "websocket.send", "text": message["text"]})
+            else:
+                await send({"type": "websocket.send", "bytes": message.get("bytes") or b""})
+        elif message["type"] == "websocket.disconnect":
+            return
+
+
+def run_upstream(port: int, reset_rate: float = 0.0, uds: str | None = None) -> None:
+    import uvicorn
+
+    UpstreamFaults.reset_rate = reset_rate
+    # With uds set, uvicorn listens on that Unix socket instead of the port
+    uvicorn.run(upstream_app, host="127.0.0.1", port=port, uds=uds, log_level="warning", ws="websockets")
+
+
+# ---------------------------------------------------------------------------
+# Stub RADIUS responder
+# ---------------------------------------------------------------------------
+
+
+class RadiusResponder(asyncio.DatagramProtocol):
+    """Answers Access-Requests for the test users after an optional delay.
+
+    A drop rate makes the responder ignore some requests, which the client sees as a RADIUS timeout.
+    """
+
+    def __init__(self, secret: bytes, delay: float = 0.0, drop_rate: float = 0.0):
+        from pyrad.dictionary import Dictionary
+
+        self.secret = secret
+        self.delay = delay
+        self.drop_rate = drop_rate
+        self.dict = Dictionary(str(DICTIONARY))
+        self.transport: asyncio.DatagramTransport | None = None
+        self.requests = 0
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport  # type: ignore[assignment]
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        self.requests += 1
+        if self.drop_rate and random.random() < self.drop_rate:
+            return
+        if self.delay:
+            asyncio.get_running_loop().call_later(self.delay, self._reply, data, addr)
+        else:
+            self._reply(data, addr)
+
+    def _reply(self, data: bytes, addr: tuple[str, int]) -> None:
+        from pyrad import packet
+
+        try:
+            request = packet.AuthPacket(packet=data, secret=self.secret, dict=self.dict)
+            username = request["User-Name"][0]
+            password = request.PwDecrypt(request["User-Password"][0])
+        except Exception:
+            return
+        reply = request.CreateReply()
+        if TEST_USERS.get(username) == password or (username.startswith("soak-") and password == SOAK_PASSWORD):
+            reply.code = packet.AccessAccept
+        else:
+            reply.code = packet.AccessReject
+        if self.transport is not None:
+            self.transport.sendto(reply.ReplyPacket(), addr)
+
+
+def run_radius(port: int, secret: str, delay: float = 0.0, drop_rate: float = 0.0) -> None:
+    async def serve() -> None:
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(
+            lambda: RadiusResponder(secret.encode(), delay, drop_rate), local_addr=("127.0.0.1", port)
+        )
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+# ---------------------------------------------------------------------------
+# Redis stand-in
+# ---------------------------------------------------------------------------
+
+
+class RedisStandIn:
+    """Single-process key/value server speaking the Redis protocol (RESP2).
+
+    Only the commands the session backend uses are implemented; keys expire
+    lazily when read.
+    """
+
+    def __init__(self) -> None:
+        self.data: dict[bytes, tuple[bytes, float | None]] = {}
+        self.commands = 0
+
+    def _get(self, key: bytes) -> bytes | None:
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def execute(self, args: list[bytes]) -> bytes:
+        self.commands += 1
+        name = args[0].upper()
+        if name == b"PING":
+            return b"+PONG\r\n"
+        if name in (b"AUTH", b"SELECT"):
+            return b"+OK\r\n"
+        if name == b"GET":
+            value = self._get(args[1])
+            return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+        if name == b"SET":
+            expires = None
+            options = [a.upper() for a in args[3:]]
+            if b"EX" in options:
+                expires = time.monotonic() + int(args[3 + options.index(b"EX") + 1])
+            elif b"PX" in options:
+                expires = time.monotonic() + int(args[3 + options.index(b"PX") + 1]) / 1000
+            self.data[args[1]] = (args[2], expires)
+            return b"+OK\r\n"
+        if name == b"DEL":
+            removed = 0
+            for key in args[1:]:
+                if self._get(key) is not None:
+                    del self.data[key]
+                    removed += 1
+            return b":%d\r\n" % removed
+        if name == b"EXPIRE":
+            value = self._get(args[1])
+            if value is None:
+                return b":0\r\n"
+            self.data[args[1]] = (value, time.monotonic() + int(args[2]))
+            return b":1\r\n"
+        if name == b"TTL":
+            if self._get(args[1]) is None:
+                return b":-2\r\n"
+            expires = self.data[args[1]][1]
+            return b":-1\r\n" if expires is None else b":%d\r\n" % int(expires - time.monotonic())
+        return b"-ERR unknown command '%s'\r\n" % name
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                header = await reader.readline()
+                if not header:
+                    break
+                if header.startswith(b"*"):
+                    args: list[bytes] = []
+                    for _ in range(int(header[1:])):
+                        length = int((await reader.readline())[1:])
+                        args.append((await reader.readexactly(length + 2))[:-2])
+                else:
+                    # Inline command (e.g. typed into telnet)
+                    args = header.split()
+                if args:
+                    writer.write(self.execute(args))
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def run_redis(port: int) -> None:
+    async def serve() -> None:
+        server = await asyncio.start_server(RedisStandIn().handle, "127.0.0.1", port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+# ---------------------------------------------------------------------------
+# Process helpers
+# ---------------------------------------------------------------------------
+
+
+def free_port(kind: int = socket.SOCK_STREAM) -> int:
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_stub(*args: str, log_path: Path | None = None) -> subprocess.Popen[bytes]:
+    """Start this module as a subprocess running one of the stub services."""
+    out = open(log_path, "wb") if log_path else subprocess.DEVNULL  # noqa: SIM115
+    return subprocess.Popen([sys.executable, __file__, *args], stdout=out, stderr=subprocess.STDOUT)
+
+
+def spawn_revproxauth(
+    port: int, config_file: Path, radius_port: int, secret: str, log_path: Path, extra_env: dict[str, str] | None = None
+) -> subprocess.Popen[bytes]:
+    """Start revproxauth from the working tree against the stub services."""
+    env = {
+        **os.environ,
+        "RADIUS_SERVER": "127.0.0.1",
+        "RADIUS_SECRET": secret,
+        "RADIUS_PORT": str(radius_port),
+        "RADIUS_DICTIONARY": str(DICTIONARY),
+        "REVPROXAUTH_CONFIG_FILE": str(config_file),
+        "LOGIN_DOMAIN": f"http://127.0.0.1:{port}",
+        **(extra_env or {}),
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--workers", "1"],
+        cwd=REVPROXAUTH_DIR,
+        env=env,
+        stdout=open(log_path, "wb"),  # noqa: SIM115
+        stderr=subprocess.STDOUT,
+    )
+
+
+def stop_processes(processes: list[subprocess.Popen[bytes]]) -> None:
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            # Graceful shutdown waits for open connections; do not hang the harness on it
+            process.kill()
+            process.wait()
+
+
+def wait_for_http(url: str, timeout: float = 20.0) -> None:
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True)
+        return out.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+    except OSError:
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="service", required=True)
+    up = sub.add_parser("upstream", help="Run the stub upstream")
+    up.add_argument("--port", type=int, default=18081)
+    up.add_argument("--reset-rate", type=float, default=0.0, help="Fraction of streams to reset mid-body")
+    up.add_argument("--uds", help="Listen on this Unix socket instead of the port")
+    rad = sub.add_parser("radius", help="Run the stub RADIUS responder")
+    rad.add_argument("--port", type=int, default=18120)
+    rad.add_argument("--secret", default="testing123")
+    rad.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before replying")
+    rad.add_argument("--drop-rate", type=float, default=0.0, help="Fraction of requests to ignore (timeouts)")
+    red = sub.add_parser("redis", help="Run the Redis protocol stand-in")
+    red.add_argument("--port", type=int, default=16379)
+    args = parser.parse_args()
+
+    if args.service == "upstream":
+        run_upstream(args.port, args.reset_rate, args.uds)
+    elif args.service == "radius":
+        run_radius(args.port, args.secret, args.delay, args.drop_rate)
+    else:
+        run_redis(args.port)
+
+
+if __name__ == "__main__":
+    main()